@@ -1,8 +1,12 @@
-import copy
-import unittest.mock
-from functools import reduce
+import dataclasses
+import itertools
+from typing import Dict
 
 from entities import Session, UserStatusSavingEnum, LoanStatusEnum, User
+from monte_carlo import run_stress_test
+from policy import Policy
+from simulation import Simulation, compare_policies
+from snapshot import ReadOnlySession
 from utils import IOUtils
 
 
@@ -18,23 +22,25 @@ def _user_in_one_month(user, session: Session) -> User:
     If one wants just to perform the calculation but not mutate the user object, one should deepcopy it before calling
     the function:
     >>> user_in_one_month = _user_in_one_month(copy.deepcopy(user), session)
+
+    Messages are reported to session.notifications.
     """
-    print(" " * 10 + f" * User {user.full_name} (status: {user.status})")
+    notify = session.notifications.notify
+    notify(" " * 10 + " * User {} (status: {})", user.full_name, user.status)
     if user.status == UserStatusSavingEnum.OVERDUE_LOANS:
         if user.at_least_one_user_loan_is_overdue(session):
             # Lock user if one has overdue status for 1 month and failed to pay all overdue loans on their
             # own during the grace period
             user.status = UserStatusSavingEnum.LOCKED
-            print(
-                " " * 20 + "User had overdue loans and failed to pay on their own during the grace period.")
+            notify(" " * 20 + "User had overdue loans and failed to pay on their own during the grace period.")
         else:
             # If user has overdue status but has paid the loans on their own during the grace period,
             # their status is set to active
             user.status = UserStatusSavingEnum.ACTIVE
-            print(" " * 20 + "User had overdue loans but paid on their own during the grace period "
-                             "==> User was reactivated.")
+            notify(" " * 20 + "User had overdue loans but paid on their own during the grace period "
+                              "==> User was reactivated.")
     if user.status == UserStatusSavingEnum.LOCKED:
-        print(" " * 20 + "User is LOCKED. Reason: Overdue unpaid loans.")
+        notify(" " * 20 + "User is LOCKED. Reason: Overdue unpaid loans.")
         return user
 
     # Increase loans and savings by interest rate that was set at the beginning of the previous month
@@ -43,124 +49,248 @@ def _user_in_one_month(user, session: Session) -> User:
 
     # Adjust interest rate if needed, s.t. in the next month a new interest rate will be applied
     user.savings_account.apply_and_adjust_interest_rate(session)
-    print(" " * 20 + "Interest rate for loans and savings applied.")
+    notify(" " * 20 + "Interest rate for loans and savings applied.")
 
     if user.status == UserStatusSavingEnum.ACTIVE:
         # If user has overdue loans, set their status to overdue
         if user.at_least_one_user_loan_is_overdue(session):
             user.status = UserStatusSavingEnum.OVERDUE_LOANS
-            print(" " * 20 + "User has overdue loans. Setting status to OVERDUE_LOANS.")
+            notify(" " * 20 + "User has overdue loans. Setting status to OVERDUE_LOANS.")
 
     if user.status == UserStatusSavingEnum.OVERDUE_LOANS:
         # If user has overdue loans, try to deduct from savings to cover the loans
         for user_loan in user.loans:
             if user_loan.is_expired(session):
                 # Try to deduct from savings to cover the loans
-                if user.savings_account.savings_amount >= user_loan.sum:
-                    # Deduct from payment amount from savings and round to 2 decimal places
-                    user.savings_account.savings_amount = IOUtils.round_float_to_2_decimal_places(
-                        user.savings_account.savings_amount - user_loan.sum
-                    )
+                if user.savings_account.savings_cents >= user_loan.sum_cents:
+                    # Deduct from payment amount from savings
+                    user.savings_account.savings_cents -= user_loan.sum_cents
 
                     user_loan.pay(user_loan.sum, prefix=' ' * 20)
                 else:
-                    print(
+                    notify(
                         " " * 20 + (
-                            f"Not enough savings to cover the loan. User status is set to "
-                            f"{UserStatusSavingEnum.OVERDUE_LOANS}. "
+                            "Not enough savings to cover the loan. User status is set to {}. "
                             "Next month will be the grace period. User will be locked if they fail "
-                            "to pay the loans on their own."))
+                            "to pay the loans on their own."), UserStatusSavingEnum.OVERDUE_LOANS)
                     break
 
         # Remove paid loans
+        for user_loan in user.loans:
+            if user_loan.status == LoanStatusEnum.PAID:
+                user_loan._detach()
         user.loans = [user_loan for user_loan in user.loans if not user_loan.status == LoanStatusEnum.PAID]
 
         # If all overdue loans were successfully paid, set status back to active
         if user.has_no_overdue_loans(session):
             user.status = UserStatusSavingEnum.ACTIVE
-            print(" " * 20 + "All loans are paid. Setting status back to ACTIVE.")
+            notify(" " * 20 + "All loans are paid. Setting status back to ACTIVE.")
     return user
 
 
-def handle_user_list_action(session: Session):
-    for i, user in enumerate(session.users):
-        print(
-            f"{i + 1} - {user.full_name}, Savings: €{user.savings_account.savings_amount:.2f} (at {user.savings_account.interest_rate * 100}%), status: {user.status}")
-        if user.loans:
-            print(" " * 10 + f"User owes to the bank in total €{user.total_loans}. "
-                             f"(Note that this amount is added to user's savings account)")
-            for loan in user.loans:
-                loan.pretty_print_loan(session, prefix=" " * 10)
+def _print_user(number: int, user: User, session: Session):
+    print(
+        f"{number} - {user.full_name} (username: {user.username}), Savings: €{user.savings_account.savings_amount:.2f} (at {user.savings_account.interest_rate * 100}%), status: {user.status}")
+    if user.loans:
+        print(" " * 10 + f"User owes to the bank in total €{user.total_loans}. "
+                         f"(Note that this amount is added to user's savings account)")
+        for loan in user.loans:
+            loan.pretty_print_loan(session, prefix=" " * 10)
+    else:
+        print(" " * 10 + "No loans")
+
+
+def handle_user_list_action(session: Session, page_size: int = 20):
+    """Function that lists the users page by page, optionally filtered and sorted (see Session.list_users)
+
+    An unsorted listing reads the pages from one iterator (see Session.iter_users), so each page only visits the users
+    it shows. A sorted listing asks Session.list_users for every page, which goes over all the matching users and keeps
+    the users up to the end of the page, so the later pages of a large bank get slower.
+    """
+    listing = IOUtils.print_menu_and_return_choice(
+        ["All users", "Users with a status", "Users with loans of at least an amount",
+         "Users with loans expiring soon", "Top debtors"], intro_message="Which users to list?")
+    filters = {}
+    sort_by, descending = None, False
+    if listing == 2:
+        statuses = [status.value for status in UserStatusSavingEnum]
+        filters["status"] = UserStatusSavingEnum(
+            IOUtils.input_str(f"Enter the status ({', '.join(statuses)}): ", expected_values=statuses))
+    if listing == 3:
+        filters["min_total_loans"] = IOUtils.input_float("Enter the minimum total of the loans: ", lower_bound=0)
+    if listing == 4:
+        filters["loans_expiring_within"] = IOUtils.input_int("Enter the number of months (from 1 to 12): ",
+                                                             lower_bound=1, upper_bound=12)
+    if listing == 5:
+        sort_by, descending = "loans", True
+
+    unsorted_users = session.iter_users(**filters) if sort_by is None else None
+    page = 0
+    while True:
+        if unsorted_users is not None:
+            users = list(itertools.islice(unsorted_users, page_size))
         else:
-            print(" " * 10 + "No loans")
+            users = session.list_users(page, page_size, sort_by=sort_by, descending=descending, **filters)
+        for i, user in enumerate(users):
+            _print_user(page * page_size + i + 1, user, session)
+        if not users:
+            print("No users found." if page == 0 else "No more users.")
+        if len(users) < page_size:
+            break
+        if IOUtils.input_str("Click enter to see the next page. Type 'exit' to exit. ",
+                             expected_values=["", "exit"]) == "exit":
+            break
+        page += 1
 
 
 def handle_simulate_action(session: Session):
     """Function that performs simulation
 
-    Function performs a deepcopy of the current session to avoid mutating the original session, performs the simulation
-    and prints the results.
+    The simulation runs on a private copy of the session, thus the original session is not mutated. The function only
+    renders the simulated months.
     """
     current_real_time = session.current_time
-    simulated_session = copy.deepcopy(session)
-    del session
+    simulation = Simulation(session)
     IOUtils.print_section("Simulation")
 
-    i = 0
     while True:
         enter_or_exit = IOUtils.input_str(
-            f"Click enter to run simulation for {i + 1} month ahead. Type 'exit' to exit. ",
+            f"Click enter to run simulation for {simulation.months_ahead + 1} month ahead. Type 'exit' to exit. ",
             expected_values=["", "exit"])
         if enter_or_exit == "exit":
             print("Exiting simulation...")
             break
 
-        simulated_session.current_time += 1
-        i += 1
-        if i > 30:
-            print("Simulation is limited to 30 months ahead. Exiting simulation...\n")
-            break
+        report = simulation.step()
         print(f"Note: Current real time is {current_real_time}.")
         IOUtils.print_section(
-            f"Simulation results for {i} month(s) ahead:")
+            f"Simulation results for {report.months_ahead} month(s) ahead:")
 
-        # Perform one month forward action with suppressed prints for simulated session
-        users_in_one_month = []
-        for user in simulated_session.users:
-            with unittest.mock.patch(print.__module__ + ".print"):
-                user_in_one_month = _user_in_one_month(copy.deepcopy(user), simulated_session)
+        for user_in_one_month in simulation.materialize().users:
             print(" " * 10 + f" * User {user_in_one_month.full_name} "
                              f"will have status: {user_in_one_month.status}")
             print(" " * 20 + f"User will have savings: €{user_in_one_month.savings_account.savings_amount:.2f} "
                              f"at interest rate {user_in_one_month.savings_account.interest_rate * 100}%")
             if len(user_in_one_month.loans):
-                user_total_in_loans = IOUtils.round_float_to_2_decimal_places(
-                    reduce(lambda a, b: a + b, [loan.sum for loan in user_in_one_month.loans])
-                )
                 print(
-                    " " * 20 + f"User will have total loans {user_total_in_loans}€ "
+                    " " * 20 + f"User will have total loans {user_in_one_month.total_loans}€ "
                                f"(applied corresponding interest rate)")
             else:
                 print(" " * 20 + "User user will have €0 in loans.")
-            users_in_one_month.append(user_in_one_month)
-
-        simulated_session.users = users_in_one_month  # save calculated users to the session
 
-        # Suppress print that may be called in the function not to give out the vulnerability of the system so easily
-        with unittest.mock.patch(print.__module__ + ".print"):
-            money_in_bank = simulated_session.money_in_bank
-        print(" " * 5 + f" * Total amount of money in the bank will be €{money_in_bank:.2f}")
+        print(" " * 5 + f" * Total amount of money in the bank will be €{report.money_in_bank:.2f}")
         print("Done.")
 
 
+def handle_stress_test_action(session: Session):
+    """Function that runs a Monte Carlo stress test of the bank and prints the distribution of money in the bank"""
+    months = IOUtils.input_int("Enter the number of months to simulate (from 1 to 120): ", lower_bound=1,
+                               upper_bound=120)
+    n_scenarios = IOUtils.input_int("Enter the number of scenarios (from 1 to 100000): ", lower_bound=1,
+                                    upper_bound=100_000)
+    print(f"Running {n_scenarios} scenarios with random deposits, withdrawals, loans and defaults...")
+    results = run_stress_test(session, months, n_scenarios)
+
+    IOUtils.print_section("Stress test results")
+    print("Month | Median money in the bank | 5th percentile | Minimum | P(negative) | P(bankrupt so far)")
+    for month in results:
+        print(f"{month.months_ahead:>5} | €{month.median:>23.2f} | €{month.percentile_5:>13.2f} | "
+              f"€{month.minimum:>12.2f} | {month.probability_negative:>11.2%} | {month.probability_bankrupt:.2%}")
+    print("Done.")
+
+
+def policy_variants(policy: Policy) -> Dict[str, Policy]:
+    """The policy and a few what-if variants of it, by name"""
+    return {
+        "Current policy": policy,
+        "6-month loans": dataclasses.replace(policy, loan_term_months=6),
+        "24-month loans": dataclasses.replace(policy, loan_term_months=24),
+        "Savings rates +1%": dataclasses.replace(policy, savings_interest_rate=policy.savings_interest_rate + 0.01,
+                                                 large_savings_interest_rate=policy.large_savings_interest_rate + 0.01),
+    }
+
+
+def handle_compare_policies_action(session: Session):
+    """Function that simulates the bank under the current policy and its variants and prints them side by side"""
+    months = IOUtils.input_int("Enter the number of months to simulate (from 1 to 120): ", lower_bound=1,
+                               upper_bound=120)
+    variants = policy_variants(session.policy)
+    results = compare_policies(session, list(variants.values()), months)
+
+    IOUtils.print_section("Money in the bank")
+    print("Month | " + " | ".join(f"{name:>18}" for name in variants))
+    for month in results:
+        print(f"{month.months_ahead:>5} | " + " | ".join(f"€{money:>17.2f}" for money in month.money_in_bank))
+    IOUtils.print_section("Users that defaulted on their loans (in the grace period)")
+    print("Month | " + " | ".join(f"{name:>18}" for name in variants))
+    for month in results:
+        print(f"{month.months_ahead:>5} | " + " | ".join(
+            f"{f'{locked} ({overdue})':>18}" for locked, overdue in zip(month.locked_users, month.overdue_users)))
+    print("Done.")
+
+
 def handle_month_forward_action(session: Session):
-    print("Going one month ahead...")
+    """Function that moves the bank one month ahead
+
+    Only the users whose status may change are processed one by one: overdue users and active users with loans that
+    expired (see Session.pop_users_with_expiring_loans). The rest of active users, with or without loans, only get
+    interest, which is applied to them in one batch (see Session.accrue_monthly_interest): still a loop over those
+    users, but without the status checks and with the bank totals updated once. The users are looked up in the status
+    indexes of the session, so locked users, who do not change, are not visited at all.
+    """
+    notify = session.notifications.notify
+    notify("Going one month ahead...")
     session.current_time += 1
+    users_with_expiring_loans = session.pop_users_with_expiring_loans()
+    # Listed before any user is processed, as processing moves users between the statuses
+    overdue_users = list(session.iter_users(status=UserStatusSavingEnum.OVERDUE_LOANS))
+    active_users = list(session.iter_users(status=UserStatusSavingEnum.ACTIVE))
+    n_locked_users = session.count_users(UserStatusSavingEnum.LOCKED)
+
+    interest_only_users = []
+    for user in overdue_users:
+        _user_in_one_month(session.get_user(user.username), session)  # copied first if shared with another session
+    for user in active_users:
+        user = session.get_user(user.username)
+        if user.username in users_with_expiring_loans:
+            _user_in_one_month(user, session)
+        else:
+            interest_only_users.append(user)
+    session.accrue_monthly_interest(interest_only_users)
+
+    notify(" " * 10 + " * Interest for loans and savings applied to {} active user(s) without expired loans.",
+           len(interest_only_users))
+    if n_locked_users:
+        notify(" " * 10 + " * {} user(s) are LOCKED. Reason: Overdue unpaid loans.", n_locked_users)
+    notify("Succeeded. Current time is {} month(s).\n", session.current_time)
+
+
+def print_dashboard(session: Session):
+    print("\n" + "-" * 10 + " Administrator dashboard " + "-" * 10)
+    print(f" * The initial amount of the money the bank had €{session.initial_money_in_bank}.")
+    print(f" * The current amount money in the bank is €{session.money_in_bank:.2f}")
+    print(f" * Total amount of user savings in the bank is €{session.total_user_savings:.2f} "
+          f"(including amount they obtained by taking loans).")
+    print(f" * Total amount of user personal savings €{session.total_user_personal_savings:.2f} "
+          f"(excluding amount they obtained by taking loans).")
+    print(f" * Total amount of user loans is €{session.total_user_loans:.2f}.")
+    print(" * The current time is " + str(session.current_time) + " month(s).")
+    print("-" * 10 + " End of your dashboard " + "-" * 10)
 
-    for user in session.users:
-        _user_in_one_month(user, session)
 
-    print("Succeeded. Current time is " + str(session.current_time) + " month(s).\n")
+def handle_reporting_mode(session: ReadOnlySession):
+    """Dashboard and user lists of a snapshot, for analysts; nothing can be changed"""
+    IOUtils.print_header("Welcome to the reporting mode!")
+    while True:
+        print_dashboard(session)
+        print(" * Users by status: " + ", ".join(
+            f"{status.value}: {count}" for status, count in session.status_counts.items()))
+        action = IOUtils.print_menu_and_return_choice(["View users", "Exit"])
+        if action == 1:
+            handle_user_list_action(session)
+        if action == 2:
+            print("Exiting...")
+            return
 
 
 def handle_administration_mode(session: Session):
@@ -168,33 +298,29 @@ def handle_administration_mode(session: Session):
     print("You can view all the users and their details, run simulations and go one month ahead.")
 
     while True:
-        print("\n" + "-" * 10 + " Administrator dashboard " + "-" * 10)
-        print(f" * The initial amount of the money the bank had €{session.initial_money_in_bank}.")
-        print(f" * The current amount money in the bank is €{session.money_in_bank:.2f}")
-        print(f" * Total amount of user savings in the bank is €{session.total_user_savings:.2f} "
-              f"(including amount they obtained by taking loans).")
-        print(f" * Total amount of user personal savings €{session.total_user_personal_savings:.2f} "
-              f"(excluding amount they obtained by taking loans).")
-        print(f" * Total amount of user loans is €{session.total_user_loans:.2f}.")
-        print(" * The current time is " + str(session.current_time) + " month(s).")
-        print("-" * 10 + " End of your dashboard " + "-" * 10)
+        print_dashboard(session)
 
         action = IOUtils.print_menu_and_return_choice(
-            ["View all users", "Run simulation", "Go one month ahead", "Add random customer", "Log out"])
+            ["View all users", "Run simulation", "Run stress test", "Compare policies", "Go one month ahead",
+             "Add random customer", "Log out"])
         if action == 1:
             handle_user_list_action(session)
         if action == 2:
             handle_simulate_action(session)
         if action == 3:
-            handle_month_forward_action(session)
+            handle_stress_test_action(session)
         if action == 4:
+            handle_compare_policies_action(session)
+        if action == 5:
+            handle_month_forward_action(session)
+        if action == 6:
             print("Adding a random customer...")
             try:
-                session.users.append(User.generate_random_user(session))
+                session.add_user(User.generate_random_user(session))
             except ValueError as e:
                 print("Failed to add a random user. Error: " + str(e) + "\n")
                 continue
             print("Done.")
-        if action == 5:
+        if action == 7:
             print("Logging out...")
             return
@@ -0,0 +1,200 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+import admin_panel
+from entities import Session, Loan, UserStatusSavingEnum
+from simulation import simulate
+from utils import SilentSink
+from vectorized_engine import ShardedBank, month_forward_sharded, month_forward_vectorized
+
+POPULATION_SIZES = [1_000, 100_000, 1_000_000]
+THREAD_POOL_SIZES = [1, 2, 4, 8]
+QUICK_POPULATION_SIZES = [1_000]
+
+
+def _seeded_session(n_users: int, seed: int) -> Session:
+    session = Session()
+    session.notifications = SilentSink()
+    session.populate_db(n_users, seed=seed)
+    return session
+
+
+def _measure(name: str, params: dict, run: Callable[[object], Optional[int]], setup: Callable[[], object],
+             repeats: int) -> dict:
+    """Time run(setup()) repeats times; the setup is not timed
+
+    run may return the number of operations it performed, in which case the throughput is reported as well.
+    """
+    result = {"name": name, "params": params, "repeats": repeats}
+    timings = []
+    operations = None
+    try:
+        for _ in range(repeats):
+            state = setup()
+            start = time.perf_counter()
+            operations = run(state)
+            timings.append(time.perf_counter() - start)
+    except Exception as e:  # reported instead of stopping the suite; main exits with an error once all have run
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    result.update({
+        "min_seconds": min(timings),
+        "median_seconds": statistics.median(timings),
+        "mean_seconds": statistics.mean(timings),
+    })
+    if operations:
+        result["operations"] = operations
+        result["operations_per_second"] = operations / statistics.median(timings)
+    return result
+
+
+def _add_loans(session: Session) -> int:
+    operations = 0
+    for user in session.users:
+        if user.status == UserStatusSavingEnum.ACTIVE and len(user.loans) < session.policy.max_loans:
+            try:
+                user.add_loan(session, Loan.create_loan_object(session, 100))
+            except ValueError:  # the bank ran out of money
+                break
+            operations += 1
+    return operations
+
+
+def _withdraw_savings(session: Session) -> int:
+    operations = 0
+    for user in session.users:
+        if user.status == UserStatusSavingEnum.ACTIVE and user.savings_account.savings_cents >= 100:
+            try:
+                user.withdraw_savings(session, 1)
+            except ValueError:  # the bank ran out of money
+                break
+            operations += 1
+    return operations
+
+
+def _concurrent_withdrawals_and_loans(session: Session, workers: int, global_lock: bool = False) -> int:
+    """Withdraw and issue a loan for every active user from a thread pool; every worker changes its own users
+
+    With global_lock every operation holds one lock, as a baseline for the reservations of the session.
+    """
+    lock = threading.Lock() if global_lock else None
+
+    def run(users) -> int:
+        operations = 0
+        for user in users:
+            if user.status != UserStatusSavingEnum.ACTIVE:
+                continue
+            for operation in [lambda: user.withdraw_savings(session, 1),
+                              lambda: user.add_loan(session, Loan.create_loan_object(session, 100))]:
+                try:
+                    if lock is None:
+                        operation()
+                    else:
+                        with lock:
+                            operation()
+                except ValueError:  # the bank ran out of money or the user of savings
+                    continue
+                operations += 1
+        return operations
+
+    users = session.users
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(run, [users[worker::workers] for worker in range(workers)]))
+
+
+def _read_money_in_bank(session: Session, reads: int = 100_000) -> int:
+    for _ in range(reads):
+        session.money_in_bank  # noqa: the property access is what is measured
+    return reads
+
+
+def run_benchmarks(population_sizes: List[int], n_users: int = 500, repeats: int = 5, seed: int = 0) -> Dict:
+    """Run all benchmarks on seeded data and return the results in a JSON-serializable form
+
+    Population is measured for every size in population_sizes (once per size, as it is the slowest benchmark); the
+    other benchmarks run on a seeded bank with n_users users.
+    """
+    results = []
+    for size in population_sizes:
+        results.append(_measure("populate_db", {"n_users": size},
+                                lambda session: session.populate_db(size, seed=seed) or size,
+                                lambda: Session(), repeats=1))
+
+    base = _seeded_session(n_users, seed)
+    # Issue loans a few months later as well, s.t. the month steps include expiring loans and status changes
+    base.current_time = 6
+    _add_loans(base)
+    base.current_time = 12
+
+    def fresh_session() -> Session:
+        return copy.deepcopy(base)
+
+    params = {"n_users": n_users, "seed": seed}
+    results.append(_measure("handle_month_forward_action", params,
+                            lambda session: admin_panel.handle_month_forward_action(session) or n_users,
+                            fresh_session, repeats))
+    results.append(_measure("month_forward_vectorized", params,
+                            lambda session: month_forward_vectorized(session) or n_users, fresh_session, repeats))
+    workers = os.cpu_count() or 1
+    results.append(_measure("month_forward_sharded", {**params, "workers": workers},
+                            lambda session: month_forward_sharded(session, workers) or n_users, fresh_session,
+                            repeats))
+    # A month of a sharded bank that is kept between months; every repeat closes the next month
+    with ShardedBank(fresh_session(), workers) as bank:
+        results.append(_measure("sharded_bank_month_forward", {**params, "workers": workers},
+                                lambda sharded_bank: sharded_bank.month_forward() or n_users, lambda: bank, repeats))
+    results.append(_measure("simulate_30_months", params, lambda session: len(simulate(session, 30)),
+                            fresh_session, repeats))
+    results.append(_measure("money_in_bank", params, _read_money_in_bank, fresh_session, repeats))
+    results.append(_measure("add_loan", params, _add_loans, fresh_session, repeats))
+    results.append(_measure("withdraw_savings", params, _withdraw_savings, fresh_session, repeats))
+    for threads in THREAD_POOL_SIZES:
+        for global_lock in [False, True]:
+            results.append(_measure(
+                "concurrent_withdrawals_and_loans", {**params, "workers": threads, "global_lock": global_lock},
+                lambda session: _concurrent_withdrawals_and_loans(session, threads, global_lock), fresh_session,
+                repeats))
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the bank. Results are written as JSON.")
+    parser.add_argument("--output", help="file to write the results to (default: standard output)")
+    parser.add_argument("--quick", action="store_true",
+                        help=f"populate only {QUICK_POPULATION_SIZES} users instead of {POPULATION_SIZES}")
+    parser.add_argument("--users", type=int, default=500, help="number of users of the other benchmarks")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(QUICK_POPULATION_SIZES if args.quick else POPULATION_SIZES, n_users=args.users,
+                            repeats=args.repeats, seed=args.seed)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    failed = [result["name"] for result in report["results"] if "error" in result]
+    if failed:
+        sys.exit(f"Failed benchmarks: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,551 @@
 import copy
 import enum
+import heapq
+import itertools
 import random
-import unittest.mock
-from typing import List, Optional
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
-from faker import Faker
+from names import NameGenerator
+from policy import DEFAULT_POLICY, Policy
+from utils import MoneyUtils, NotificationSink
 
-from utils import IOUtils
+# Entities that are not registered in a session print their messages
+_DEFAULT_SINK = NotificationSink()
+MAX_USER_DRAWS = 1_000  # random users that may be drawn in a row for Session.populate_db before it gives up
+
+
+def _notifications(session: Optional["Session"]) -> NotificationSink:
+    return session.notifications if session is not None else _DEFAULT_SINK
+
+
+def _policy(session: Optional["Session"]) -> Policy:
+    return session.policy if session is not None else DEFAULT_POLICY
+
+
+def _deepcopy_entity(entity, memo):
+    """Deepcopy an entity without dragging along the session it is registered in
+
+    The link to the session is kept only when the session itself is being copied (i.e. it is already in the memo),
+    so copying a single user gives a detached user, while copying a session gives a consistent copy of the whole bank.
+    """
+    copied = entity.__class__.__new__(entity.__class__)
+    memo[id(entity)] = copied
+    for name in entity.__slots__:
+        value = getattr(entity, name)
+        if name == "_session":
+            setattr(copied, name, memo.get(id(value)))
+        else:
+            setattr(copied, name, copy.deepcopy(value, memo))
+    return copied
 
 
 class Session:
     current_time: int  # current time in months
     users: List["User"]
-    faker: Faker
+    names: NameGenerator  # names of the random users
+    policy: Policy  # rates and limits of the bank
     initial_money_in_bank: float
-
-    def __init__(self):
-        self.users = []
+    check_consistency: bool  # verify running totals against a full recomputation on every access
+    journal: Optional["journal.Journal"]  # log of every change of the users, if the session is journaled
+
+    def __init__(self, check_consistency: bool = False):
+        self.journal = None
+        self._users = []
+        self._users_by_username: Dict[str, "User"] = {}
+        # Usernames of the users by their status, in the order they got the status (dicts are used as ordered sets)
+        self._usernames_by_status: Dict["UserStatusSavingEnum", Dict[str, None]] = {
+            status: {} for status in UserStatusSavingEnum}
+        # Usernames of the users by the month their loans expire in (see Loan.expires_at). A month is removed once it
+        # has been processed, and paid loans are not removed, so a user in a bucket only may have an expired loan.
+        self._expiring_loans: Dict[int, List[str]] = {}
+        self._shared_expiry_months: Set[int] = set()  # months whose buckets are shared with the base of a fork
         self.current_time = 0
-        self.faker = Faker()
+        self.names = NameGenerator()
+        self.policy = DEFAULT_POLICY
         self.initial_money_in_bank = 100_000  # 100 thousand euros
+        self.check_consistency = check_consistency
+        # Where the domain methods report what happened; set to utils.SilentSink to run without output
+        self.notifications = NotificationSink()
+        # Running totals of all registered users. They are updated by the entities themselves on every mutation,
+        # s.t. bank-wide figures are available without scanning every user and every loan.
+        self._total_user_savings_cents = 0
+        self._total_user_loans_cents = 0
+        # Money set aside for withdrawals and loans in progress (see try_reserve). The lock guards the bank-level
+        # fields, so that users can be changed from several threads, as long as every user is changed by one thread
+        # at a time.
+        self._reserved_cents = 0
+        self._lock = threading.Lock()
+        # Number of changes made to the users of this session; used to detect changes of the base session of a fork
+        self._version = 0
+        self._base = None  # session this session was forked from
+        self._base_version = 0
+        self._user_positions = None  # username -> index in the users; kept by forks to copy shared users by username
+        # Storage the session is persisted to (see storage.SQLiteStorage). Users of a stored session are loaded lazily.
+        self.storage = None
+        self._all_users_loaded = True
+
+    def populate_db(self, n_users: int = 10, seed: Optional[int] = None):
+        """Add n_users random users to the session in a single pass
+
+        Each user is checked against the running bank totals, so seeding is linear in the number of users. Users that
+        would make the bank go bankrupt are skipped and drawn again; if MAX_USER_DRAWS users in a row are skipped, the
+        bank can not afford any more users and ValueError is raised. Pass a seed to get a reproducible bank.
+        """
+        rng = random.Random(seed)
+        if seed is not None:
+            self.names.seed(seed)
+        added_users = 0
+        while added_users < n_users:
+            for _ in range(MAX_USER_DRAWS):
+                try:
+                    user = User.generate_random_user(self, rng)
+                    break
+                except ValueError as e:
+                    error = e
+            else:
+                raise ValueError(f"Could not add a random user after {MAX_USER_DRAWS} attempts: {error}")
+            self.add_user(user)
+            added_users += 1
 
-    def populate_db(self):
-        with unittest.mock.patch(print.__module__ + ".print"):
-            for _ in range(10):
-                user = User.generate_random_user(self)
-                self.users.append(user)
+    def save(self, path: str):
+        """Write a snapshot of the whole session to the directory at path, see snapshot.save_snapshot"""
+        from snapshot import save_snapshot
+        save_snapshot(self, path)
+
+    @staticmethod
+    def load(path: str, check_consistency: bool = False) -> "Session":
+        """Open a session from a snapshot written by save. Users are loaded lazily, see snapshot.Snapshot."""
+        from snapshot import Snapshot
+        return Snapshot(path).open_session(check_consistency)
+
+    def _new_name(self) -> Tuple[str, str]:
+        """Draw a full name and a username that is not taken in the session"""
+        while True:
+            full_name, username = self.names.draw()
+            if self._find_user(username) is None:
+                return full_name, username
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def current_time(self) -> int:
+        return self._current_time
+
+    @current_time.setter
+    def current_time(self, value: int):
+        self._current_time = value
+        if self.journal is not None:
+            self.journal.time_changed(value)
+
+    @property
+    def users(self) -> List["User"]:
+        if not self._all_users_loaded:
+            self.storage.load_all_users(self)
+        return self._users
+
+    @users.setter
+    def users(self, users: List["User"]):
+        """Replace all users of the session and rebuild the running totals
+
+        Users shared with the base of a fork (see fork) are copied into the fork, the base keeps its own.
+        """
+        for user in self._users:
+            if user._session is not self:  # still owned by the base of the fork
+                continue
+            if self.journal is not None:
+                self.journal.user_removed(user)
+            user._detach()
+        self._users = [user._fork(self) if self._shares(user) else user for user in users]
+        self._users_by_username = {user.username: user for user in self._users}
+        self._usernames_by_status = {status: {} for status in UserStatusSavingEnum}
+        for user in self._users:
+            self._usernames_by_status[user.status][user.username] = None
+        if self._user_positions is not None:
+            self._index_user_positions()
+        self._expiring_loans = {}
+        self._shared_expiry_months = set()
+        self._total_user_savings_cents = 0
+        self._total_user_loans_cents = 0
+        self._version += 1
+        for user in self._users:
+            user._attach(self)
+            if self.journal is not None:
+                self.journal.user_added(user)
+
+    def add_user(self, user: "User"):
+        """Register the user in the session, s.t. their savings and loans are included into bank totals"""
+        self._users.append(user)
+        self._users_by_username[user.username] = user
+        self._usernames_by_status[user.status][user.username] = None
+        if self._user_positions is not None:
+            self._user_positions[user.username] = len(self._users) - 1
+        self._version += 1
+        user._attach(self)
+        if self.journal is not None:
+            self.journal.user_added(user)
+
+    def remove_user(self, user: "User"):
+        """Remove the user from the session together with their savings and loans"""
+        self._users.remove(user)
+        if self._user_positions is not None:
+            self._index_user_positions()  # the users after the removed one moved
+        del self._users_by_username[user.username]
+        del self._usernames_by_status[user.status][user.username]
+        self._adjust_total_user_savings(-user.savings_account.savings_cents)
+        self._adjust_total_user_loans(-user.total_loans_cents)
+        if user._session is self:  # users shared with the base of a fork stay in the base
+            if self.journal is not None:
+                self.journal.user_removed(user)
+            user._detach()
+
+    def get_user(self, username: str) -> Optional["User"]:
+        """Find the user by username, loading them from the storage if they were not loaded yet
+
+        In a fork, a user shared with the base is copied first (see writable_user), so the returned user can be changed.
+        """
+        user = self._find_user(username)
+        if user is not None and user._session is not self:
+            return self.writable_user(self._user_positions[username])
+        return user
+
+    def _find_user(self, username: str) -> Optional["User"]:
+        user = self._users_by_username.get(username)
+        if user is None and not self._all_users_loaded:
+            return self.storage.load_user(self, username)
+        return user
+
+    def _shares(self, user: "User") -> bool:
+        """Whether the user is owned by one of the sessions this session was forked from"""
+        base = self._base
+        while base is not None:
+            if user._session is base:
+                return True
+            base = base._base
+        return False
+
+    def _add_loaded_user(self, user: "User"):
+        """Add a user loaded from the storage. The running totals loaded from the storage already include them."""
+        self._users.append(user)
+        self._users_by_username[user.username] = user
+        self._usernames_by_status[user.status][user.username] = None
+        user._link_loaded(self)
+
+    def fork(self) -> "Session":
+        """Create a lightweight copy of the session for what-if calculations
+
+        The fork shares the user objects with this session instead of copying them. Forking copies only the list and
+        the indexes of the users, i.e. references to them; a user object is copied into the fork only when the fork is
+        about to change them (see writable_user and get_user). This session must not be changed while its forks are in
+        use; forks detect it and raise RuntimeError.
+        """
+        forked = copy.copy(self)
+        forked._users = list(self.users)
+        forked._all_users_loaded = True  # the users of a stored session were just loaded, the fork has no storage
+        forked._index_user_positions()
+        forked._users_by_username = dict(self._users_by_username)
+        forked._usernames_by_status = {
+            status: dict(usernames) for status, usernames in self._usernames_by_status.items()}
+        forked._expiring_loans = dict(self._expiring_loans)
+        forked._shared_expiry_months = set(self._expiring_loans)
+        forked._version = 0
+        forked._reserved_cents = 0
+        forked.storage = None  # forks are never persisted
+        forked.journal = None
+        forked._base = self
+        forked._base_version = self._version
+        return forked
+
+    def _index_user_positions(self):
+        self._user_positions = {user.username: i for i, user in enumerate(self._users)}
+
+    def writable_user(self, index: int) -> "User":
+        """Return the user at the index, copying them first if they are shared with the session this one was forked
+        from. The returned user can be changed without affecting other sessions."""
+        user = self.users[index]
+        if user._session is not self:
+            self._check_base_unchanged()
+            user = user._fork(self)
+            self._users[index] = user
+            self._users_by_username[user.username] = user
+        return user
+
+    def iter_users(self, status: Optional["UserStatusSavingEnum"] = None, min_total_loans: Optional[float] = None,
+                   loans_expiring_within: Optional[int] = None) -> Iterator["User"]:
+        """Iterate over the users matching all the given filters, one at a time
+
+        Filters: the status, the minimum total of the loans of the user, and loans that expire within the given number
+        of months from the current time. The status and the expiry filters are looked up in the indexes of the
+        session, so only the users they match are visited, in the order they were indexed; without them the users are
+        visited in the order of the session. The session must not be changed while iterating.
+        """
+        if not self._all_users_loaded:  # the indexes include only the loaded users
+            self.storage.load_all_users(self)
+        if loans_expiring_within is not None:
+            months = range(self.current_time + 1, self.current_time + loans_expiring_within + 1)
+            # A user is in a bucket once per loan, and buckets keep paid loans, so the users are checked below
+            usernames = dict.fromkeys(itertools.chain.from_iterable(
+                self._expiring_loans.get(month, []) for month in months))
+            if status is not None:
+                usernames = (username for username in usernames if username in self._usernames_by_status[status])
+            users = (self._users_by_username.get(username) for username in usernames)
+        elif status is not None:
+            users = (self._users_by_username[username] for username in self._usernames_by_status[status])
+        else:
+            users = iter(self.users)
+
+        min_total_loans_cents = None if min_total_loans is None else MoneyUtils.to_cents(min_total_loans)
+        for user in users:
+            if user is None:  # the user was removed
+                continue
+            if min_total_loans_cents is not None and user.total_loans_cents < min_total_loans_cents:
+                continue
+            if loans_expiring_within is not None and not any(
+                    loan.status == LoanStatusEnum.ACTIVE and months.start <= loan.expires_at < months.stop
+                    for loan in user.loans):
+                continue
+            yield user
+
+    def count_users(self, status: "UserStatusSavingEnum") -> int:
+        """Return the number of users with the status, read from the status index without visiting them"""
+        if not self._all_users_loaded:  # the indexes include only the loaded users
+            self.storage.load_all_users(self)
+        return len(self._usernames_by_status[status])
+
+    def list_users(self, page: int = 0, page_size: int = 20, sort_by: Optional[str] = None, descending: bool = False,
+                   **filters) -> List["User"]:
+        """Return a page of the users matching the filters (see iter_users), sorted by one of USER_SORT_KEYS
+
+        Only the users up to the end of the page are kept in memory, so a page of a large bank is cheap as long as it
+        is one of the first ones. Ties are broken by the username, in the same direction.
+
+        Usage example:
+        >>> top_debtors = session.list_users(sort_by="loans", descending=True, page_size=10)
+        >>> overdue_users = session.list_users(status=UserStatusSavingEnum.OVERDUE_LOANS, page=2)
+        """
+        users = self.iter_users(**filters)
+        end = (page + 1) * page_size
+        if sort_by is None:
+            return list(itertools.islice(users, page * page_size, end))
+        sort_key = USER_SORT_KEYS[sort_by]
+        select = heapq.nlargest if descending else heapq.nsmallest
+        return select(end, users, key=lambda user: (sort_key(user), user.username))[page * page_size:]
+
+    def _register_loan_expiry(self, user: "User", loan: "Loan"):
+        month = loan.expires_at
+        with self._lock:
+            usernames = self._expiring_loans.get(month)
+            if usernames is None:
+                self._expiring_loans[month] = [user.username]
+                return
+            if month in self._shared_expiry_months:
+                usernames = list(usernames)
+                self._expiring_loans[month] = usernames
+                self._shared_expiry_months.discard(month)
+            usernames.append(user.username)
+
+    def pop_users_with_expiring_loans(self) -> Set[str]:
+        """Return usernames of the users whose loans expire by the current time and forget about these loans
+
+        Every loan is returned once, in the first call after it expires, so users that are not returned have no loans
+        that expired since the previous call.
+        """
+        usernames = set()
+        for month in [month for month in self._expiring_loans if month <= self.current_time]:
+            usernames.update(self._expiring_loans.pop(month))
+            self._shared_expiry_months.discard(month)
+        return usernames
+
+    def _check_base_unchanged(self):
+        session = self
+        while session._base is not None:
+            if session._base._version != session._base_version:
+                raise RuntimeError("The session was changed after it was forked. Fork it again.")
+            session = session._base
+
+    def _adjust_total_user_savings(self, delta_cents: int):
+        with self._lock:
+            self._total_user_savings_cents += delta_cents
+            self._version += 1
+
+    def _adjust_total_user_loans(self, delta_cents: int):
+        with self._lock:
+            self._total_user_loans_cents += delta_cents
+            self._version += 1
+
+    def _change_savings(self, savings_account: "SavingsAccount", savings_cents: int) -> int:
+        """Set the savings of the account and the running total together (see verify_totals); returns the change"""
+        with self._lock:
+            delta_cents = savings_cents - savings_account._savings_cents
+            savings_account._savings_cents = savings_cents
+            self._total_user_savings_cents += delta_cents
+            self._version += 1
+        return delta_cents
+
+    def _change_loan_sum(self, loan: "Loan", sum_cents: int) -> int:
+        """Set the sum of the loan and the running total together (see verify_totals); returns the change"""
+        with self._lock:
+            delta_cents = sum_cents - loan._sum_cents
+            loan._sum_cents = sum_cents
+            self._total_user_loans_cents += delta_cents
+            self._version += 1
+        return delta_cents
+
+    def _open_loan(self, user: "User", loan: "Loan"):
+        """Add the loan to the user and to the running total together (see verify_totals)"""
+        with self._lock:
+            user.loans.append(loan)
+            loan._session = self
+            self._total_user_loans_cents += loan._sum_cents
+            self._version += 1
+
+    def _user_status_changed(self, user: "User", previous_status: "UserStatusSavingEnum"):
+        with self._lock:
+            del self._usernames_by_status[previous_status][user.username]
+            self._usernames_by_status[user.status][user.username] = None
+            self._version += 1
+        if self.journal is not None:
+            self.journal.status_changed(user)
+
+    def accrue_monthly_interest(self, users: List["User"]):
+        """Apply a month of interest to the loans and savings of the users and adjust their savings interest rates
+
+        This is all that happens in a month to an active user whose loans do not expire (see
+        admin_panel._user_in_one_month). The users are changed in one batch: the bank totals are updated once for all of
+        them, and the journal still gets every change.
+        """
+        journal = self.journal
+        savings_delta_cents = 0
+        loans_delta_cents = 0
+        for user in users:
+            for loan in user.loans:
+                delta_cents = MoneyUtils.with_monthly_interest(loan._sum_cents, loan.interest_rate) - loan._sum_cents
+                if delta_cents:
+                    loan._sum_cents += delta_cents
+                    loans_delta_cents += delta_cents
+                    if journal is not None:
+                        journal.loan_changed(loan, delta_cents)
+            savings_account = user.savings_account
+            delta_cents = MoneyUtils.monthly_interest(savings_account._savings_cents, savings_account._interest_rate)
+            if delta_cents:
+                savings_account._savings_cents += delta_cents
+                savings_delta_cents += delta_cents
+                if journal is not None:
+                    journal.savings_changed(savings_account, delta_cents)
+            savings_account.interest_rate = self.policy.savings_interest_rate_for(savings_account.savings_amount)
+        self._adjust_total_user_savings(savings_delta_cents)
+        self._adjust_total_user_loans(loans_delta_cents)
+
+    def verify_totals(self):
+        """Recompute the bank totals from scratch and compare them with the running totals
+
+        Raises RuntimeError if the running totals went out of sync with the users. Savings and loans are changed
+        together with the totals under the lock of the session, so the check holds while other threads change users
+        (but not while users are added or removed).
+        """
+        users = self.users  # loading the users takes the lock
+        with self._lock:
+            savings_cents = sum([user.savings_account.savings_cents for user in users])
+            loans_cents = sum([user.total_loans_cents for user in users])
+            total_user_savings_cents = self._total_user_savings_cents
+            total_user_loans_cents = self._total_user_loans_cents
+        if savings_cents != total_user_savings_cents:
+            raise RuntimeError(
+                f"Total user savings are out of sync: running total is "
+                f"€{MoneyUtils.to_euros(total_user_savings_cents):.2f}, "
+                f"but users have €{MoneyUtils.to_euros(savings_cents):.2f}")
+        if loans_cents != total_user_loans_cents:
+            raise RuntimeError(
+                f"Total user loans are out of sync: running total is "
+                f"€{MoneyUtils.to_euros(total_user_loans_cents):.2f}, "
+                f"but users have €{MoneyUtils.to_euros(loans_cents):.2f}")
+
+    def try_reserve(self, cents: int) -> Optional["Reservation"]:
+        """Set the money aside for a withdrawal or a loan if the bank has it, or return None if it does not
+
+        The check and the reservation are atomic, and reserved money is not available to other reservations until the
+        reservation is committed, so concurrent withdrawals and loans can not jointly overdraw the bank. Commit the
+        reservation once the balances have been changed (or the operation failed):
+        >>> with session.try_reserve(amount_cents):
+        ...     savings_account.savings_cents -= amount_cents
+        """
+        self._check_base_unchanged()
+        with self._lock:
+            available_cents = MoneyUtils.to_cents(self.initial_money_in_bank) + self._total_user_savings_cents - \
+                self._total_user_loans_cents - self._reserved_cents
+            if available_cents < cents:
+                return None
+            self._reserved_cents += cents
+        return Reservation(self, cents)
+
+    @property
+    def money_in_bank_cents(self) -> int:
+        return MoneyUtils.to_cents(self.initial_money_in_bank) + self.total_user_savings_cents - \
+            self.total_user_loans_cents
 
     @property
     def money_in_bank(self):
-        money_in_bank = IOUtils.round_float_to_2_decimal_places(
-            self.initial_money_in_bank + self.total_user_savings - self.total_user_loans
-        )
+        money_in_bank = MoneyUtils.to_euros(self.money_in_bank_cents)
 
         if money_in_bank < 0:
-            IOUtils.print_header(
-                f"\nCRITICAL: Amount in the bank is {money_in_bank}. Money in the bank cannot be negative. "
-                f"You broke the bank!\n")
+            self.notifications.notify("CRITICAL: Amount in the bank is {}. Money in the bank cannot be negative. "
+                                      "You broke the bank!", money_in_bank)
         return money_in_bank
 
+    @property
+    def total_user_savings_cents(self) -> int:
+        self._check_base_unchanged()
+        if self.check_consistency:
+            self.verify_totals()
+        return self._total_user_savings_cents
+
+    @property
+    def total_user_loans_cents(self) -> int:
+        self._check_base_unchanged()
+        if self.check_consistency:
+            self.verify_totals()
+        return self._total_user_loans_cents
+
     @property
     def total_user_savings(self):
-        return IOUtils.round_float_to_2_decimal_places(
-            sum([user.savings_account.savings_amount for user in self.users]))
+        return MoneyUtils.to_euros(self.total_user_savings_cents)
 
     @property
     def total_user_loans(self):
-        return IOUtils.round_float_to_2_decimal_places(
-            sum([sum([loan.sum for loan in user.loans]) for user in self.users]))
+        return MoneyUtils.to_euros(self.total_user_loans_cents)
 
     @property
     def total_user_personal_savings(self):
-        return IOUtils.round_float_to_2_decimal_places(self.total_user_savings - self.total_user_loans)
+        return MoneyUtils.to_euros(self.total_user_savings_cents - self.total_user_loans_cents)
+
+
+class Reservation:
+    """Money of the bank set aside for a withdrawal or a loan in progress, see Session.try_reserve"""
+    cents: int
+    __slots__ = ("_session", "cents")
+
+    def __init__(self, session: Session, cents: int):
+        self._session = session
+        self.cents = cents
+
+    def commit(self):
+        """Release the reservation; by now the operation has changed the balances or failed"""
+        with self._session._lock:
+            self._session._reserved_cents -= self.cents
+        self.cents = 0
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exception):
+        self.commit()
 
 
 class UserStatusSavingEnum(str, enum.Enum):
@@ -68,62 +562,104 @@ class LoanStatusEnum(str, enum.Enum):
 class Loan:
     """Loan entity
 
+    Rates and limits are set by the policy of the bank (see policy.Policy); by default:
     Is issued for 12 months. After 12 months, the loan is expired.
     Each user may have up to 3 loans.
     Each loan has an interest rate of 10% for loans up to €2000 and 10.5% for loans equal or above €2000.
-    The loan is represented as a float number with max 2 decimal places, and is rounded to the nearest cent if needed.
+    The loan is kept as an integer number of cents (see sum_cents); the amount is rounded to the nearest cent if needed.
     """
-    sum: float
+    sum: float  # in euros
+    sum_cents: int
     initiated_at: int
     interest_rate: float
     status: LoanStatusEnum
+    # Entities are slotted, as a bank may hold millions of them
+    __slots__ = ("_session", "_sum_cents", "initiated_at", "interest_rate", "status")
 
-    def __init__(self, amount: float, initiated_at: int):
+    def __init__(self, amount: float, initiated_at: int, policy: Policy = DEFAULT_POLICY):
         amount = float(amount)  # ensure that amount is float
         if amount <= 0:
             raise ValueError("Loan amount can not be negative or zero")
-        if amount > 10_000:
-            raise ValueError("Bank do not give loans more than €10000")
+        if amount > policy.max_loan_amount:
+            raise ValueError(f"Bank do not give loans more than €{policy.max_loan_amount:.0f}")
 
-        self.sum = IOUtils.round_float_to_2_decimal_places(amount)
+        self._session = None
+        self._sum_cents = MoneyUtils.to_cents(amount)
         self.initiated_at = initiated_at
         # Set fixed loan rate
-        if amount >= 2_000:
-            self.interest_rate = 0.105  # 10.5%
-        else:
-            self.interest_rate = 0.1  # 10%
+        self.interest_rate = policy.loan_interest_rate_for(amount)
         self.status = LoanStatusEnum.ACTIVE
 
+    @property
+    def sum_cents(self) -> int:
+        return self._sum_cents
+
+    @sum_cents.setter
+    def sum_cents(self, value: int):
+        session = self._session
+        if session is None:
+            self._sum_cents = value
+            return
+        # The sum is set before the journal is written, s.t. a failing journal can not leave the totals out of sync
+        delta_cents = session._change_loan_sum(self, value)
+        if session.journal is not None and delta_cents:
+            session.journal.loan_changed(self, delta_cents)
+
+    @property
+    def sum(self) -> float:
+        return MoneyUtils.to_euros(self._sum_cents)
+
+    @sum.setter
+    def sum(self, value: float):
+        self.sum_cents = MoneyUtils.to_cents(value)
+
+    def _attach(self, session: Session):
+        self._session = session
+        session._adjust_total_user_loans(self._sum_cents)
+
+    def _detach(self):
+        if self._session is not None and self._session.journal is not None:
+            self._session.journal.loan_closed(self)
+        self._session = None
+
+    def __deepcopy__(self, memo):
+        return _deepcopy_entity(self, memo)
+
+    @property
+    def expires_at(self) -> int:
+        """Month in which the loan expires"""
+        return self.initiated_at + _policy(self._session).loan_term_months
+
     def is_expired(self, session: Session) -> bool:
         """
-        If a loan is not paid within 12 months after initiating the loan,
+        If a loan is not paid within 12 months (the loan term of the policy) after initiating the loan,
         the savings account will be drained and locked until the loan is
         paid in full.
         """
-        return self.initiated_at + 12 <= session.current_time
+        return self.initiated_at + session.policy.loan_term_months <= session.current_time
 
     def expires_in(self, session: Session) -> int:
         """Returns the number of months until the loan expires"""
-        expires_in = self.initiated_at + 12 - session.current_time
+        expires_in = self.initiated_at + session.policy.loan_term_months - session.current_time
         return expires_in if expires_in > 0 else 0
 
     def apply_interest_rate(self):
         """Applies interest rate to the loan sum"""
-        monthly_interest_rate = self.interest_rate / 12
-        self.sum = IOUtils.round_float_to_2_decimal_places(self.sum * (1 + monthly_interest_rate))
+        self.sum_cents = MoneyUtils.with_monthly_interest(self.sum_cents, self.interest_rate)
 
     def pay(self, amount: float, prefix: str = '') -> LoanStatusEnum:
         """Allow user to pay for a loan and returns the loan status"""
         if not amount > 0:
             raise ValueError("Payment amount can not be negative or zero")
-        self.sum -= amount
+        self.sum_cents -= MoneyUtils.to_cents(amount)
 
-        if self.sum <= 0:
-            self.sum = 0
+        if self.sum_cents <= 0:
+            self.sum_cents = 0
             self.status = LoanStatusEnum.PAID
-            print(prefix + "Loan is paid in full and is closed. Thank you!")
+            _notifications(self._session).notify(prefix + "Loan is paid in full and is closed. Thank you!")
         else:
-            print(prefix + f"Loan is partially paid. Thanks! You still owe €{self.sum:.2f} for this loan")
+            _notifications(self._session).notify(
+                prefix + "Loan is partially paid. Thanks! You still owe €{:.2f} for this loan", self.sum)
         return self.status
 
     def pretty_print_loan(self, session: Session, prefix: str = ""):
@@ -140,7 +676,18 @@ class Loan:
     @staticmethod
     def create_loan_object(session: Session, loan_amount: float):
         """Loan factory method"""
-        return Loan(loan_amount, session.current_time)
+        return Loan(loan_amount, session.current_time, session.policy)
+
+    @staticmethod
+    def restore(sum_cents: int, initiated_at: int, interest_rate: float) -> "Loan":
+        """Rebuild a stored loan as it was, without the checks that apply to a new loan"""
+        loan = Loan.__new__(Loan)
+        loan._session = None
+        loan._sum_cents = sum_cents
+        loan.initiated_at = initiated_at
+        loan.interest_rate = interest_rate
+        loan.status = LoanStatusEnum.ACTIVE if sum_cents > 0 else LoanStatusEnum.PAID
+        return loan
 
     def __repr__(self):
         return f"Loan(sum={self.sum}, initiated_at={self.initiated_at}, interest_rate={self.interest_rate})"
@@ -150,46 +697,98 @@ class Loan:
 
 
 class SavingsAccount:
-    savings_amount: float
+    savings_amount: float  # in euros
+    savings_cents: int
     interest_rate: float
+    __slots__ = ("_session", "_savings_cents", "_interest_rate")
 
     @staticmethod
-    def define_rate_for_amount(amount: float):
+    def define_rate_for_amount(amount: float, policy: Policy = DEFAULT_POLICY):
         """Function that sets interest rate depending on the amount of savings
 
+        With the default policy:
         If the amount of savings is more than €10,000, the interest rate is 5.5%;
         If the amount of savings is less than €10,000, the interest rate is 5%.
         """
-        if amount >= 10_000:
-            return 0.055
-        else:
-            return 0.05
+        return policy.savings_interest_rate_for(amount)
 
-    def __init__(self, savings_amount: float):
+    def __init__(self, savings_amount: float, policy: Policy = DEFAULT_POLICY):
         savings_amount = float(savings_amount)  # ensure that amount is float
-        self.savings_amount = savings_amount
-        self.interest_rate = self.define_rate_for_amount(savings_amount)
+        self._session = None
+        self._savings_cents = MoneyUtils.to_cents(savings_amount)
+        self._interest_rate = self.define_rate_for_amount(savings_amount, policy)
+
+    @property
+    def savings_cents(self) -> int:
+        return self._savings_cents
+
+    @savings_cents.setter
+    def savings_cents(self, value: int):
+        session = self._session
+        if session is None:
+            self._savings_cents = value
+            return
+        # The savings are set before the journal is written, s.t. a failing journal can not leave the totals out of sync
+        delta_cents = session._change_savings(self, value)
+        if session.journal is not None and delta_cents:
+            session.journal.savings_changed(self, delta_cents)
+
+    @property
+    def interest_rate(self) -> float:
+        return self._interest_rate
+
+    @interest_rate.setter
+    def interest_rate(self, value: float):
+        changed = value != self._interest_rate
+        self._interest_rate = value
+        if changed and self._session is not None and self._session.journal is not None:
+            self._session.journal.savings_rate_changed(self)
+
+    @property
+    def savings_amount(self) -> float:
+        return MoneyUtils.to_euros(self._savings_cents)
+
+    @savings_amount.setter
+    def savings_amount(self, value: float):
+        self.savings_cents = MoneyUtils.to_cents(value)
+
+    def _attach(self, session: Session):
+        self._session = session
+        session._adjust_total_user_savings(self._savings_cents)
+
+    def _detach(self):
+        self._session = None
+
+    def __deepcopy__(self, memo):
+        return _deepcopy_entity(self, memo)
+
+    @staticmethod
+    def restore(savings_cents: int, interest_rate: float) -> "SavingsAccount":
+        """Rebuild a stored savings account with the interest rate it had"""
+        savings_account = SavingsAccount(0)
+        savings_account._savings_cents = savings_cents
+        savings_account.interest_rate = interest_rate
+        return savings_account
 
     def add_savings(self, amount: float):
         if amount <= 0:
             raise ValueError("Deposit amount can not be negative or zero")
         if amount > 1_000_000:
             raise ValueError("Deposit amount can not be more than €1 million")
-        self.savings_amount += amount
-        print(f"Deposited €{amount}. Current savings: €{self.savings_amount}")
+        self.savings_cents += MoneyUtils.to_cents(amount)
+        _notifications(self._session).notify("Deposited €{}. Current savings: €{}", amount, self.savings_amount)
 
     def withdraw_savings(self, amount: float):
-        if amount > self.savings_amount:
+        if MoneyUtils.to_cents(amount) > self.savings_cents:
             raise ValueError("Not enough savings to withdraw")
-        self.savings_amount -= amount
-        print(f"Withdrawn €{amount} from savings account. Current savings: ${self.savings_amount}")
+        self.savings_cents -= MoneyUtils.to_cents(amount)
+        _notifications(self._session).notify(
+            "Withdrawn €{} from savings account. Current savings: ${}", amount, self.savings_amount)
 
     def apply_and_adjust_interest_rate(self, session: Session):
         """Function that applies interest rate to the savings amount and adjusts the interest rate after"""
-        monthly_interest_rate = self.interest_rate / 12
-        monthly_interest = IOUtils.round_float_to_2_decimal_places(self.savings_amount * monthly_interest_rate)
-        self.savings_amount = IOUtils.round_float_to_2_decimal_places(self.savings_amount + monthly_interest)
-        self.interest_rate = self.define_rate_for_amount(self.savings_amount)
+        self.savings_cents += MoneyUtils.monthly_interest(self.savings_cents, self.interest_rate)
+        self.interest_rate = self.define_rate_for_amount(self.savings_amount, session.policy)
 
     def __str__(self):
         return f"Savings Account details: savings: €{self.savings_amount:.2f} at interest_rate of {self.interest_rate * 100}%"
@@ -201,51 +800,122 @@ class User:
     loans: List[Loan]
     savings_account: SavingsAccount
     status: UserStatusSavingEnum
+    __slots__ = ("full_name", "username", "loans", "savings_account", "_status", "_session")
 
     def __init__(self, session: Session, loans: Optional[List[Loan]] = None, savings: int = 0):
-        self.full_name = session.faker.unique.first_name() + " " + session.faker.unique.last_name()
-        self.username = self.full_name.lower().replace(" ", "_")
+        self.full_name, self.username = session._new_name()
         self.loans = loans or []
-        self.savings_account = SavingsAccount(savings)
-        self.status = UserStatusSavingEnum.ACTIVE
+        self.savings_account = SavingsAccount(savings, session.policy)
+        self._status = UserStatusSavingEnum.ACTIVE
+        self._session = None  # session the user is registered in, if any
+
+    @property
+    def status(self) -> UserStatusSavingEnum:
+        return self._status
+
+    @status.setter
+    def status(self, value: UserStatusSavingEnum):
+        previous_status = self._status
+        self._status = value
+        if self._session is not None:
+            self._session._user_status_changed(self, previous_status)
+
+    def _attach(self, session: Session):
+        """Link the user, their savings account and loans to the session running totals"""
+        self._session = session
+        self.savings_account._attach(session)
+        for loan in self.loans:
+            loan._attach(session)
+            session._register_loan_expiry(self, loan)
+
+    def _link(self, session: Session):
+        """Link the user to the session without changing its running totals, which must already include the user"""
+        self._session = session
+        self.savings_account._session = session
+        for loan in self.loans:
+            loan._session = session
+
+    def _link_loaded(self, session: Session):
+        """Link a user loaded from a storage; unlike forked users, their loans are not known to the session yet"""
+        self._link(session)
+        for loan in self.loans:
+            session._register_loan_expiry(self, loan)
+
+    def _detach(self):
+        self._session = None
+        self.savings_account._detach()
+        for loan in self.loans:
+            loan._detach()
+
+    def __deepcopy__(self, memo):
+        return _deepcopy_entity(self, memo)
+
+    def _fork(self, session: Session) -> "User":
+        """Copy of the user owned by the forked session. Bank totals of the fork already include the user."""
+        forked = copy.copy(self)
+        forked.savings_account = copy.copy(self.savings_account)
+        forked.loans = [copy.copy(loan) for loan in self.loans]
+        forked._link(session)
+        return forked
+
+    @staticmethod
+    def restore(full_name: str, username: str, savings_account: SavingsAccount, loans: List[Loan],
+                status: UserStatusSavingEnum) -> "User":
+        """Rebuild a stored user. The user is not registered in any session."""
+        user = User.__new__(User)
+        user.full_name = full_name
+        user.username = username
+        user.loans = loans
+        user.savings_account = savings_account
+        user._status = status
+        user._session = None
+        return user
 
     def add_loan(self, session: Session, loan: Loan):
         if self.status == UserStatusSavingEnum.LOCKED:
             raise ValueError("User is locked")
         if self.status == UserStatusSavingEnum.OVERDUE_LOANS:
             raise ValueError("User has unpaid loans")
-        if len(self.loans) >= 3:
-            raise ValueError("User can not have more than 3 loans concurrently")
+        if len(self.loans) >= session.policy.max_loans:
+            raise ValueError(f"User can not have more than {session.policy.max_loans} loans concurrently")
 
-        if session.money_in_bank < loan.sum:
+        reservation = session.try_reserve(loan.sum_cents)
+        if reservation is None:
             raise ValueError(
                 f"Sorry! Bank do not have enough money to issue the loan. You ask for €{loan.sum} but bank has only "
                 f"€{session.money_in_bank}. Please try again later.")
 
-        self.loans.append(loan)
-        self.savings_account.savings_amount = IOUtils.round_float_to_2_decimal_places(
-            self.savings_account.savings_amount + loan.sum
-        )
-        print(f"Loan added successfully. €{loan.sum} were deposited to your savings account. Thank you!")
+        with reservation:
+            if self._session is None:
+                self.loans.append(loan)
+            else:
+                self._session._open_loan(self, loan)
+                self._session._register_loan_expiry(self, loan)
+                if self._session.journal is not None:
+                    self._session.journal.loan_opened(self, loan)
+            self.savings_account.savings_cents += loan.sum_cents
+        session.notifications.notify(
+            "Loan added successfully. €{} were deposited to your savings account. Thank you!", loan.sum)
 
     def pay_loan(self, session: Session, loan: Loan, amount: float, prefix: str = ""):
         """Function that allows user to pay for a loan and removes the loan if it is paid in full
 
         Function will deduct the respective amount from the savings account"""
-        if amount > self.savings_account.savings_amount:
+        amount_cents = MoneyUtils.to_cents(amount)
+        if amount_cents > self.savings_account.savings_cents:
             raise ValueError("Not enough savings to pay for the loan")
         status = loan.pay(amount, prefix=prefix)
-        self.savings_account.savings_amount = IOUtils.round_float_to_2_decimal_places(
-            self.savings_account.savings_amount - amount
-        )
+        self.savings_account.savings_cents -= amount_cents
 
         # Remove loan from the user object if it is paid and keep if is not
         if status == LoanStatusEnum.PAID:
             self.loans.remove(loan)
+            loan._detach()
 
         # Set user status back to active if all overdue loans are paid
         if self.status == UserStatusSavingEnum.OVERDUE_LOANS and self.has_no_overdue_loans(session):
-            print("You have paid out all overdue loans. Your account is set back to ACTIVE. Congratulations!")
+            session.notifications.notify(
+                "You have paid out all overdue loans. Your account is set back to ACTIVE. Congratulations!")
             self.status = UserStatusSavingEnum.ACTIVE
 
     def at_least_one_user_loan_is_overdue(self, session: Session):
@@ -261,20 +931,22 @@ class User:
 
     def rate_adjustment_is_needed(self) -> bool:
         return self.savings_account.interest_rate != \
-            SavingsAccount.define_rate_for_amount(self.savings_account.savings_amount)
+            SavingsAccount.define_rate_for_amount(self.savings_account.savings_amount, _policy(self._session))
 
     def withdraw_savings(self, session: Session, amount: float):
         if self.status == UserStatusSavingEnum.LOCKED:
             raise ValueError("User is locked")
         if self.status == UserStatusSavingEnum.OVERDUE_LOANS:
             raise ValueError("User has unpaid loans")
-        if amount > self.savings_account.savings_amount:
+        if MoneyUtils.to_cents(amount) > self.savings_account.savings_cents:
             raise ValueError("Not enough savings to withdraw")
-        if session.money_in_bank < amount:
+        reservation = session.try_reserve(MoneyUtils.to_cents(amount))
+        if reservation is None:
             raise ValueError(
                 f"Excuse us! You ask us for €{amount} but there are only €{session.money_in_bank} in the bank left. "
                 "Please try again later, deposits money to the bank.")
-        self.savings_account.withdraw_savings(amount)
+        with reservation:
+            self.savings_account.withdraw_savings(amount)
 
     def deposit_savings(self, deposit_amount: float):
         if self.status == UserStatusSavingEnum.LOCKED:
@@ -283,21 +955,27 @@ class User:
 
     @property
     def personal_savings_amount(self):
-        return self.savings_account.savings_amount - self.total_loans
+        return MoneyUtils.to_euros(self.savings_account.savings_cents - self.total_loans_cents)
+
+    @property
+    def total_loans_cents(self) -> int:
+        return sum([loan.sum_cents for loan in self.loans])
 
     @property
     def total_loans(self):
-        return IOUtils.round_float_to_2_decimal_places(sum([loan.sum for loan in self.loans]))
+        return MoneyUtils.to_euros(self.total_loans_cents)
 
     @staticmethod
-    def generate_random_user(session: Session):
-        """Function that generates a random user with random loans and savings amount"""
-        loans = [Loan.create_loan_object(session, random.randint(0, 10_000)) for _ in
-                 range(random.randint(0, 3))]
-        user = User(session=session, loans=loans, savings=random.randint(0, 30_000))
-        fake_session = copy.deepcopy(session)
-        fake_session.users.append(user)
-        if fake_session.money_in_bank < 0:
+    def generate_random_user(session: Session, rng: random.Random = random):
+        """Function that generates a random user with random loans and savings amount
+
+        The user is not added to the session. Raises ValueError if adding the user would leave the bank without money.
+        """
+        loans = [Loan.create_loan_object(session, rng.randint(1, int(session.policy.max_loan_amount))) for _ in
+                 range(rng.randint(0, session.policy.max_loans))]
+        user = User(session=session, loans=loans, savings=rng.randint(0, 30_000))
+        # Adding the user changes the bank balance only by their savings minus their loans
+        if session.money_in_bank_cents + user.savings_account.savings_cents - user.total_loans_cents < 0:
             raise ValueError("Random user can not be generated, otherwise bank will not have money left.")
 
         return user
@@ -305,3 +983,12 @@ class User:
     def __repr__(self):
         return f"User(username={self.username}, full_name={self.full_name}, loans={self.loans}, " \
                f"{self.savings_account}, status={self.status})"
+
+
+# Sort keys of Session.list_users
+USER_SORT_KEYS: Dict[str, Callable[[User], object]] = {
+    "username": lambda user: user.username,
+    "full_name": lambda user: user.full_name,
+    "savings": lambda user: user.savings_account.savings_cents,
+    "loans": lambda user: user.total_loans_cents,
+}
@@ -0,0 +1,248 @@
+import enum
+import struct
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+from entities import Session, User, Loan, SavingsAccount, LoanStatusEnum, UserStatusSavingEnum
+
+MAGIC = b"BANKJ01\n"
+
+STATUS_CODES = {status: code for code, status in enumerate(UserStatusSavingEnum)}
+STATUSES = {code: status for status, code in STATUS_CODES.items()}
+
+
+class EventType(enum.IntEnum):
+    USER_ADDED = 1
+    USER_REMOVED = 2
+    STATUS_CHANGED = 3
+    SAVINGS_CHANGED = 4
+    SAVINGS_RATE_CHANGED = 5
+    LOAN_OPENED = 6
+    LOAN_CHANGED = 7
+    LOAN_CLOSED = 8
+    TIME_CHANGED = 9
+
+
+# Fixed part of every record after the event type. Users and loans are referred to by the numbers the journal gave
+# them; USER_ADDED is followed by the username and the full name, each prefixed with its length ("<H").
+FORMATS = {
+    EventType.USER_ADDED: struct.Struct("<IqdB"),  # user, savings in cents, savings interest rate, status
+    EventType.USER_REMOVED: struct.Struct("<I"),  # user
+    EventType.STATUS_CHANGED: struct.Struct("<IB"),  # user, status
+    EventType.SAVINGS_CHANGED: struct.Struct("<Iq"),  # user, change of the savings in cents
+    EventType.SAVINGS_RATE_CHANGED: struct.Struct("<Id"),  # user, new savings interest rate
+    EventType.LOAN_OPENED: struct.Struct("<IIqid"),  # user, loan, sum in cents, initiated at, interest rate
+    EventType.LOAN_CHANGED: struct.Struct("<Iq"),  # loan, change of the sum in cents
+    EventType.LOAN_CLOSED: struct.Struct("<I"),  # loan
+    EventType.TIME_CHANGED: struct.Struct("<i"),  # current time
+}
+_EVENT_TYPE = struct.Struct("<B")
+_LENGTH = struct.Struct("<H")
+
+
+def _numbered_users(session: Session) -> List[User]:
+    """Users of the session in the order they are numbered when a journal starts"""
+    return sorted(session.users, key=lambda user: user.username)
+
+
+def _encode(text: str) -> bytes:
+    data = text.encode()
+    return _LENGTH.pack(len(data)) + data
+
+
+class Journal:
+    """Append-only binary log of every change of the users, their savings and loans, and of the time of a session
+
+    The journal is written by the entities themselves: the same hooks that keep the bank totals up to date append an
+    event to the journal of the session. Together with a snapshot of the session taken when the journal was attached
+    (e.g. with storage.SQLiteStorage), the journal is enough to rebuild the session (see replay). Events are written
+    to the file at the end of every month (when the time of the session changes) and when the journal is closed.
+
+    Usage example:
+    >>> storage.save(session)  # snapshot
+    >>> journal = Journal("bank.journal")
+    >>> journal.attach(session)
+    >>> session.get_user("john_doe").deposit_savings(100)  # journaled
+    >>> journal.close()
+    """
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file: BinaryIO = open(path, "wb")
+        self._file.write(MAGIC)
+        # Numbers of the journaled objects: id(object) -> (number, object)
+        self._users: Dict[int, Tuple[int, User]] = {}
+        self._accounts: Dict[int, Tuple[int, SavingsAccount]] = {}
+        self._loans: Dict[int, Tuple[int, Loan]] = {}
+        self._next_user = 0
+        self._next_loan = 0
+        self._session = None
+
+    def attach(self, session: Session):
+        """Start journaling the session. The session must be in the state of the snapshot the journal will be
+        replayed on."""
+        for user in _numbered_users(session):
+            self._number_user(user)
+            for loan in user.loans:
+                self._number_loan(loan)
+        session.journal = self
+        self._session = session
+
+    def detach(self):
+        """Stop journaling the session and write the events so far to the file"""
+        if self._session is not None and self._session.journal is self:
+            self._session.journal = None
+        self._session = None
+        self.flush()
+
+    def __deepcopy__(self, memo):
+        # Copies of a session are not journaled
+        return None
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.detach()
+            self._file.close()
+
+    def _write(self, event_type: EventType, *fields):
+        if self._file.closed:
+            raise RuntimeError(f"The journal {self.path} is closed")
+        self._file.write(_EVENT_TYPE.pack(event_type) + FORMATS[event_type].pack(*fields))
+
+    def _number_user(self, user: User) -> int:
+        number = self._next_user
+        self._next_user += 1
+        self._users[id(user)] = (number, user)
+        self._accounts[id(user.savings_account)] = (number, user.savings_account)
+        return number
+
+    def _number_loan(self, loan: Loan) -> int:
+        number = self._next_loan
+        self._next_loan += 1
+        self._loans[id(loan)] = (number, loan)
+        return number
+
+    def user_added(self, user: User):
+        self._write(EventType.USER_ADDED, self._number_user(user), user.savings_account.savings_cents,
+                    user.savings_account.interest_rate, STATUS_CODES[user.status])
+        self._file.write(_encode(user.username) + _encode(user.full_name))
+        for loan in user.loans:
+            self.loan_opened(user, loan)
+
+    def user_removed(self, user: User):
+        number, _ = self._users.pop(id(user))
+        del self._accounts[id(user.savings_account)]
+        for loan in user.loans:
+            self._loans.pop(id(loan), None)
+        self._write(EventType.USER_REMOVED, number)
+
+    def status_changed(self, user: User):
+        self._write(EventType.STATUS_CHANGED, self._users[id(user)][0], STATUS_CODES[user.status])
+
+    def savings_changed(self, savings_account: SavingsAccount, delta_cents: int):
+        self._write(EventType.SAVINGS_CHANGED, self._accounts[id(savings_account)][0], delta_cents)
+
+    def savings_rate_changed(self, savings_account: SavingsAccount):
+        self._write(EventType.SAVINGS_RATE_CHANGED, self._accounts[id(savings_account)][0],
+                    savings_account.interest_rate)
+
+    def loan_opened(self, user: User, loan: Loan):
+        self._write(EventType.LOAN_OPENED, self._users[id(user)][0], self._number_loan(loan), loan.sum_cents,
+                    loan.initiated_at, loan.interest_rate)
+
+    def loan_changed(self, loan: Loan, delta_cents: int):
+        self._write(EventType.LOAN_CHANGED, self._loans[id(loan)][0], delta_cents)
+
+    def loan_closed(self, loan: Loan):
+        # Loans of a removed user are closed together with the user
+        numbered = self._loans.pop(id(loan), None)
+        if numbered is not None:
+            self._write(EventType.LOAN_CLOSED, numbered[0])
+
+    def time_changed(self, current_time: int):
+        self._write(EventType.TIME_CHANGED, current_time)
+        self.flush()
+
+
+def read_journal(path: str) -> Iterator[Tuple[EventType, tuple]]:
+    """Iterate over the events of the journal, e.g. for an audit
+
+    Every event is the event type and its fields (see FORMATS); the fields of USER_ADDED end with the username and the
+    full name. A record that was cut off by a crash ends the journal.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a journal")
+    offset = len(MAGIC)
+    while offset < len(data):
+        event_type = EventType(data[offset])
+        record = FORMATS[event_type]
+        if offset + 1 + record.size > len(data):
+            return
+        fields = record.unpack_from(data, offset + 1)
+        offset += 1 + record.size
+        if event_type == EventType.USER_ADDED:
+            texts = []
+            for _ in range(2):
+                if offset + _LENGTH.size > len(data):
+                    return
+                length, = _LENGTH.unpack_from(data, offset)
+                offset += _LENGTH.size
+                if offset + length > len(data):
+                    return
+                texts.append(data[offset:offset + length].decode())
+                offset += length
+            fields += tuple(texts)
+        yield event_type, fields
+
+
+def replay(session: Session, path: str) -> Session:
+    """Apply the journal to the snapshot the journal was started from and return the rebuilt session
+
+    The snapshot session is changed in place. Events are applied as they were recorded, without checking the rules of
+    the bank again.
+    """
+    users: Dict[int, User] = {}
+    loans: Dict[int, Tuple[Loan, User]] = {}
+    for user in _numbered_users(session):
+        users[len(users)] = user
+        for loan in user.loans:
+            loans[len(loans)] = (loan, user)
+
+    for event_type, fields in read_journal(path):
+        if event_type == EventType.USER_ADDED:
+            number, savings_cents, interest_rate, status, username, full_name = fields
+            user = User.restore(full_name, username, SavingsAccount.restore(savings_cents, interest_rate), [],
+                                STATUSES[status])
+            session.add_user(user)
+            users[number] = user
+        elif event_type == EventType.USER_REMOVED:
+            session.remove_user(users.pop(fields[0]))
+        elif event_type == EventType.STATUS_CHANGED:
+            users[fields[0]].status = STATUSES[fields[1]]
+        elif event_type == EventType.SAVINGS_CHANGED:
+            users[fields[0]].savings_account.savings_cents += fields[1]
+        elif event_type == EventType.SAVINGS_RATE_CHANGED:
+            users[fields[0]].savings_account.interest_rate = fields[1]
+        elif event_type == EventType.LOAN_OPENED:
+            user_number, loan_number, sum_cents, initiated_at, interest_rate = fields
+            user = users[user_number]
+            loan = Loan.restore(sum_cents, initiated_at, interest_rate)
+            user.loans.append(loan)
+            loan._attach(session)
+            session._register_loan_expiry(user, loan)
+            loans[loan_number] = (loan, user)
+        elif event_type == EventType.LOAN_CHANGED:
+            loans[fields[0]][0].sum_cents += fields[1]
+        elif event_type == EventType.LOAN_CLOSED:
+            loan, user = loans.pop(fields[0])
+            loan.status = LoanStatusEnum.PAID
+            user.loans.remove(loan)
+            loan._detach()
+        elif event_type == EventType.TIME_CHANGED:
+            session.current_time = fields[0]
+    return session
@@ -1,11 +1,36 @@
-from admin_panel import handle_administration_mode
+import argparse
+import multiprocessing
+
+from admin_panel import handle_administration_mode, handle_reporting_mode
 from entities import Session
+from snapshot import ReadOnlySession
+from storage import SQLiteStorage
 from user_panel import handle_user_mode
 from utils import IOUtils
 
 if __name__ == "__main__":
-    session = Session()  # instantiate the session
-    session.populate_db()
+    multiprocessing.freeze_support()  # the stress test uses worker processes, which must work in executables too
+    parser = argparse.ArgumentParser(description="Banks, Loans and Simulations")
+    parser.add_argument("--db", help="SQLite database to keep the bank in. A new database is populated with demo data.")
+    parser.add_argument("--report", metavar="SNAPSHOT", help="only view the dashboard and the users of a snapshot "
+                                                             "saved with Session.save")
+    args = parser.parse_args()
+
+    if args.report:
+        handle_reporting_mode(ReadOnlySession(args.report))
+        raise SystemExit
+
+    storage = None
+    if args.db:
+        storage = SQLiteStorage(args.db)
+        new_database = storage.is_empty()
+        session = storage.open_session()
+        if new_database:
+            session.populate_db()
+            storage.save(session)
+    else:
+        session = Session()  # instantiate the session
+        session.populate_db()
 
     while True:
         IOUtils.print_header("Welcome to the bank!")
@@ -15,6 +40,8 @@ if __name__ == "__main__":
             handle_user_mode(session)
         if mode == 2:
             handle_administration_mode(session)
+        if storage is not None:
+            storage.save(session)  # persist everything that was done in the mode in one transaction
         if mode == 3:
             print("Exiting the program...")
             break
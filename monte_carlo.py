@@ -0,0 +1,168 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+from entities import Session
+from policy import Policy
+from utils import MoneyUtils
+from vectorized_engine import BankColumns, ACTIVE, LOCKED
+
+
+@dataclass
+class CustomerBehaviour:
+    """Distributions that drive what customers do during a simulated month
+
+    Probabilities are per user per month. Amounts of deposits and new loans are exponentially distributed with the
+    given means (and clipped to the limits of the bank); a withdrawal takes a uniformly distributed share of the
+    savings up to max_withdrawal_share. A defaulting user tries to withdraw all their savings and never deposits,
+    withdraws or borrows again, so their loans end up overdue.
+    """
+    deposit_probability: float = 0.3
+    deposit_mean: float = 500
+    withdrawal_probability: float = 0.2
+    max_withdrawal_share: float = 0.3
+    loan_probability: float = 0.05
+    loan_mean: float = 3_000
+    default_probability: float = 0.005
+
+
+@dataclass
+class StressTestMonth:
+    """Distribution of the money in the bank over all scenarios after a simulated month"""
+    months_ahead: int
+    mean: float
+    minimum: float
+    percentile_5: float
+    median: float
+    percentile_95: float
+    probability_negative: float  # share of scenarios where the bank has negative balance in this month
+    probability_bankrupt: float  # share of scenarios where the bank had negative balance in this or any earlier month
+
+
+def _money_in_bank_cents(columns: BankColumns, initial_money_in_bank_cents: int) -> int:
+    return initial_money_in_bank_cents + int(columns.savings_cents.sum()) - \
+        int(columns.loan_sum_cents[columns.loan_present].sum())
+
+
+def _random_cents(amounts: np.ndarray, low: float, high: float) -> np.ndarray:
+    """Clip the amounts in euros to the limits and convert them to whole cents"""
+    return np.rint(np.clip(amounts, low, high) * 100).astype(np.int64)
+
+
+def _add_loans(columns: BankColumns, borrowers: np.ndarray, amounts_cents: np.ndarray, policy: Policy):
+    """Append a loan to each borrower (see User.add_loan) after their existing loans"""
+    rows = np.flatnonzero(borrowers)
+    if not len(rows):
+        return
+    # Move the loans of the borrowers to the first slots, keeping their order, s.t. the new loan goes after the last one
+    order = np.argsort(~columns.loan_present[rows], axis=1, kind="stable")
+    for name in ["loan_sum_cents", "loan_interest_rate", "loan_initiated_at", "loan_present"]:
+        column = getattr(columns, name)
+        column[rows] = np.take_along_axis(column[rows], order, axis=1)
+    slots = columns.loan_present[rows].sum(axis=1)
+    amounts_cents = amounts_cents[rows]
+    columns.loan_sum_cents[rows, slots] = amounts_cents
+    large = amounts_cents >= MoneyUtils.to_cents(policy.large_loan_threshold)
+    columns.loan_interest_rate[rows, slots] = np.where(large, policy.large_loan_interest_rate, policy.loan_interest_rate)
+    columns.loan_initiated_at[rows, slots] = columns.current_time
+    columns.loan_present[rows, slots] = True
+    columns.savings_cents[rows] += amounts_cents
+
+
+def _customers_in_one_month(columns: BankColumns, behaviour: CustomerBehaviour, rng: np.random.Generator,
+                            initial_money_in_bank_cents: int, defaulted: np.ndarray, policy: Policy):
+    """Apply random customer actions of one month with the same validation rules as the user panel
+
+    Withdrawals are served in random order while the bank has enough money; once a withdrawal is refused,
+    the rest of the month's withdrawals are refused as well.
+    """
+    n_users = len(columns.savings_cents)
+    status = columns.status
+    savings_cents = columns.savings_cents
+
+    depositing = (status != LOCKED) & ~defaulted & (rng.random(n_users) < behaviour.deposit_probability)
+    deposits = _random_cents(rng.exponential(behaviour.deposit_mean, n_users), 1, 1_000_000)
+    savings_cents[depositing] += deposits[depositing]
+
+    active = (status == ACTIVE) & ~defaulted
+    new_defaults = active & (rng.random(n_users) < behaviour.default_probability)
+    defaulted |= new_defaults
+    active &= ~new_defaults
+
+    withdrawing = active & (rng.random(n_users) < behaviour.withdrawal_probability)
+    withdrawals = np.rint(savings_cents * rng.uniform(0, behaviour.max_withdrawal_share, n_users)).astype(np.int64)
+    withdrawals[new_defaults] = savings_cents[new_defaults]
+    requests = rng.permutation(np.flatnonzero((withdrawing | new_defaults) & (withdrawals > 0)))
+    money_in_bank_cents = _money_in_bank_cents(columns, initial_money_in_bank_cents)
+    served = requests[money_in_bank_cents - np.cumsum(withdrawals[requests]) >= 0]
+    savings_cents[served] -= withdrawals[served]
+
+    # A loan does not change the money in the bank, but the bank must have enough money to issue it
+    money_in_bank_cents = _money_in_bank_cents(columns, initial_money_in_bank_cents)
+    loans = _random_cents(rng.exponential(behaviour.loan_mean, n_users), 1, policy.max_loan_amount)
+    borrowing = active & (rng.random(n_users) < behaviour.loan_probability) & \
+        (columns.loan_present.sum(axis=1) < policy.max_loans) & (loans <= money_in_bank_cents)
+    _add_loans(columns, borrowing, loans, policy)
+
+
+def _run_scenarios(base: BankColumns, initial_money_in_bank_cents: int, months: int, behaviour: CustomerBehaviour,
+                   seeds: List[np.random.SeedSequence], policy: Policy) -> np.ndarray:
+    """Run a chunk of scenarios and return the money in the bank in euros per scenario (rows) and month (columns)"""
+    money_in_bank_cents = np.empty((len(seeds), months), dtype=np.int64)
+    for scenario, seed in enumerate(seeds):
+        rng = np.random.default_rng(seed)
+        columns = base.detached_copy()
+        defaulted = np.zeros(len(columns.savings_cents), dtype=bool)
+        for month in range(months):
+            _customers_in_one_month(columns, behaviour, rng, initial_money_in_bank_cents, defaulted, policy)
+            columns.step()
+            money_in_bank_cents[scenario, month] = _money_in_bank_cents(columns, initial_money_in_bank_cents)
+    return money_in_bank_cents / 100
+
+
+def run_stress_test(session: Session, months: int, n_scenarios: int = 1_000,
+                    behaviour: Optional[CustomerBehaviour] = None, seed: Optional[int] = None,
+                    workers: Optional[int] = None) -> List[StressTestMonth]:
+    """Monte Carlo stress test of the bank under random customer behaviour
+
+    Every scenario starts from the current state of the session, which is not mutated. Scenarios are distributed over
+    a pool of worker processes (one per CPU by default; workers=1 runs them in the current process). Each scenario has
+    its own random stream derived from the seed, so the results do not depend on the number of workers.
+    """
+    behaviour = behaviour or CustomerBehaviour()
+    workers = workers or os.cpu_count() or 1
+    # Leave room for the most loans a user may have, as new loans are issued during the scenarios
+    base = BankColumns.from_session(session).detached_copy(n_slots=session.policy.max_loans)
+    seeds = np.random.SeedSequence(seed).spawn(n_scenarios)
+    initial_money_in_bank_cents = MoneyUtils.to_cents(session.initial_money_in_bank)
+    chunks = [chunk.tolist() for chunk in np.array_split(np.array(seeds, dtype=object), min(workers, n_scenarios))]
+
+    if workers == 1:
+        results = [_run_scenarios(base, initial_money_in_bank_cents, months, behaviour, chunk, session.policy)
+                   for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_scenarios, base, initial_money_in_bank_cents, months, behaviour, chunk,
+                                       session.policy) for chunk in chunks]
+            results = [future.result() for future in futures]
+    money_in_bank = np.concatenate(results)
+
+    negative = money_in_bank < 0
+    bankrupt = np.logical_or.accumulate(negative, axis=1)
+    percentiles = np.percentile(money_in_bank, [5, 50, 95], axis=0)
+    return [
+        StressTestMonth(
+            months_ahead=month + 1,
+            mean=round(float(money_in_bank[:, month].mean()), 2),
+            minimum=float(money_in_bank[:, month].min()),
+            percentile_5=round(float(percentiles[0, month]), 2),
+            median=round(float(percentiles[1, month]), 2),
+            percentile_95=round(float(percentiles[2, month]), 2),
+            probability_negative=float(negative[:, month].mean()),
+            probability_bankrupt=float(bankrupt[:, month].mean()),
+        )
+        for month in range(months)
+    ]
@@ -0,0 +1,33 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Policy:
+    """Rates and limits of the bank
+
+    A session applies its policy (see Session.policy) to new loans, to the savings interest rates and to the term of
+    the loans. The policy of a session must be set before any loans are added to it. Use dataclasses.replace to make a
+    variant, e.g. for simulation.compare_policies:
+    >>> shorter_loans = dataclasses.replace(DEFAULT_POLICY, loan_term_months=6)
+    """
+    loan_interest_rate: float = 0.1  # 10%
+    large_loan_interest_rate: float = 0.105  # 10.5% for loans of at least large_loan_threshold
+    large_loan_threshold: float = 2_000
+    savings_interest_rate: float = 0.05  # 5%
+    large_savings_interest_rate: float = 0.055  # 5.5% for savings of at least large_savings_threshold
+    large_savings_threshold: float = 10_000
+    loan_term_months: int = 12  # a loan that is not paid in this many months is expired
+    max_loans: int = 3  # loans a user may have concurrently
+    max_loan_amount: float = 10_000
+
+    def loan_interest_rate_for(self, amount: float) -> float:
+        """Fixed interest rate of a new loan of the amount"""
+        return self.large_loan_interest_rate if amount >= self.large_loan_threshold else self.loan_interest_rate
+
+    def savings_interest_rate_for(self, amount: float) -> float:
+        """Interest rate for the amount of savings"""
+        return self.large_savings_interest_rate if amount >= self.large_savings_threshold \
+            else self.savings_interest_rate
+
+
+DEFAULT_POLICY = Policy()
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import weakref
+from dataclasses import dataclass
+from typing import List, Optional
+
+from admin_panel import handle_month_forward_action
+from entities import Session, User
+from storage import SQLiteStorage
+from transactions import TransactionActionEnum, execute, parse_transaction
+from utils import SilentSink
+
+
+def _user_details(user: User) -> dict:
+    return {
+        "username": user.username,
+        "full_name": user.full_name,
+        "status": user.status.value,
+        "savings": user.savings_account.savings_amount,
+        "savings_interest_rate": user.savings_account.interest_rate,
+        "personal_savings": user.personal_savings_amount,
+        "loans": [{"sum": loan.sum, "initiated_at": loan.initiated_at, "interest_rate": loan.interest_rate}
+                  for loan in user.loans],
+    }
+
+
+class BankServer:
+    """Local server of the bank for many concurrent clients, speaking JSON lines over TCP or a Unix socket
+
+    Every request is a JSON object on its own line with the operation in "op" and an optional "id" that is copied to
+    the response. The response is {"id": ..., "ok": true, "result": ...} or {"id": ..., "ok": false, "error": ...}.
+
+    User operations: deposit, withdraw, take_a_loan and pay_a_loan (with "user", "amount" and, for payments,
+    optionally "loan"), applied with the rules of the user panel (see transactions.execute), and "user" for the
+    dashboard of a user. Administrator operations: "bank" for the dashboard, "users" for the list of users (with
+    optional "offset" and "limit"), "month_forward" and "add_random_customer".
+
+    Operations run on the event loop thread. Withdrawals and loans reserve their amount from the money in the bank
+    (see Session.try_reserve), so concurrent requests can not jointly overdraw the bank. Requests of a user are applied
+    one at a time and in order under a per-user lock; as transactions.execute is synchronous, with no await inside, the
+    locks are currently never contended and only guard against a future await in a transaction. A lock lives only while
+    a request of its user holds it, so usernames sent by clients do not pile up.
+
+    Usage example:
+    >>> server = BankServer(session)
+    >>> await server.start(port=8765)
+    >>> await server.serve_forever()
+    """
+    session: Session
+    operations: int  # number of requests that were handled
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.session.notifications = SilentSink()
+        self.operations = 0
+        self._user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, path: Optional[str] = None):
+        """Start listening on the TCP port (0 picks a free one, see address) or, if the path is given, on a Unix
+        socket"""
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle_client, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle_client, host=host, port=port)
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get("id")
+                    response = {"id": request_id, "ok": True, "result": await self.handle(request)}
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    response = {"id": request_id, "ok": False, "error": str(e)}
+                self.operations += 1
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _lock(self, username: str) -> asyncio.Lock:
+        lock = self._user_locks.get(username)
+        if lock is None:
+            lock = self._user_locks[username] = asyncio.Lock()
+        return lock
+
+    async def handle(self, request: dict):
+        """Apply a request and return its result. Raises ValueError if the request is rejected."""
+        operation = request["op"]
+        if operation in {action.value for action in TransactionActionEnum}:
+            transaction = parse_transaction({**request, "action": operation})
+            async with self._lock(transaction.username):
+                execute(self.session, transaction)
+                return _user_details(self.session.get_user(transaction.username))
+        if operation == "user":
+            user = self.session.get_user(request["user"])
+            if user is None:
+                raise ValueError(f"There is no user with username '{request['user']}'")
+            return _user_details(user)
+        if operation == "bank":
+            return {
+                "money_in_bank": self.session.money_in_bank,
+                "initial_money_in_bank": self.session.initial_money_in_bank,
+                "total_user_savings": self.session.total_user_savings,
+                "total_user_personal_savings": self.session.total_user_personal_savings,
+                "total_user_loans": self.session.total_user_loans,
+                "current_time": self.session.current_time,
+            }
+        if operation == "users":
+            offset = int(request.get("offset", 0))
+            limit = int(request.get("limit", 100))
+            return [_user_details(user) for user in self.session.users[offset:offset + limit]]
+        if operation == "month_forward":
+            handle_month_forward_action(self.session)
+            return {"current_time": self.session.current_time}
+        if operation == "add_random_customer":
+            user = User.generate_random_user(self.session)
+            self.session.add_user(user)
+            return _user_details(user)
+        raise ValueError(f"Unknown operation '{operation}'")
+
+
+@dataclass
+class LoadReport:
+    clients: int
+    requests: int
+    rejected: int
+    seconds: float
+
+    @property
+    def operations_per_second(self) -> float:
+        return self.requests / self.seconds if self.seconds else 0.0
+
+
+async def _client(host: str, port: int, usernames: List[str], n_requests: int, rng: random.Random) -> int:
+    """Send random customer requests one after another and return the number of rejected ones"""
+    reader, writer = await asyncio.open_connection(host, port)
+    rejected = 0
+    try:
+        for request_id in range(n_requests):
+            operation = rng.choice(["deposit", "withdraw", "take_a_loan", "pay_a_loan", "user"])
+            request = {"id": request_id, "op": operation, "user": rng.choice(usernames),
+                       "amount": rng.choice([1, 10, 100, 1_000])}
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            if not json.loads(await reader.readline())["ok"]:
+                rejected += 1
+    finally:
+        writer.close()
+    return rejected
+
+
+async def run_load(host: str, port: int, clients: int, requests_per_client: int = 100,
+                   seed: Optional[int] = None) -> LoadReport:
+    """Load generator: the clients connect at once and each sends random customer requests, waiting for every response
+    before sending the next request"""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(json.dumps({"op": "users", "limit": 1_000_000}).encode() + b"\n")
+    await writer.drain()
+    usernames = [user["username"] for user in json.loads(await reader.readline())["result"]]
+    writer.close()
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    rejected = await asyncio.gather(*[
+        _client(host, port, usernames, requests_per_client, random.Random(rng.random())) for _ in range(clients)])
+    return LoadReport(clients=clients, requests=clients * requests_per_client, rejected=sum(rejected),
+                      seconds=time.perf_counter() - start)
+
+
+async def _serve(args):
+    storage = None
+    if args.db:
+        storage = SQLiteStorage(args.db)
+        session = storage.open_session()
+    else:
+        session = Session()
+        session.populate_db(args.users, seed=args.seed)
+    server = BankServer(session)
+    await server.start(host=args.host, port=args.port, path=args.socket)
+    print(f"Serving the bank on {args.socket or server.address}. Press Ctrl+C to stop.")
+    try:
+        await server.serve_forever()
+    finally:
+        if storage is not None:
+            storage.save(session)
+            storage.close()
+
+
+async def _load(args):
+    print("Clients | Requests | Rejected | Seconds | Requests per second")
+    for clients in args.clients:
+        report = await run_load(args.host, args.port, clients, args.requests, seed=args.seed)
+        print(f"{report.clients:>7} | {report.requests:>8} | {report.rejected:>8} | {report.seconds:>7.2f} | "
+              f"{report.operations_per_second:>19.0f}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Bank server for concurrent clients and its load generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run the server")
+    serve.add_argument("--db", help="SQLite database of the bank, saved when the server stops. "
+                                    "Without it a demo bank is used.")
+    serve.add_argument("--users", type=int, default=100, help="number of users of the demo bank")
+    serve.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    load = commands.add_parser("load", help="measure requests per second at different numbers of clients")
+    load.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100, 1000])
+    load.add_argument("--requests", type=int, default=100, help="requests per client")
+    for command in [serve, load]:
+        command.add_argument("--host", default="127.0.0.1")
+        command.add_argument("--port", type=int, default=8765)
+        command.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(_serve(args) if args.command == "serve" else _load(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
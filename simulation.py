@@ -0,0 +1,131 @@
+from dataclasses import dataclass
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from entities import Session, UserStatusSavingEnum
+from policy import Policy
+from utils import MoneyUtils
+from vectorized_engine import BankColumns, STATUSES, OVERDUE_LOANS, LOCKED
+
+
+@dataclass
+class MonthReport:
+    """Health of the bank after a simulated month"""
+    months_ahead: int
+    current_time: int
+    money_in_bank: float
+    total_user_savings: float
+    total_user_loans: float
+    status_counts: Dict[UserStatusSavingEnum, int]
+
+
+@dataclass
+class PolicyComparisonMonth:
+    """Health of the bank under every compared policy after a simulated month, in the order of the policies"""
+    months_ahead: int
+    current_time: int
+    money_in_bank: List[float]
+    overdue_users: List[int]  # users in the grace period after their loans expired
+    locked_users: List[int]  # users that defaulted on their loans
+
+
+class Simulation:
+    """Runs the bank forward month by month on a fork of the session (see Session.fork)
+
+    The original session is never mutated and must not be changed while the simulation is in use. The months are
+    computed by the vectorized engine, so the simulation does not print anything and a month costs a handful of array
+    operations regardless of the number of users.
+
+    Usage example:
+    >>> simulation = Simulation(session)
+    >>> report = simulation.step()  # the bank in one month
+    >>> simulated_session = simulation.materialize()  # users as they will be at that time
+    """
+    session: Session
+    months_ahead: int
+
+    def __init__(self, session: Session):
+        self.session = session.fork()
+        self.months_ahead = 0
+        self._columns = BankColumns.from_session(self.session)
+
+    def step(self) -> MonthReport:
+        """Simulate one more month and return the state of the bank at that time"""
+        self._columns.step()
+        self.months_ahead += 1
+        return self.report()
+
+    def fast_forward(self, months: int) -> MonthReport:
+        """Simulate the given number of months at once (see BankColumns.fast_forward) and return the state of the bank
+        after the last one"""
+        self._columns.fast_forward(months)
+        self.months_ahead += months
+        return self.report()
+
+    def report(self) -> MonthReport:
+        columns = self._columns
+        total_user_savings_cents = int(columns.savings_cents.sum())
+        total_user_loans_cents = int(columns.loan_sum_cents[columns.loan_present].sum())
+        counts = np.bincount(columns.status, minlength=len(STATUSES))
+        return MonthReport(
+            months_ahead=self.months_ahead,
+            current_time=columns.current_time,
+            money_in_bank=MoneyUtils.to_euros(MoneyUtils.to_cents(self.session.initial_money_in_bank)
+                                              + total_user_savings_cents - total_user_loans_cents),
+            total_user_savings=MoneyUtils.to_euros(total_user_savings_cents),
+            total_user_loans=MoneyUtils.to_euros(total_user_loans_cents),
+            status_counts={status: int(counts[code]) for code, status in STATUSES.items()},
+        )
+
+    def materialize(self) -> Session:
+        """Write the simulated state back to the users of the simulated session and return the session"""
+        self._columns.apply_to_session(self.session)
+        # Paid loans were removed from the users, so the loan slots have to be rebuilt
+        self._columns = BankColumns.from_session(self.session)
+        return self.session
+
+
+def simulate(session: Session, months: int) -> List[MonthReport]:
+    """Simulate the bank for the given number of months ahead and return the report for every month
+
+    The session is not mutated.
+    """
+    simulation = Simulation(session)
+    return [simulation.step() for _ in range(months)]
+
+
+def compare_policies(session: Session, policies: Sequence[Policy], months: int) -> List[PolicyComparisonMonth]:
+    """Simulate the bank under each of the policies for the given number of months ahead and return the comparison for
+    every month
+
+    All the variants start from the current state of the session, which is not mutated, and are stepped together: the
+    columns of the bank are stacked once per policy, so a month of K variants costs one step of K times the users. The
+    policy of a variant applies to the existing loans and savings from the first simulated month, as if it was set on
+    the session (see Session.policy); the simulation does not issue new loans, so the loan rates and limits of the
+    policies do not make a difference here (see monte_carlo.run_stress_test for that).
+    """
+    base = BankColumns.from_session(session)
+    n_users = len(base.users)
+    columns = base.shard(np.tile(np.arange(n_users), len(policies)))
+    for variant, policy in enumerate(policies):
+        rows = slice(variant * n_users, (variant + 1) * n_users)
+        columns.set_policy(rows, policy)
+        columns.savings_interest_rate[rows] = columns._savings_interest_rate_for(columns.savings_cents[rows], rows)
+    initial_money_in_bank_cents = MoneyUtils.to_cents(session.initial_money_in_bank)
+
+    comparison = []
+    for month in range(months):
+        columns.step()
+        savings_cents = columns.savings_cents.reshape(len(policies), n_users).sum(axis=1)
+        loans_cents = np.where(columns.loan_present, columns.loan_sum_cents, 0).reshape(len(policies), -1).sum(axis=1)
+        status = columns.status.reshape(len(policies), n_users)
+        comparison.append(PolicyComparisonMonth(
+            months_ahead=month + 1,
+            current_time=columns.current_time,
+            money_in_bank=[MoneyUtils.to_euros(initial_money_in_bank_cents + int(money_cents))
+                           for money_cents in savings_cents - loans_cents],
+            overdue_users=(status == OVERDUE_LOANS).sum(axis=1).tolist(),
+            locked_users=(status == LOCKED).sum(axis=1).tolist(),
+        ))
+    return comparison
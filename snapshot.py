@@ -0,0 +1,346 @@
+import bisect
+import dataclasses
+import gc
+import json
+import os
+from typing import Dict, Iterator, List, Optional, Sequence, Set
+
+import numpy as np
+
+from entities import Session, User, Loan, SavingsAccount, UserStatusSavingEnum
+from policy import Policy
+from utils import MoneyUtils
+from vectorized_engine import STATUS_CODES, STATUSES
+
+FORMAT_VERSION = 1
+BANK_FILE = "bank.json"
+# Columns of the snapshot, one .npy file each. Rows of the user columns are the users in the order of the session.
+# Texts and loans are stored like Arrow lists: the items of the user i are items[offsets[i]:offsets[i + 1]].
+USER_COLUMNS = ["savings_cents", "savings_interest_rate", "status", "username_offsets", "username_data",
+                "username_order", "full_name_offsets", "full_name_data", "loan_offsets"]
+LOAN_COLUMNS = ["loan_sum_cents", "loan_interest_rate", "loan_initiated_at"]
+
+
+def _text_columns(texts: List[str]):
+    encoded = [text.encode() for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+class TextColumn(Sequence[str]):
+    """Read-only sequence of the texts stored in an offsets and a data column"""
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode()
+
+
+class _SortedTexts(Sequence[str]):
+    """Texts of a column in the given order, for bisect"""
+
+    def __init__(self, texts: TextColumn, order: np.ndarray):
+        self.texts = texts
+        self.order = order
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __getitem__(self, index: int) -> str:
+        return self.texts[self.order[index]]
+
+
+def save_snapshot(session: Session, path: str):
+    """Write the whole session to the directory at path as columns (see USER_COLUMNS and LOAN_COLUMNS)
+
+    Every file is written next to the old one and then renamed over it, so sessions that were loaded from the old
+    snapshot (and map its files) keep working. The bank file is written last.
+    """
+    users = session.users
+    loans = [loan for user in users for loan in user.loans]
+    columns = {
+        "savings_cents": np.array([user.savings_account.savings_cents for user in users], dtype=np.int64),
+        "savings_interest_rate": np.array([user.savings_account.interest_rate for user in users], dtype=np.float64),
+        "status": np.array([STATUS_CODES[user.status] for user in users], dtype=np.int8),
+        "loan_offsets": np.zeros(len(users) + 1, dtype=np.int64),
+        "loan_sum_cents": np.array([loan.sum_cents for loan in loans], dtype=np.int64),
+        "loan_interest_rate": np.array([loan.interest_rate for loan in loans], dtype=np.float64),
+        "loan_initiated_at": np.array([loan.initiated_at for loan in loans], dtype=np.int64),
+    }
+    np.cumsum([len(user.loans) for user in users], out=columns["loan_offsets"][1:])
+    usernames = [user.username for user in users]
+    columns["username_offsets"], columns["username_data"] = _text_columns(usernames)
+    columns["username_order"] = np.array(sorted(range(len(users)), key=usernames.__getitem__), dtype=np.int64)
+    columns["full_name_offsets"], columns["full_name_data"] = _text_columns([user.full_name for user in users])
+
+    os.makedirs(path, exist_ok=True)
+    for name, column in columns.items():
+        with open(os.path.join(path, name + ".npy.tmp"), "wb") as file:
+            np.save(file, column)
+        os.replace(os.path.join(path, name + ".npy.tmp"), os.path.join(path, name + ".npy"))
+    bank = {
+        "format_version": FORMAT_VERSION,
+        "n_users": len(users),
+        "current_time": session.current_time,
+        "initial_money_in_bank": session.initial_money_in_bank,
+        "total_user_savings_cents": session._total_user_savings_cents,
+        "total_user_loans_cents": session._total_user_loans_cents,
+        "policy": dataclasses.asdict(session.policy),
+    }
+    with open(os.path.join(path, BANK_FILE + ".tmp"), "w") as file:
+        json.dump(bank, file)
+    os.replace(os.path.join(path, BANK_FILE + ".tmp"), os.path.join(path, BANK_FILE))
+
+
+class Snapshot:
+    """Snapshot of a session written by save_snapshot, with its columns memory-mapped
+
+    Opening a snapshot reads only the bank figures; sessions opened from it load users lazily, like sessions of
+    storage.SQLiteStorage: a user is built from the columns when they are looked up (see Session.get_user) or when all
+    users are needed (see Session.users). So opening a bank of millions of users takes milliseconds, and processes that
+    open the same snapshot share its pages.
+
+    Usage example:
+    >>> session.save("bank.snapshot")
+    >>> session = Session.load("bank.snapshot")  # same as Snapshot("bank.snapshot").open_session()
+    """
+    path: str
+    bank: dict
+    columns: Dict[str, np.ndarray]
+    policy: Policy
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, BANK_FILE)) as file:
+            self.bank = json.load(file)
+        if self.bank["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {self.bank['format_version']} in {path}")
+        self.columns = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+                        for name in USER_COLUMNS + LOAN_COLUMNS}
+        if len(self.columns["savings_cents"]) != self.bank["n_users"]:
+            raise ValueError(f"Snapshot {path} is incomplete")
+        self.usernames = TextColumn(self.columns["username_offsets"], self.columns["username_data"])
+        self.full_names = TextColumn(self.columns["full_name_offsets"], self.columns["full_name_data"])
+        self._sorted_usernames = _SortedTexts(self.usernames, self.columns["username_order"])
+        self._rows: Dict[int, int] = {}  # rows of the loaded users: id(user) -> row
+        self._loaded_rows: Set[int] = set()
+        self.policy = Policy(**self.bank.get("policy", {}))  # snapshots saved without a policy use the default one
+
+    def open_session(self, check_consistency: bool = False) -> Session:
+        """Return a session with the figures of the snapshot. Users are not loaded until they are needed."""
+        session = Session(check_consistency=check_consistency)
+        session.current_time = self.bank["current_time"]
+        session.initial_money_in_bank = self.bank["initial_money_in_bank"]
+        session.policy = self.policy
+        session._total_user_savings_cents = self.bank["total_user_savings_cents"]
+        session._total_user_loans_cents = self.bank["total_user_loans_cents"]
+        session.storage = self
+        session._all_users_loaded = False
+        return session
+
+    def find_row(self, username: str) -> Optional[int]:
+        """Row of the user with the username, found by a binary search over the sorted usernames"""
+        position = bisect.bisect_left(self._sorted_usernames, username)
+        if position < len(self._sorted_usernames) and self._sorted_usernames[position] == username:
+            return int(self.columns["username_order"][position])
+        return None
+
+    def _add_user(self, session: Session, row: int, full_name: str, username: str, savings_cents: int,
+                  savings_interest_rate: float, status: int, loans: List[Loan]) -> User:
+        user = User.restore(full_name, username, SavingsAccount.restore(savings_cents, savings_interest_rate), loans,
+                            STATUSES[status])
+        session._add_loaded_user(user)
+        self._rows[id(user)] = row
+        self._loaded_rows.add(row)
+        return user
+
+    def load_user(self, session: Session, username: str) -> Optional[User]:
+        row = self.find_row(username)
+        if row is None or row in self._loaded_rows:
+            return None
+        columns = self.columns
+        loans = [Loan.restore(int(columns["loan_sum_cents"][i]), int(columns["loan_initiated_at"][i]),
+                              float(columns["loan_interest_rate"][i]))
+                 for i in range(columns["loan_offsets"][row], columns["loan_offsets"][row + 1])]
+        return self._add_user(session, row, self.full_names[row], username, int(columns["savings_cents"][row]),
+                              float(columns["savings_interest_rate"][row]), int(columns["status"][row]), loans)
+
+    def load_all_users(self, session: Session):
+        """Load all users that are not loaded yet, keeping the users in the order of the snapshot"""
+        session._all_users_loaded = True
+        new_users = [user for user in session._users if id(user) not in self._rows]
+        # Columns are converted to lists at once, as reading the items of a mapped array one by one is slow
+        columns = {name: column.tolist() for name, column in self.columns.items()}
+        usernames, full_names = self.usernames.data.tobytes(), self.full_names.data.tobytes()
+        loans = [Loan.restore(*loan) for loan in
+                 zip(columns["loan_sum_cents"], columns["loan_initiated_at"], columns["loan_interest_rate"])]
+        username_offsets, full_name_offsets = columns["username_offsets"], columns["full_name_offsets"]
+        loan_offsets = columns["loan_offsets"]
+        # Nothing built here is garbage, but building millions of objects would run the garbage collector many times
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for row in range(self.bank["n_users"]):
+                if row in self._loaded_rows:
+                    continue
+                self._add_user(session, row, full_names[full_name_offsets[row]:full_name_offsets[row + 1]].decode(),
+                               usernames[username_offsets[row]:username_offsets[row + 1]].decode(),
+                               columns["savings_cents"][row], columns["savings_interest_rate"][row],
+                               columns["status"][row], loans[loan_offsets[row]:loan_offsets[row + 1]])
+        finally:
+            if gc_enabled:
+                gc.enable()
+        # Removed users are detached from the session
+        stored_users = [user for user in session._users if id(user) in self._rows and user._session is session]
+        stored_users.sort(key=lambda user: self._rows[id(user)])
+        session._users = stored_users + new_users
+
+
+class ReadOnlySession:
+    """Read-only view of a snapshot for reports: the figures of the administrator dashboard and lists of users
+
+    The figures are computed from the memory-mapped columns, without building any user, so several reporting processes
+    can share one snapshot (the operating system keeps a single copy of its pages). Lists of users are filtered and
+    sorted on the columns as well; only the users of the requested page are built, and they are not registered in any
+    session. The view has the reading part of the interface of Session, so the user listing of the administrator
+    panel works on it.
+
+    Usage example:
+    >>> report = ReadOnlySession("bank.snapshot")
+    >>> report.money_in_bank, report.status_counts
+    >>> top_debtors = report.list_users(sort_by="loans", descending=True, page_size=10)
+    """
+    snapshot: Snapshot
+
+    def __init__(self, path: str):
+        self.snapshot = Snapshot(path)
+        self._total_loans_cents = None  # per user, computed on first use
+
+    @property
+    def current_time(self) -> int:
+        return self.snapshot.bank["current_time"]
+
+    @property
+    def initial_money_in_bank(self) -> float:
+        return self.snapshot.bank["initial_money_in_bank"]
+
+    @property
+    def policy(self) -> Policy:
+        return self.snapshot.policy
+
+    @property
+    def total_user_savings_cents(self) -> int:
+        return int(self.snapshot.columns["savings_cents"].sum())
+
+    @property
+    def total_user_loans_cents(self) -> int:
+        return int(self.snapshot.columns["loan_sum_cents"].sum())
+
+    @property
+    def money_in_bank_cents(self) -> int:
+        return MoneyUtils.to_cents(self.initial_money_in_bank) + self.total_user_savings_cents - \
+            self.total_user_loans_cents
+
+    @property
+    def money_in_bank(self) -> float:
+        return MoneyUtils.to_euros(self.money_in_bank_cents)
+
+    @property
+    def total_user_savings(self) -> float:
+        return MoneyUtils.to_euros(self.total_user_savings_cents)
+
+    @property
+    def total_user_loans(self) -> float:
+        return MoneyUtils.to_euros(self.total_user_loans_cents)
+
+    @property
+    def total_user_personal_savings(self) -> float:
+        return MoneyUtils.to_euros(self.total_user_savings_cents - self.total_user_loans_cents)
+
+    @property
+    def status_counts(self) -> Dict[UserStatusSavingEnum, int]:
+        counts = np.bincount(self.snapshot.columns["status"], minlength=len(STATUSES))
+        return {STATUSES[code]: int(counts[code]) for code in STATUSES}
+
+    def total_loans_cents(self) -> np.ndarray:
+        """Total of the loans of every user"""
+        if self._total_loans_cents is None:
+            columns = self.snapshot.columns
+            cumulative_cents = np.concatenate([[0], np.cumsum(columns["loan_sum_cents"])])
+            self._total_loans_cents = cumulative_cents[columns["loan_offsets"][1:]] - \
+                cumulative_cents[columns["loan_offsets"][:-1]]
+        return self._total_loans_cents
+
+    def _matching_rows(self, status: Optional[UserStatusSavingEnum] = None, min_total_loans: Optional[float] = None,
+                       loans_expiring_within: Optional[int] = None) -> np.ndarray:
+        """Rows of the users matching all the given filters, see Session.iter_users"""
+        columns = self.snapshot.columns
+        matching = np.ones(self.snapshot.bank["n_users"], dtype=bool)
+        if status is not None:
+            matching &= columns["status"] == STATUS_CODES[status]
+        if min_total_loans is not None:
+            matching &= self.total_loans_cents() >= MoneyUtils.to_cents(min_total_loans)
+        if loans_expiring_within is not None:
+            expires_at = columns["loan_initiated_at"] + self.policy.loan_term_months  # see Loan.expires_at
+            expiring = (expires_at > self.current_time) & (expires_at <= self.current_time + loans_expiring_within)
+            users_with_expiring_loans = np.zeros_like(matching)
+            users_with_expiring_loans[np.searchsorted(columns["loan_offsets"], np.flatnonzero(expiring),
+                                                      side="right") - 1] = True
+            matching &= users_with_expiring_loans
+        return np.flatnonzero(matching)
+
+    def iter_users(self, **filters) -> Iterator[User]:
+        """Iterate over the users matching the filters (see Session.iter_users), building one user at a time
+
+        The users are visited in the order of the rows, i.e. of the users of the session when the snapshot was taken,
+        also with the status and the expiry filters, for which Session.iter_users follows the order of its indexes.
+        """
+        for row in self._matching_rows(**filters).tolist():
+            yield self.user(row)
+
+    def list_users(self, page: int = 0, page_size: int = 20, sort_by: Optional[str] = None, descending: bool = False,
+                   **filters) -> List[User]:
+        """Return a page of the users matching the filters (see Session.list_users)
+
+        Sorted pages have the same order as in Session.list_users. Unsorted pages follow the order of the rows, see
+        iter_users.
+        """
+        rows = self._matching_rows(**filters)
+        if sort_by is not None:
+            username_ranks = np.empty(len(self.snapshot.usernames), dtype=np.int64)
+            username_ranks[self.snapshot.columns["username_order"]] = np.arange(len(username_ranks))
+            if sort_by == "full_name":
+                full_names = [self.snapshot.full_names[row] for row in rows.tolist()]
+                keys = np.unique(full_names, return_inverse=True)[1] if full_names else rows
+            elif sort_by == "username":
+                keys = username_ranks[rows]
+            elif sort_by == "savings":
+                keys = self.snapshot.columns["savings_cents"][rows]
+            elif sort_by == "loans":
+                keys = self.total_loans_cents()[rows]
+            else:
+                raise KeyError(sort_by)
+            order = np.lexsort([username_ranks[rows], keys])
+            rows = rows[order[::-1] if descending else order]
+        return [self.user(row) for row in rows[page * page_size:(page + 1) * page_size].tolist()]
+
+    def user(self, row: int) -> User:
+        """Build the user in the row; the user is not registered in any session"""
+        columns = self.snapshot.columns
+        loans = [Loan.restore(int(columns["loan_sum_cents"][i]), int(columns["loan_initiated_at"][i]),
+                              float(columns["loan_interest_rate"][i]))
+                 for i in range(columns["loan_offsets"][row], columns["loan_offsets"][row + 1])]
+        return User.restore(self.snapshot.full_names[row], self.snapshot.usernames[row],
+                            SavingsAccount.restore(int(columns["savings_cents"][row]),
+                                                   float(columns["savings_interest_rate"][row])),
+                            loans, STATUSES[int(columns["status"][row])])
+
+    def get_user(self, username: str) -> Optional[User]:
+        row = self.snapshot.find_row(username)
+        return None if row is None else self.user(row)
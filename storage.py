@@ -0,0 +1,181 @@
+import dataclasses
+import json
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from entities import Session, User, Loan, SavingsAccount, UserStatusSavingEnum
+from policy import Policy
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bank (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    time_in_months INTEGER NOT NULL,
+    initial_money_in_bank REAL NOT NULL,
+    total_user_savings_cents INTEGER NOT NULL,
+    total_user_loans_cents INTEGER NOT NULL,
+    policy TEXT  -- JSON of the fields of policy.Policy; NULL for the default policy
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    full_name TEXT NOT NULL,
+    savings_cents INTEGER NOT NULL,
+    savings_interest_rate REAL NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS loans (
+    user_id INTEGER NOT NULL REFERENCES users (id),
+    position INTEGER NOT NULL,
+    sum_cents INTEGER NOT NULL,
+    initiated_at INTEGER NOT NULL,
+    interest_rate REAL NOT NULL,
+    PRIMARY KEY (user_id, position)
+);
+"""
+
+
+def _user_state(user: User) -> tuple:
+    """Everything that is stored about the user; used to find out which loaded users have changed"""
+    return (user.savings_account.savings_cents, user.savings_account.interest_rate, user.status,
+            tuple((loan.sum_cents, loan.initiated_at, loan.interest_rate) for loan in user.loans))
+
+
+class SQLiteStorage:
+    """Persists a session (users, their loans and savings accounts, the time, the bank totals and the policy) to SQLite
+
+    Sessions opened from the storage load users lazily: a user is read from the database only when they are looked up
+    (see Session.get_user) or when all users are needed (see Session.users). The bank totals are stored in the database
+    as well, so the administrator dashboard works without loading any user.
+
+    Usage example:
+    >>> storage = SQLiteStorage("bank.sqlite")
+    >>> session = storage.open_session()
+    >>> session.get_user("john_doe").deposit_savings(100)
+    >>> storage.save(session)  # writes the changed users in one transaction
+    """
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(SCHEMA)
+        if "policy" not in [column[1] for column in self._connection.execute("PRAGMA table_info(bank)")]:
+            # Databases created before the policy was stored use the default one
+            self._connection.execute("ALTER TABLE bank ADD COLUMN policy TEXT")
+        # Users that were loaded or saved: id(user) -> (row id, user, state at the time of loading or saving)
+        self._rows: Dict[int, Tuple[int, User, tuple]] = {}
+        self._loaded_row_ids = set()
+
+    def close(self):
+        self._connection.close()
+
+    def is_empty(self) -> bool:
+        return self._connection.execute("SELECT COUNT(*) FROM bank").fetchone()[0] == 0
+
+    def open_session(self, check_consistency: bool = False) -> Session:
+        """Return a session backed by the storage. Users are not loaded until they are needed."""
+        session = Session(check_consistency=check_consistency)
+        session.storage = self
+        bank = self._connection.execute(
+            "SELECT time_in_months, initial_money_in_bank, total_user_savings_cents, total_user_loans_cents, policy "
+            "FROM bank").fetchone()
+        if bank is not None:
+            session.current_time, session.initial_money_in_bank = bank[0], bank[1]
+            session._total_user_savings_cents, session._total_user_loans_cents = bank[2], bank[3]
+            if bank[4] is not None:
+                session.policy = Policy(**json.loads(bank[4]))
+            session._all_users_loaded = False
+        return session
+
+    def _load_users(self, session: Session, where: str = "", parameters: tuple = ()) -> List[User]:
+        """Load the users matching the condition that are not loaded yet and add them to the session"""
+        user_rows = [row for row in self._connection.execute(
+            "SELECT id, username, full_name, savings_cents, savings_interest_rate, status FROM users "
+            + where + " ORDER BY id", parameters) if row[0] not in self._loaded_row_ids]
+        if not user_rows:
+            return []
+        if len(user_rows) == 1:
+            loan_rows = self._connection.execute(
+                "SELECT user_id, sum_cents, initiated_at, interest_rate FROM loans WHERE user_id = ? ORDER BY position",
+                (user_rows[0][0],))
+        else:
+            loan_rows = self._connection.execute(
+                "SELECT user_id, sum_cents, initiated_at, interest_rate FROM loans ORDER BY user_id, position")
+        loans: Dict[int, List[Loan]] = {}
+        for user_id, sum_cents, initiated_at, interest_rate in loan_rows:
+            loans.setdefault(user_id, []).append(Loan.restore(sum_cents, initiated_at, interest_rate))
+
+        users = []
+        for row_id, username, full_name, savings_cents, savings_interest_rate, status in user_rows:
+            user = User.restore(full_name, username, SavingsAccount.restore(savings_cents, savings_interest_rate),
+                                loans.get(row_id, []), UserStatusSavingEnum(status))
+            session._add_loaded_user(user)
+            self._rows[id(user)] = (row_id, user, _user_state(user))
+            self._loaded_row_ids.add(row_id)
+            users.append(user)
+        return users
+
+    def load_user(self, session: Session, username: str) -> Optional[User]:
+        users = self._load_users(session, "WHERE username = ?", (username,))
+        return users[0] if users else None
+
+    def load_all_users(self, session: Session):
+        """Load all users that are not loaded yet, keeping the users in the order they were stored"""
+        session._all_users_loaded = True
+        new_users = [user for user in session._users if id(user) not in self._rows]
+        self._load_users(session)
+        stored_users = [user for user in session._users if id(user) in self._rows]
+        stored_users.sort(key=lambda user: self._rows[id(user)][0])
+        session._users = stored_users + new_users
+
+    def save(self, session: Session):
+        """Write the bank, new users and the loaded users that have changed in a single transaction
+
+        A storage keeps track of a single session, so only the session opened from it (or the first session saved to
+        it) can be saved.
+        """
+        session.storage = self
+        # Users are detached from the session when they are removed from it
+        removed_users = [user for _, user, _ in self._rows.values() if user._session is not session]
+        users_to_update = []
+        users_to_insert = []
+        for user in session._users:
+            if id(user) not in self._rows:
+                users_to_insert.append(user)
+            elif self._rows[id(user)][2] != _user_state(user):
+                users_to_update.append(user)
+
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO bank (id, time_in_months, initial_money_in_bank, total_user_savings_cents, "
+                "total_user_loans_cents, policy) VALUES (1, ?, ?, ?, ?, ?)",
+                (session.current_time, session.initial_money_in_bank, session._total_user_savings_cents,
+                 session._total_user_loans_cents, json.dumps(dataclasses.asdict(session.policy))))
+            # Removed users go first, as a new user may have taken the username of a removed one
+            self._connection.executemany("DELETE FROM loans WHERE user_id = ?",
+                                         [(self._rows[id(user)][0],) for user in users_to_update + removed_users])
+            self._connection.executemany("DELETE FROM users WHERE id = ?",
+                                         [(self._rows[id(user)][0],) for user in removed_users])
+            for user in users_to_insert:
+                row_id = self._connection.execute(
+                    "INSERT INTO users (username, full_name, savings_cents, savings_interest_rate, status) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (user.username, user.full_name, user.savings_account.savings_cents,
+                     user.savings_account.interest_rate, user.status.value)).lastrowid
+                self._rows[id(user)] = (row_id, user, ())
+            self._connection.executemany(
+                "UPDATE users SET savings_cents = ?, savings_interest_rate = ?, status = ? WHERE id = ?",
+                [(user.savings_account.savings_cents, user.savings_account.interest_rate, user.status.value,
+                  self._rows[id(user)][0]) for user in users_to_update])
+            changed_users = users_to_update + users_to_insert
+            self._connection.executemany(
+                "INSERT INTO loans (user_id, position, sum_cents, initiated_at, interest_rate) VALUES (?, ?, ?, ?, ?)",
+                [(self._rows[id(user)][0], position, loan.sum_cents, loan.initiated_at, loan.interest_rate)
+                 for user in changed_users for position, loan in enumerate(user.loans)])
+
+        # A new user may have got the row id of a removed one
+        for user in removed_users:
+            self._loaded_row_ids.discard(self._rows.pop(id(user))[0])
+        for user in changed_users:
+            self._rows[id(user)] = (self._rows[id(user)][0], user, _user_state(user))
+            self._loaded_row_ids.add(self._rows[id(user)][0])
@@ -1,6 +1,31 @@
-from entities import Session, Loan, LoanStatusEnum, SavingsAccount, User, UserStatusSavingEnum
+from entities import Session, Loan, LoanStatusEnum, SavingsAccount, User, UserStatusSavingEnum, USER_SORT_KEYS
 import unittest
 import admin_panel as admin
+import user_panel
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest.mock
+import vectorized_engine
+from simulation import Simulation, compare_policies, simulate
+from monte_carlo import CustomerBehaviour, run_stress_test
+from snapshot import ReadOnlySession
+from storage import SQLiteStorage
+from names import NameGenerator
+from policy import DEFAULT_POLICY, Policy
+from journal import EventType, Journal, read_journal, replay
+import benchmarks
+from benchmarks import run_benchmarks
+from server import BankServer, run_load
+from transactions import Transaction, TransactionActionEnum, read_transactions, run_batch
+from utils import MoneyUtils, SilentSink
 from mutpy import commandline    
 
 
@@ -393,5 +418,1211 @@ class AdminTest(unittest.TestCase):
         self.assertEqual(new_user.loans[0].sum, 100.83)
         self.assertEqual(new_user.status, UserStatusSavingEnum.OVERDUE_LOANS)
 
+class MonthEndTest(unittest.TestCase):
+    def test_only_users_that_can_change_status_are_processed_one_by_one(self):
+        session = Session(check_consistency=True)
+        session.notifications = SilentSink()
+        session.current_time = 11
+        locked_user = User(session, loans=[Loan(500, 0)], savings=100)
+        saver = User(session, savings=20_000)
+        borrower = User(session, loans=[Loan(1000, 5)], savings=1000)
+        expiring_borrower = User(session, loans=[Loan(300, 0)], savings=1000)
+        overdue_user = User(session, savings=1000)
+        for user in [locked_user, saver, borrower, expiring_borrower, overdue_user]:
+            session.add_user(user)
+        locked_user.status = UserStatusSavingEnum.LOCKED
+        overdue_user.status = UserStatusSavingEnum.OVERDUE_LOANS
+        expected_session = copy.deepcopy(session)
+
+        with unittest.mock.patch("admin_panel._user_in_one_month",
+                                 wraps=admin._user_in_one_month) as user_in_one_month:
+            admin.handle_month_forward_action(session)
+        self.assertEqual([call.args[0] for call in user_in_one_month.call_args_list],
+                         [overdue_user, expiring_borrower])
+        expected_session.current_time += 1
+        for user in expected_session.users:
+            admin._user_in_one_month(user, expected_session)
+        self.assertEqual([repr(user) for user in session.users], [repr(user) for user in expected_session.users])
+        self.assertEqual(borrower.loans[0].sum, 1008.33)
+        self.assertEqual(saver.savings_account.interest_rate, 0.055)
+        self.assertEqual(expiring_borrower.status, UserStatusSavingEnum.ACTIVE)
+        session.verify_totals()
+
+    def test_fork_copies_only_users_that_change(self):
+        session = Session()
+        session.notifications = SilentSink()
+        session.populate_db(30, seed=8)
+        for user in session.users[:10]:
+            user.status = UserStatusSavingEnum.LOCKED
+        fork = session.fork()
+        admin.handle_month_forward_action(fork)
+        self.assertEqual([user._session is session for user in fork.users], [True] * 10 + [False] * 20)
+        self.assertEqual(fork.current_time, 1)
+        fork.verify_totals()
+
+
+class SessionTotalsTest(unittest.TestCase):
+    def test_totals_follow_user_mutations(self):
+        session = Session(check_consistency=True)
+        user = User(session, savings=1000)
+        session.add_user(user)
+        user.add_loan(session, Loan(500, 0))
+        user.deposit_savings(200)
+        user.withdraw_savings(session, 100)
+        user.pay_loan(session, user.loans[0], 300)
+        self.assertEqual(session.total_user_savings, 1300)
+        self.assertEqual(session.total_user_loans, 200)
+        self.assertEqual(session.money_in_bank, 101_100)
+
+    def test_totals_follow_month_forward(self):
+        session = Session(check_consistency=True)
+        session.populate_db()
+        for _ in range(14):
+            admin.handle_month_forward_action(session)
+        session.verify_totals()
+
+    def test_consistency_check_detects_out_of_sync_totals(self):
+        session = Session(check_consistency=True)
+        user = User(session, savings=1000)
+        session.add_user(user)
+        user.savings_account._savings_cents = 200_000  # bypass the running totals
+        with self.assertRaises(RuntimeError):
+            session.money_in_bank
+
+    def test_populate_db_is_reproducible_with_seed(self):
+        session = Session(check_consistency=True)
+        session.populate_db(200, seed=42)
+        other_session = Session()
+        other_session.populate_db(200, seed=42)
+        self.assertEqual(len(session.users), 200)
+        self.assertEqual([user.username for user in session.users], [user.username for user in other_session.users])
+        self.assertEqual(session.money_in_bank, other_session.money_in_bank)
+        self.assertGreaterEqual(session.money_in_bank, 0)
+        session.populate_db(10, seed=43)
+        self.assertEqual(len(session.users), 210)
+
+    def test_populate_db_gives_up_when_bank_can_not_afford_users(self):
+        session = Session()
+        session.initial_money_in_bank = -50_000
+        with self.assertRaises(ValueError):
+            session.populate_db(1, seed=0)
+        self.assertEqual(session.users, [])
+
+    def test_copied_user_is_detached_and_slotted(self):
+        session = Session()
+        session.populate_db(20, seed=11)
+        user = next(user for user in session.users if user.loans)
+        copied = copy.deepcopy(user)
+        self.assertIsNone(copied._session)
+        self.assertIsNone(copied.savings_account._session)
+        self.assertEqual(copied.loans[0].sum_cents, user.loans[0].sum_cents)
+        self.assertIsNot(copied.loans[0], user.loans[0])
+        for entity in [copied, copied.savings_account, copied.loans[0]]:
+            self.assertFalse(hasattr(entity, "__dict__"))
+
+    def test_unregistered_user_is_not_counted(self):
+        session = Session()
+        user = User(session, savings=1000)
+        user.deposit_savings(500)
+        self.assertEqual(session.total_user_savings, 0)
+
+
+class ReservationTest(unittest.TestCase):
+    def test_reserved_money_is_not_available_until_committed(self):
+        session = Session()
+        session.initial_money_in_bank = 1000
+        reservation = session.try_reserve(80_000)
+        self.assertEqual(reservation.cents, 80_000)
+        self.assertIsNone(session.try_reserve(30_000))
+        reservation.commit()
+        with session.try_reserve(100_000):
+            self.assertIsNone(session.try_reserve(1))
+        self.assertEqual(session._reserved_cents, 0)
+
+    def test_rejected_operation_releases_its_reservation(self):
+        session = Session()
+        user = User(session, savings=100)
+        session.add_user(user)
+        with self.assertRaises(ValueError):
+            user.withdraw_savings(session, 200)  # more than the savings of the user
+        self.assertEqual(session._reserved_cents, 0)
+        self.assertEqual(copy.deepcopy(session)._reserved_cents, 0)
+
+    def test_concurrent_threads_do_not_overdraw_the_bank(self):
+        session = Session(check_consistency=True)
+        session.notifications = SilentSink()
+        for _ in range(40):
+            session.add_user(User(session, savings=300))
+        session.initial_money_in_bank = -11_000  # the bank has €1000 left
+        barrier = threading.Barrier(40)
+
+        def withdraw_and_borrow(user):
+            barrier.wait()
+            for operation in [lambda: user.withdraw_savings(session, 300),
+                              lambda: user.add_loan(session, Loan(300, 0))]:
+                try:
+                    operation()
+                except ValueError:
+                    pass
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=withdraw_and_borrow, args=(user,)) for user in session.users]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        session.verify_totals()
+        self.assertEqual(session.money_in_bank, 100)
+        self.assertEqual(session._reserved_cents, 0)
+
+
+class MoneyInCentsTest(unittest.TestCase):
+    def test_repeated_small_deposits_do_not_drift(self):
+        session = Session(check_consistency=True)
+        user = User(session, savings=0)
+        session.add_user(user)
+        session.notifications = SilentSink()
+        for _ in range(1000):
+            user.deposit_savings(0.1)
+        self.assertEqual(user.savings_account.savings_cents, 10_000)
+        self.assertEqual(session.total_user_savings_cents, 10_000)
+        self.assertEqual(user.savings_account.savings_amount, 100)
+
+    def test_amounts_are_rounded_to_the_nearest_cent(self):
+        self.assertEqual(MoneyUtils.to_cents(10.005), 1001)
+        self.assertEqual(MoneyUtils.to_cents(99.99), 9999)
+        self.assertEqual(Loan(1000.004, 0).sum_cents, 100_000)
+        self.assertEqual(MoneyUtils.with_monthly_interest(100_000, 0.1), 100_833)
+
+
+class NotificationSinkTest(unittest.TestCase):
+    @staticmethod
+    def _output(action) -> str:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            action()
+        return output.getvalue()
+
+    def test_domain_methods_report_to_the_session_sink(self):
+        session = Session()
+        user = User(session, savings=100)
+        session.add_user(user)
+        self.assertEqual(self._output(lambda: user.deposit_savings(50)), "Deposited €50. Current savings: €150.0\n")
+        session.notifications = SilentSink()
+        self.assertEqual(self._output(lambda: user.deposit_savings(50)), "")
+        self.assertEqual(user.savings_account.savings_amount, 200)
+
+    def test_silent_month_forward_does_not_print(self):
+        session = Session()
+        session.populate_db(50, seed=13)
+        session.current_time = 12
+        session.notifications = SilentSink()
+        self.assertEqual(self._output(lambda: admin.handle_month_forward_action(session)), "")
+        self.assertEqual(session.current_time, 13)
+
+    def test_negative_balance_is_reported_to_the_session_sink(self):
+        session = Session()
+        session.initial_money_in_bank = -10
+        self.assertIn("CRITICAL", self._output(lambda: session.money_in_bank))
+        session.notifications = SilentSink()
+        self.assertEqual(self._output(lambda: session.money_in_bank), "")
+
+
+class VectorizedEngineTest(unittest.TestCase):
+    @staticmethod
+    def _user_state(user):
+        return (user.username, user.status, user.savings_account.savings_amount, user.savings_account.interest_rate,
+                [(loan.sum, loan.initiated_at, loan.interest_rate) for loan in user.loans])
+
+    def test_interest_in_cents_matches_money_utils(self):
+        cents = [100_000, 1_000_000, 6, 18, 30, 123_456_789, 1, 0]
+        rates = [0.05, 0.055, 0.05, 0.1, 0.105, 0.1, 0.06, 0.05]
+        np = vectorized_engine.np
+        self.assertEqual(vectorized_engine.monthly_interest(np.array(cents), np.array(rates)).tolist(),
+                         [MoneyUtils.monthly_interest(c, rate) for c, rate in zip(cents, rates)])
+        self.assertEqual(vectorized_engine.with_monthly_interest(np.array(cents), np.array(rates)).tolist(),
+                         [MoneyUtils.with_monthly_interest(c, rate) for c, rate in zip(cents, rates)])
+
+    def test_fast_forward_matches_month_by_month(self):
+        session = Session(check_consistency=True)
+        session.notifications = SilentSink()
+        for month in range(3):
+            session.populate_db(100, seed=20 + month)
+            admin.handle_month_forward_action(session)
+        stepped_session = copy.deepcopy(session)
+
+        for months in [1, 5, 30]:
+            vectorized_engine.fast_forward(session, months)
+            for _ in range(months):
+                vectorized_engine.month_forward_vectorized(stepped_session)
+            self.assertEqual(session.current_time, stepped_session.current_time)
+            self.assertEqual([self._user_state(user) for user in session.users],
+                             [self._user_state(user) for user in stepped_session.users])
+            self.assertEqual(session.money_in_bank, stepped_session.money_in_bank)
+
+    def test_fast_forward_locks_users_with_already_expired_loans(self):
+        session = Session()
+        session.current_time = 20
+        session.add_user(User(session, loans=[Loan(5000, 0)], savings=100))
+        session.add_user(User(session, loans=[Loan(50, 0), Loan(100, 15)], savings=100))
+        stepped_session = copy.deepcopy(session)
+        vectorized_engine.fast_forward(session, 3)
+        for _ in range(3):
+            vectorized_engine.month_forward_vectorized(stepped_session)
+        self.assertEqual([user.status for user in session.users],
+                         [UserStatusSavingEnum.LOCKED, UserStatusSavingEnum.ACTIVE])
+        self.assertEqual([self._user_state(user) for user in session.users],
+                         [self._user_state(user) for user in stepped_session.users])
+
+    def test_fast_forward_crosses_savings_rate_threshold(self):
+        session = Session()
+        user = User(session, loans=[Loan(1000, 0)], savings=9_900)
+        session.add_user(user)
+        vectorized_engine.fast_forward(session, 11)
+        self.assertEqual(user.savings_account.interest_rate, 0.055)
+        self.assertEqual(user.status, UserStatusSavingEnum.ACTIVE)
+        self.assertEqual(Simulation(session).fast_forward(24), simulate(session, 24)[-1])
+
+    def test_sharded_month_forward_matches_vectorized(self):
+        session = Session(check_consistency=True)
+        session.notifications = SilentSink()
+        for month in range(3):
+            session.populate_db(50, seed=30 + month)
+            admin.handle_month_forward_action(session)
+        sharded_sessions = {workers: copy.deepcopy(session) for workers in [1, 3]}
+
+        for _ in range(14):
+            vectorized_engine.month_forward_vectorized(session)
+            for workers, sharded_session in sharded_sessions.items():
+                vectorized_engine.month_forward_sharded(sharded_session, workers=workers)
+                self.assertEqual(sharded_session.current_time, session.current_time)
+                self.assertEqual([self._user_state(user) for user in sharded_session.users],
+                                 [self._user_state(user) for user in session.users])
+                sharded_session.verify_totals()
+                self.assertEqual(sharded_session.money_in_bank, session.money_in_bank)
+
+    def test_sharded_bank_closes_months_without_changing_users(self):
+        session = Session(check_consistency=True)
+        session.notifications = SilentSink()
+        for month in range(3):
+            session.populate_db(40, seed=40 + month)
+            admin.handle_month_forward_action(session)
+        expected_session = copy.deepcopy(session)
+        user_states = [self._user_state(user) for user in session.users]
+
+        for workers in [1, 3]:
+            sharded_session = copy.deepcopy(session)
+            with vectorized_engine.ShardedBank(sharded_session, workers=workers) as bank:
+                for months in [1, 1, 10]:
+                    bank.fast_forward(months)
+                    self.assertEqual([self._user_state(user) for user in sharded_session.users], user_states)
+                bank.apply_to_session()
+                bank.month_forward()
+                bank.apply_to_session()
+            if workers == 1:
+                vectorized_engine.fast_forward(expected_session, 13)
+            self.assertEqual(bank.current_time, expected_session.current_time)
+            self.assertEqual(bank.money_in_bank, expected_session.money_in_bank)
+            self.assertEqual(bank.status_counts, {status: len(list(expected_session.iter_users(status=status)))
+                                                  for status in UserStatusSavingEnum})
+            self.assertEqual([self._user_state(user) for user in sharded_session.users],
+                             [self._user_state(user) for user in expected_session.users])
+            sharded_session.verify_totals()
+
+    def test_sharded_month_forward_of_empty_bank(self):
+        session = Session()
+        vectorized_engine.month_forward_sharded(session, workers=2)
+        with vectorized_engine.ShardedBank(session, workers=1) as bank:
+            bank.fast_forward(3)
+            self.assertEqual(bank.money_in_bank, session.initial_money_in_bank)
+            self.assertEqual(bank.status_counts, {status: 0 for status in UserStatusSavingEnum})
+            bank.apply_to_session()
+        self.assertEqual(session.current_time, 4)
+
+    def test_vectorized_month_forward_matches_object_path(self):
+        session = Session(check_consistency=True)
+        # Issue loans at different months, s.t. they expire at different times
+        session.notifications = SilentSink()
+        for month in range(4):
+            session.populate_db(100, seed=month)
+            admin.handle_month_forward_action(session)
+        vectorized_session = copy.deepcopy(session)
+
+        statuses = set()
+        for _ in range(18):
+            admin.handle_month_forward_action(session)
+            vectorized_engine.month_forward_vectorized(vectorized_session)
+            self.assertEqual(vectorized_session.current_time, session.current_time)
+            self.assertEqual([self._user_state(user) for user in vectorized_session.users],
+                             [self._user_state(user) for user in session.users])
+            self.assertEqual(vectorized_session.money_in_bank, session.money_in_bank)
+            statuses.update(user.status for user in session.users)
+        self.assertEqual(statuses, set(UserStatusSavingEnum))
+
+
+class SimulationTest(unittest.TestCase):
+    def test_simulate_does_not_mutate_session(self):
+        session = Session()
+        session.populate_db(50, seed=3)
+        money_in_bank = session.money_in_bank
+        reports = simulate(session, 120)
+        self.assertEqual(len(reports), 120)
+        self.assertEqual(reports[-1].current_time, 120)
+        self.assertEqual(session.current_time, 0)
+        self.assertEqual(session.money_in_bank, money_in_bank)
+
+    def test_simulate_matches_month_forward(self):
+        session = Session()
+        session.populate_db(100, seed=4)
+        reports = simulate(session, 15)
+        session.notifications = SilentSink()
+        for report in reports:
+            admin.handle_month_forward_action(session)
+            self.assertEqual(report.money_in_bank, session.money_in_bank)
+            self.assertEqual(report.total_user_savings, session.total_user_savings)
+            self.assertEqual(report.total_user_loans, session.total_user_loans)
+            for status in UserStatusSavingEnum:
+                self.assertEqual(report.status_counts[status],
+                                 len([user for user in session.users if user.status == status]))
+
+    def test_simulate_action_renders_months(self):
+        session = Session()
+        session.populate_db(10, seed=5)
+        with unittest.mock.patch("builtins.input", side_effect=["", "", "exit"]), \
+                unittest.mock.patch(print.__module__ + ".print"):
+            admin.handle_simulate_action(session)
+        self.assertEqual(session.current_time, 0)
+
+
+class PolicyComparisonTest(unittest.TestCase):
+    def setUp(self):
+        self.session = Session()
+        self.session.populate_db(80, seed=32)
+        self.policies = [DEFAULT_POLICY, Policy(loan_term_months=6), Policy(savings_interest_rate=0.08),
+                         Policy(loan_term_months=24, large_savings_threshold=500)]
+
+    def test_current_policy_matches_simulation(self):
+        comparison = compare_policies(self.session, [DEFAULT_POLICY], 18)
+        for month, report in zip(comparison, simulate(self.session, 18)):
+            self.assertEqual(month.money_in_bank, [report.money_in_bank])
+            self.assertEqual(month.overdue_users, [report.status_counts[UserStatusSavingEnum.OVERDUE_LOANS]])
+            self.assertEqual(month.locked_users, [report.status_counts[UserStatusSavingEnum.LOCKED]])
+        self.assertEqual(self.session.current_time, 0)
+
+    def test_batched_variants_match_separate_runs(self):
+        comparison = compare_policies(self.session, self.policies, 30)
+        for variant, policy in enumerate(self.policies):
+            separate = compare_policies(self.session, [policy], 30)
+            self.assertEqual([month.money_in_bank[variant] for month in comparison],
+                             [month.money_in_bank[0] for month in separate])
+            self.assertEqual([month.locked_users[variant] for month in comparison],
+                             [month.locked_users[0] for month in separate])
+
+    def test_shorter_loans_default_earlier(self):
+        comparison = compare_policies(self.session, self.policies[:2], 12)
+        self.assertEqual(comparison[6].locked_users[0], 0)
+        self.assertGreater(comparison[6].locked_users[1], 0)
+        self.assertEqual(comparison[-1].current_time, 12)
+
+    def test_compare_policies_action_renders_variants(self):
+        output = io.StringIO()
+        with unittest.mock.patch("builtins.input", side_effect=["3"]), contextlib.redirect_stdout(output):
+            admin.handle_compare_policies_action(self.session)
+        self.assertIn("6-month loans", output.getvalue())
+        self.assertEqual(self.session.current_time, 0)
+
+
+class UserLookupTest(unittest.TestCase):
+    def test_get_user_by_username(self):
+        session = Session()
+        session.populate_db(50, seed=13)
+        user = session.users[17]
+        self.assertIs(session.get_user(user.username), user)
+        self.assertIsNone(session.get_user("nobody"))
+
+    def test_remove_user(self):
+        session = Session(check_consistency=True)
+        session.populate_db(10, seed=14)
+        user = session.users[3]
+        money_in_bank = session.money_in_bank
+        session.remove_user(user)
+        self.assertIsNone(session.get_user(user.username))
+        self.assertEqual(len(session.users), 9)
+        self.assertEqual(session.money_in_bank,
+                         round(money_in_bank - user.savings_account.savings_amount + user.total_loans, 2))
+
+    def test_log_in_by_username(self):
+        session = Session()
+        session.populate_db(10, seed=15)
+        user = session.users[4]
+        with unittest.mock.patch("builtins.input", side_effect=["nobody", user.username]), \
+                unittest.mock.patch(print.__module__ + ".print"):
+            self.assertIs(user_panel.log_in(session), user)
+        with unittest.mock.patch("builtins.input", side_effect=[""]), \
+                unittest.mock.patch(print.__module__ + ".print"):
+            self.assertIsNone(user_panel.log_in(session))
+
+
+class LoanExpiryIndexTest(unittest.TestCase):
+    def test_users_are_returned_once_when_their_loans_expire(self):
+        session = Session()
+        user = User(session, loans=[Loan(100, 0)], savings=1000)
+        session.add_user(user)
+        session.current_time = 5
+        user.add_loan(session, Loan.create_loan_object(session, 100))
+        session.current_time = 11
+        self.assertEqual(session.pop_users_with_expiring_loans(), set())
+        session.current_time = 12
+        self.assertEqual(session.pop_users_with_expiring_loans(), {user.username})
+        self.assertEqual(session.pop_users_with_expiring_loans(), set())
+        session.current_time = 17
+        self.assertEqual(session.pop_users_with_expiring_loans(), {user.username})
+
+    def test_month_forward_finds_loans_that_expired_before_user_was_added(self):
+        session = Session()
+        session.current_time = 12
+        user = User(session, loans=[Loan(100, 0)], savings=0)
+        session.add_user(user)
+        session.notifications = SilentSink()
+        admin.handle_month_forward_action(session)
+        self.assertEqual(user.status, UserStatusSavingEnum.OVERDUE_LOANS)
+
+    def test_fork_does_not_consume_expiring_loans_of_base(self):
+        session = Session()
+        user = User(session, loans=[Loan(100, 0)], savings=1000)
+        session.add_user(user)
+        fork = session.fork()
+        fork.current_time = 12
+        fork.writable_user(0).add_loan(fork, Loan.create_loan_object(fork, 50))
+        self.assertEqual(fork.pop_users_with_expiring_loans(), {user.username})
+        session.current_time = 12
+        self.assertEqual(session.pop_users_with_expiring_loans(), {user.username})
+        self.assertEqual(session._expiring_loans, {})
+
+
+class PolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.session = Session()
+        self.session.policy = Policy(loan_interest_rate=0.2, large_loan_interest_rate=0.25, large_loan_threshold=500,
+                                     savings_interest_rate=0.01, large_savings_interest_rate=0.02,
+                                     large_savings_threshold=1_000, loan_term_months=6, max_loans=1,
+                                     max_loan_amount=800)
+
+    def test_default_policy_keeps_the_rules_of_the_bank(self):
+        self.assertEqual(Session().policy, DEFAULT_POLICY)
+        self.assertEqual(DEFAULT_POLICY.loan_interest_rate_for(1_999.99), 0.1)
+        self.assertEqual(DEFAULT_POLICY.loan_interest_rate_for(2_000), 0.105)
+        self.assertEqual(DEFAULT_POLICY.savings_interest_rate_for(9_999.99), 0.05)
+        self.assertEqual(DEFAULT_POLICY.savings_interest_rate_for(10_000), 0.055)
+
+    def test_loans_follow_the_policy_of_the_session(self):
+        user = User(self.session, savings=2_000)
+        self.session.add_user(user)
+        with self.assertRaises(ValueError):
+            Loan.create_loan_object(self.session, 900)
+        loan = Loan.create_loan_object(self.session, 600)
+        self.assertEqual(loan.interest_rate, 0.25)
+        user.add_loan(self.session, loan)
+        self.assertEqual(loan.expires_at, 6)
+        with self.assertRaises(ValueError):
+            user.add_loan(self.session, Loan.create_loan_object(self.session, 100))
+
+    def test_savings_follow_the_policy_of_the_session(self):
+        user = User(self.session, savings=1_000)
+        self.assertEqual(user.savings_account.interest_rate, 0.02)
+        self.session.add_user(user)
+        user.withdraw_savings(self.session, 1)
+        self.assertTrue(user.rate_adjustment_is_needed())
+
+    def test_vectorized_month_follows_the_policy(self):
+        self.session.policy = Policy(loan_term_months=3, savings_interest_rate=0.03)
+        self.session.populate_db(60, seed=31)
+        self.session.notifications = SilentSink()
+        vectorized_session = copy.deepcopy(self.session)
+        for _ in range(5):
+            admin.handle_month_forward_action(self.session)
+            vectorized_engine.month_forward_vectorized(vectorized_session)
+        self.assertEqual([repr(user) for user in vectorized_session.users], [repr(user) for user in self.session.users])
+        self.assertGreater(len(list(self.session.iter_users(status=UserStatusSavingEnum.LOCKED))), 0)
+
+
+class NameGeneratorTest(unittest.TestCase):
+    def test_large_population_has_unique_usernames(self):
+        session = Session()
+        session.notifications = SilentSink()
+        session.populate_db(3_000, seed=21)
+        self.assertEqual(len({user.username for user in session.users}), 3_000)
+        for user in session.users:
+            self.assertTrue(user.username.startswith(user.full_name.lower().replace(" ", "_")))
+
+    def test_names_are_reproducible_and_numbered_once_taken(self):
+        names, other_names = NameGenerator(seed=5), NameGenerator(seed=5)
+        drawn = [names.draw() for _ in range(1_000)]
+        self.assertEqual(drawn, [other_names.draw() for _ in range(1_000)])
+        with unittest.mock.patch("names.FIRST_NAMES", ("Ann",)), unittest.mock.patch("names.LAST_NAMES", ("Lee",)):
+            self.assertEqual([names.draw() for _ in range(3)],
+                             [("Ann Lee", "ann_lee"), ("Ann Lee", "ann_lee_2"), ("Ann Lee", "ann_lee_3")])
+
+
+class UserListingTest(unittest.TestCase):
+    def setUp(self):
+        self.session = Session()
+        self.session.notifications = SilentSink()
+        self.session.populate_db(60, seed=20)
+        self.session.current_time = 10
+        for i, user in enumerate(self.session.users[:10]):
+            user.status = UserStatusSavingEnum.OVERDUE_LOANS if i % 2 else UserStatusSavingEnum.LOCKED
+
+    def test_filters_match_a_full_scan(self):
+        session = self.session
+        for status in UserStatusSavingEnum:
+            self.assertCountEqual(session.iter_users(status=status),
+                                  [user for user in session.users if user.status == status])
+        self.assertCountEqual(session.iter_users(min_total_loans=5_000),
+                              [user for user in session.users if user.total_loans >= 5_000])
+        expiring = [user for user in session.users if any(11 <= loan.expires_at <= 13 for loan in user.loans)]
+        self.assertTrue(expiring)
+        self.assertCountEqual(session.iter_users(loans_expiring_within=3), expiring)
+        self.assertEqual(list(session.iter_users(loans_expiring_within=1)), [])
+        self.assertCountEqual(session.iter_users(status=UserStatusSavingEnum.ACTIVE, loans_expiring_within=3),
+                              [user for user in expiring if user.status == UserStatusSavingEnum.ACTIVE])
+
+    def test_status_index_follows_changes(self):
+        session = self.session
+        user = session.users[20]
+        user.status = UserStatusSavingEnum.LOCKED
+        fork = session.fork()
+        fork.writable_user(0).status = UserStatusSavingEnum.ACTIVE
+        session.remove_user(session.users[1])
+        self.assertEqual(len(list(session.iter_users(status=UserStatusSavingEnum.LOCKED))), 6)
+        self.assertEqual(len(list(session.iter_users(status=UserStatusSavingEnum.OVERDUE_LOANS))), 4)
+        self.assertEqual(len(list(fork.iter_users(status=UserStatusSavingEnum.LOCKED))), 5)
+        self.assertIn(user, session.iter_users(status=UserStatusSavingEnum.LOCKED))
+
+    def test_pages_of_sorted_users(self):
+        session = self.session
+        top_debtors = sorted(session.users, key=lambda user: (user.total_loans_cents, user.username), reverse=True)
+        self.assertEqual(session.list_users(0, 7, sort_by="loans", descending=True), top_debtors[:7])
+        self.assertEqual(session.list_users(2, 7, sort_by="loans", descending=True), top_debtors[14:21])
+        self.assertEqual(session.list_users(1, 25), session.users[25:50])
+        self.assertEqual(session.list_users(2, 25, sort_by="username"),
+                         sorted(session.users, key=lambda user: user.username)[50:])
+
+    def test_admin_lists_users_page_by_page(self):
+        output = io.StringIO()
+        with unittest.mock.patch("builtins.input", side_effect=["1", "", "exit"]), \
+                contextlib.redirect_stdout(output):
+            admin.handle_user_list_action(self.session, page_size=20)
+        self.assertIn(f"40 - {self.session.users[39].full_name}", output.getvalue())
+        self.assertNotIn(f"41 - {self.session.users[40].full_name}", output.getvalue())
+
+    def test_admin_reads_unsorted_pages_from_one_iterator(self):
+        session = self.session
+        locked_users = list(session.iter_users(status=UserStatusSavingEnum.LOCKED))
+        output = io.StringIO()
+        with unittest.mock.patch("builtins.input", side_effect=["2", "LOCKED", "", ""]), \
+                unittest.mock.patch.object(session, "iter_users", wraps=session.iter_users) as iter_users, \
+                contextlib.redirect_stdout(output):
+            admin.handle_user_list_action(session, page_size=2)
+        iter_users.assert_called_once_with(status=UserStatusSavingEnum.LOCKED)
+        for i, user in enumerate(locked_users):
+            self.assertIn(f"{i + 1} - {user.full_name}", output.getvalue())
+
+
+class SessionForkTest(unittest.TestCase):
+    def test_fork_shares_users_until_they_are_changed(self):
+        session = Session()
+        session.populate_db(20, seed=6)
+        fork = session.fork()
+        self.assertIs(fork.users[0], session.users[0])
+        user = fork.writable_user(0)
+        self.assertIsNot(user, session.users[0])
+        self.assertIs(fork.users[1], session.users[1])
+
+    def test_changes_in_fork_do_not_affect_session(self):
+        session = Session(check_consistency=True)
+        session.populate_db(20, seed=7)
+        money_in_bank = session.money_in_bank
+        savings = session.users[0].savings_account.savings_amount
+        fork = session.fork()
+        fork.writable_user(0).deposit_savings(1000)
+        fork.notifications = SilentSink()
+        admin.handle_month_forward_action(fork)
+        fork.verify_totals()
+        self.assertEqual(session.money_in_bank, money_in_bank)
+        self.assertEqual(session.users[0].savings_account.savings_amount, savings)
+        self.assertEqual(session.current_time, 0)
+
+    def test_locked_users_are_not_copied_by_month_forward(self):
+        session = Session()
+        user = User(session, savings=1000)
+        session.add_user(user)
+        user.status = UserStatusSavingEnum.LOCKED
+        fork = session.fork()
+        fork.notifications = SilentSink()
+        admin.handle_month_forward_action(fork)
+        self.assertIs(fork.users[0], user)
+
+    def test_fork_detects_changes_of_base_session(self):
+        session = Session()
+        session.populate_db(5, seed=8)
+        fork = session.fork()
+        session.users[0].deposit_savings(100)
+        with self.assertRaises(RuntimeError):
+            fork.writable_user(0)
+
+    def test_removing_and_replacing_users_of_fork_keeps_base_intact(self):
+        session = Session(check_consistency=True)
+        session.populate_db(10, seed=12)
+        session.notifications = SilentSink()
+        fork = session.fork()
+        removed_user = fork.users[0]
+        fork.remove_user(removed_user)
+        fork.users = fork.users[:5]
+        fork.verify_totals()
+        self.assertTrue(all(user._session is session for user in session.users))
+        removed_user.deposit_savings(100)
+        session.verify_totals()
+
+    def test_users_found_in_fork_are_copies(self):
+        session = Session()
+        session.populate_db(5, seed=13)
+        fork = session.fork()
+        user = fork.get_user(session.users[2].username)
+        self.assertIsNot(user, session.users[2])
+        self.assertIs(fork.users[2], user)
+        self.assertIs(fork.get_user(user.username), user)
+
+    def test_users_are_found_by_position_after_fork_changes(self):
+        session = Session()
+        session.populate_db(8, seed=14)
+        fork = session.fork()
+        fork.remove_user(fork.users[1])
+        fork.add_user(User(fork, savings=100))
+        for i, user in enumerate(list(fork.users)):
+            found = fork.get_user(user.username)
+            self.assertIs(fork.users[i], found)
+            self.assertIs(found._session, fork)
+        self.assertEqual(fork._user_positions, {user.username: i for i, user in enumerate(fork.users)})
+
+
+class StressTestTest(unittest.TestCase):
+    def test_stress_test_without_customer_activity_matches_simulation(self):
+        session = Session()
+        session.populate_db(50, seed=9)
+        idle = CustomerBehaviour(deposit_probability=0, withdrawal_probability=0, loan_probability=0,
+                                 default_probability=0)
+        results = run_stress_test(session, 24, n_scenarios=3, behaviour=idle, seed=1, workers=1)
+        reports = simulate(session, 24)
+        self.assertEqual([month.median for month in results], [report.money_in_bank for report in reports])
+        self.assertEqual([month.probability_bankrupt for month in results], [0.0] * 24)
+
+    def test_stress_test_results_do_not_depend_on_workers(self):
+        session = Session()
+        session.populate_db(30, seed=10)
+        in_process = run_stress_test(session, 12, n_scenarios=8, seed=2, workers=1)
+        in_pool = run_stress_test(session, 12, n_scenarios=8, seed=2, workers=2)
+        self.assertEqual(in_process, in_pool)
+        self.assertEqual(session.current_time, 0)
+
+    def test_bankrupt_probability_is_cumulative(self):
+        session = Session()
+        session.initial_money_in_bank = 0
+        session.populate_db(30, seed=11)
+        results = run_stress_test(session, 36, n_scenarios=20, seed=3, workers=1)
+        for previous, month in zip(results, results[1:]):
+            self.assertGreaterEqual(month.probability_bankrupt, previous.probability_bankrupt)
+            self.assertGreaterEqual(month.probability_bankrupt, month.probability_negative)
+
+
+class SQLiteStorageTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "bank.sqlite")
+
+    def _saved_session(self):
+        session = Session()
+        session.populate_db(30, seed=12)
+        session.notifications = SilentSink()
+        for _ in range(13):
+            admin.handle_month_forward_action(session)
+        storage = SQLiteStorage(self.path)
+        storage.save(session)
+        storage.close()
+        return session
+
+    def test_session_is_opened_without_loading_users(self):
+        session = self._saved_session()
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        stored_session = storage.open_session()
+        self.assertEqual(stored_session._users, [])
+        self.assertEqual(stored_session.current_time, 13)
+        self.assertEqual(stored_session.money_in_bank, session.money_in_bank)
+        self.assertEqual(stored_session.total_user_loans, session.total_user_loans)
+
+    def test_stored_session_can_be_forked(self):
+        session = self._saved_session()
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        stored_session = storage.open_session()
+        reports = simulate(stored_session, 3)
+        self.assertEqual([report.money_in_bank for report in reports],
+                         [report.money_in_bank for report in simulate(session, 3)])
+        fork = stored_session.fork()
+        self.assertEqual(len(fork.users), 30)
+        self.assertIsNone(fork.get_user("nobody"))
+
+    def test_users_are_restored_as_they_were(self):
+        session = self._saved_session()
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        stored_session = storage.open_session(check_consistency=True)
+        user = stored_session.get_user(session.users[5].username)
+        self.assertEqual(repr(user), repr(session.users[5]))
+        self.assertEqual(len(stored_session._users), 1)
+        self.assertEqual([repr(user) for user in stored_session.users], [repr(user) for user in session.users])
+        stored_session.verify_totals()
+
+    def test_changes_are_saved(self):
+        session = self._saved_session()
+        storage = SQLiteStorage(self.path)
+        stored_session = storage.open_session()
+        active_user = next(user for user in session.users if user.status == UserStatusSavingEnum.ACTIVE)
+        user = stored_session.get_user(active_user.username)
+        user.deposit_savings(1000)
+        stored_session.add_user(User(stored_session, savings=500))
+        storage.save(stored_session)
+        storage.close()
+
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        reopened_session = storage.open_session(check_consistency=True)
+        self.assertEqual(reopened_session.get_user(user.username).savings_account.savings_amount,
+                         user.savings_account.savings_amount)
+        self.assertEqual(len(reopened_session.users), 31)
+        self.assertEqual(reopened_session.money_in_bank, session.money_in_bank + 1500)
+
+    def test_removed_users_are_deleted(self):
+        session = self._saved_session()
+        storage = SQLiteStorage(self.path)
+        stored_session = storage.open_session()
+        stored_session.remove_user(stored_session.get_user(session.users[2].username))
+        storage.save(stored_session)
+        storage.close()
+
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        reopened_session = storage.open_session(check_consistency=True)
+        self.assertIsNone(reopened_session.get_user(session.users[2].username))
+        self.assertEqual(len(reopened_session.users), 29)
+
+    def test_policy_is_saved(self):
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        self.assertEqual(storage.open_session().policy, DEFAULT_POLICY)
+        session = Session()
+        session.policy = Policy(loan_term_months=6, max_loans=5)
+        storage.save(session)
+        reopened_storage = SQLiteStorage(self.path)
+        self.addCleanup(reopened_storage.close)
+        self.assertEqual(reopened_storage.open_session().policy, Policy(loan_term_months=6, max_loans=5))
+
+    def test_database_without_policy_uses_default_policy(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE bank (id INTEGER PRIMARY KEY CHECK (id = 1), time_in_months INTEGER NOT NULL, "
+                           "initial_money_in_bank REAL NOT NULL, total_user_savings_cents INTEGER NOT NULL, "
+                           "total_user_loans_cents INTEGER NOT NULL)")
+        connection.execute("INSERT INTO bank VALUES (1, 3, 1000, 0, 0)")
+        connection.commit()
+        connection.close()
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        session = storage.open_session()
+        self.assertEqual((session.current_time, session.policy), (3, DEFAULT_POLICY))
+
+    def test_username_of_removed_user_can_be_taken_by_new_user(self):
+        session = self._saved_session()
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        stored_session = storage.open_session(check_consistency=True)
+        username = session.users[-1].username
+        stored_session.remove_user(stored_session.get_user(username))
+        stored_session.add_user(User.restore("New Customer", username, SavingsAccount.restore(50_000, 0.05), [],
+                                             UserStatusSavingEnum.ACTIVE))
+        storage.save(stored_session)
+        self.assertEqual(len(stored_session.users), 30)
+
+        reopened_storage = SQLiteStorage(self.path)
+        self.addCleanup(reopened_storage.close)
+        reopened_session = reopened_storage.open_session(check_consistency=True)
+        self.assertEqual(reopened_session.get_user(username).full_name, "New Customer")
+        self.assertEqual(len(reopened_session.users), 30)
+        reopened_session.verify_totals()
+
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "bank.snapshot")
+        self.session = Session()
+        self.session.populate_db(40, seed=22)
+        self.session.notifications = SilentSink()
+        for _ in range(13):
+            admin.handle_month_forward_action(self.session)
+        self.session.save(self.path)
+
+    def test_session_is_loaded_without_users(self):
+        loaded_session = Session.load(self.path)
+        self.assertEqual(loaded_session._users, [])
+        self.assertEqual(loaded_session.current_time, 13)
+        self.assertEqual(loaded_session.money_in_bank, self.session.money_in_bank)
+        self.assertEqual(loaded_session.total_user_loans, self.session.total_user_loans)
+
+    def test_users_are_restored_as_they_were(self):
+        loaded_session = Session.load(self.path, check_consistency=True)
+        user = loaded_session.get_user(self.session.users[7].username)
+        self.assertEqual(repr(user), repr(self.session.users[7]))
+        self.assertIsNone(loaded_session.get_user("nobody"))
+        self.assertEqual(len(loaded_session._users), 1)
+        self.assertEqual([repr(user) for user in loaded_session.users], [repr(user) for user in self.session.users])
+        loaded_session.verify_totals()
+
+    def test_loaded_session_can_be_changed_and_saved_over_its_snapshot(self):
+        loaded_session = Session.load(self.path, check_consistency=True)
+        removed_user = loaded_session.get_user(self.session.users[0].username)
+        loaded_session.remove_user(removed_user)
+        loaded_session.add_user(User(loaded_session, savings=500))
+        admin.handle_month_forward_action(loaded_session)
+        loaded_session.save(self.path)
+
+        reloaded_session = Session.load(self.path)
+        self.assertEqual([repr(user) for user in reloaded_session.users],
+                         [repr(user) for user in loaded_session.users])
+        self.assertIsNone(reloaded_session.get_user(removed_user.username))
+        self.assertEqual(reloaded_session.money_in_bank, loaded_session.money_in_bank)
+
+    def test_loaded_session_can_be_simulated(self):
+        self.assertEqual(simulate(Session.load(self.path), 2), simulate(self.session, 2))
+
+    def test_policy_is_saved_with_the_snapshot(self):
+        self.session.policy = Policy(loan_term_months=6)
+        self.session.save(self.path)
+        self.assertEqual(Session.load(self.path).policy, Policy(loan_term_months=6))
+        self.assertEqual(ReadOnlySession(self.path).policy, Policy(loan_term_months=6))
+
+    def test_detached_loans_expire_under_the_policy_of_the_report(self):
+        session = Session()
+        session.policy = Policy(loan_term_months=6)
+        session.add_user(User(session, loans=[Loan(1000, 0, session.policy)], savings=100))
+        session.current_time = 4
+        session.save(self.path)
+        report = ReadOnlySession(self.path)
+        user, = report.list_users(loans_expiring_within=3)
+        self.assertIsNone(user.loans[0]._session)
+        self.assertEqual(user.loans[0].expires_in(report), 2)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            user.loans[0].pretty_print_loan(report)
+        self.assertIn("expires in: 2 months", output.getvalue())
+
+
+class ReadOnlySessionTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "bank.snapshot")
+        self.session = Session()
+        self.session.notifications = SilentSink()
+        for month in range(3):
+            self.session.populate_db(40, seed=23 + month)
+            admin.handle_month_forward_action(self.session)
+        self.session.current_time = 13
+        admin.handle_month_forward_action(self.session)
+        self.session.save(self.path)
+        self.report = ReadOnlySession(self.path)
+
+    def test_figures_match_the_session(self):
+        session, report = self.session, self.report
+        self.assertEqual(report.money_in_bank, session.money_in_bank)
+        self.assertEqual(report.total_user_savings, session.total_user_savings)
+        self.assertEqual(report.total_user_loans, session.total_user_loans)
+        self.assertEqual(report.total_user_personal_savings, session.total_user_personal_savings)
+        self.assertEqual(report.status_counts, {status: sum(user.status == status for user in session.users)
+                                                for status in UserStatusSavingEnum})
+        self.assertEqual(sum(report.status_counts.values()), 120)
+
+    def test_lists_match_the_session(self):
+        for filters in [{}, {"status": UserStatusSavingEnum.OVERDUE_LOANS}, {"min_total_loans": 4_000},
+                        {"loans_expiring_within": 2}]:
+            self.assertCountEqual([repr(user) for user in self.report.iter_users(**filters)],
+                                  [repr(user) for user in self.session.iter_users(**filters)])
+            matching_users = set(map(id, self.session.iter_users(**filters)))
+            self.assertEqual([repr(user) for user in self.report.list_users(0, 1000, **filters)],
+                             [repr(user) for user in self.session.users if id(user) in matching_users])
+            for sort_by in USER_SORT_KEYS:
+                for descending in [False, True]:
+                    self.assertEqual(
+                        [repr(user) for user in self.report.list_users(1, 15, sort_by, descending, **filters)],
+                        [repr(user) for user in self.session.list_users(1, 15, sort_by, descending, **filters)])
+        self.assertEqual(repr(self.report.get_user(self.session.users[3].username)), repr(self.session.users[3]))
+
+    def test_reporting_mode_shows_the_dashboard(self):
+        output = io.StringIO()
+        with unittest.mock.patch("builtins.input", side_effect=["1", "5", "exit", "2"]), \
+                contextlib.redirect_stdout(output):
+            admin.handle_reporting_mode(self.report)
+        self.assertIn(f"money in the bank is €{self.session.money_in_bank:.2f}", output.getvalue())
+        top_debtor = max(self.session.users, key=lambda user: (user.total_loans_cents, user.username))
+        self.assertIn(f"1 - {top_debtor.full_name}", output.getvalue())
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshot_path = os.path.join(directory.name, "bank.sqlite")
+        self.journal_path = os.path.join(directory.name, "bank.journal")
+
+    @staticmethod
+    def _state(session):
+        return (session.current_time, session.total_user_savings_cents, session.total_user_loans_cents,
+                sorted((user.username, user.full_name, user.status, user.savings_account.savings_cents,
+                        user.savings_account.interest_rate,
+                        [(loan.sum_cents, loan.initiated_at, loan.interest_rate) for loan in user.loans])
+                       for user in session.users))
+
+    def _journaled_session(self):
+        session = Session()
+        session.notifications = SilentSink()
+        session.populate_db(40, seed=16)
+        storage = SQLiteStorage(self.snapshot_path)
+        storage.save(session)
+        storage.close()
+        journal = Journal(self.journal_path)
+        journal.attach(session)
+
+        active_users = [user for user in session.users if user.status == UserStatusSavingEnum.ACTIVE]
+        active_users[0].deposit_savings(123.45)
+        active_users[1].withdraw_savings(session, 10)
+        borrower = next(user for user in active_users if len(user.loans) < 3)
+        borrower.add_loan(session, Loan.create_loan_object(session, 2500))
+        borrower.pay_loan(session, borrower.loans[-1], 100)
+        borrower.pay_loan(session, borrower.loans[-1], borrower.loans[-1].sum)
+        for _ in range(13):
+            admin.handle_month_forward_action(session)
+        vectorized_engine.month_forward_vectorized(session)
+        session.remove_user(session.users[3])
+        session.populate_db(6, seed=17)
+        journal.close()
+        return session
+
+    def test_replay_rebuilds_session_from_snapshot(self):
+        session = self._journaled_session()
+        storage = SQLiteStorage(self.snapshot_path)
+        self.addCleanup(storage.close)
+        recovered = replay(storage.open_session(check_consistency=True), self.journal_path)
+        recovered.verify_totals()
+        self.assertEqual(self._state(recovered), self._state(session))
+        self.assertEqual(recovered.money_in_bank, session.money_in_bank)
+
+    def test_journal_is_typed_and_tolerates_cut_off_record(self):
+        self._journaled_session()
+        events = list(read_journal(self.journal_path))
+        event_types = {event_type for event_type, _ in events}
+        self.assertTrue({EventType.SAVINGS_CHANGED, EventType.LOAN_OPENED, EventType.LOAN_CLOSED,
+                         EventType.STATUS_CHANGED, EventType.USER_REMOVED, EventType.USER_ADDED,
+                         EventType.TIME_CHANGED} <= event_types)
+        with open(self.journal_path, "rb+") as file:
+            file.truncate(os.path.getsize(self.journal_path) - 3)
+        self.assertEqual(list(read_journal(self.journal_path)), events[:-1])
+
+    def test_closed_journal_stops_journaling_the_session(self):
+        session = self._journaled_session()
+        self.assertIsNone(session.journal)
+        journal_size = os.path.getsize(self.journal_path)
+        next(user for user in session.users if user.status == UserStatusSavingEnum.ACTIVE).deposit_savings(10)
+        self.assertEqual(os.path.getsize(self.journal_path), journal_size)
+
+    def test_events_are_written_at_month_end(self):
+        session = Session()
+        session.notifications = SilentSink()
+        session.populate_db(10, seed=18)
+        journal = Journal(self.journal_path)
+        self.addCleanup(journal.close)
+        journal.attach(session)
+        session.users[0].deposit_savings(10)
+        admin.handle_month_forward_action(session)
+        events = list(read_journal(self.journal_path))
+        self.assertEqual(events[0][0], EventType.SAVINGS_CHANGED)
+        self.assertEqual(events[-1], (EventType.TIME_CHANGED, (1,)))
+
+    def test_failing_journal_keeps_totals_in_sync(self):
+        session = Session(check_consistency=True)
+        session.notifications = SilentSink()
+        session.populate_db(5, seed=19)
+        journal = Journal(self.journal_path)
+        self.addCleanup(journal.close)
+        journal.attach(session)
+        user = session.users[0]
+        with unittest.mock.patch.object(journal, "savings_changed", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                user.deposit_savings(10)
+        session.verify_totals()
+
+
+
+class BenchmarksTest(unittest.TestCase):
+    def test_benchmarks_report_every_benchmark_as_json(self):
+        report = json.loads(json.dumps(run_benchmarks([20], n_users=30, repeats=1, seed=3)))
+        self.assertEqual([result["name"] for result in report["results"]],
+                         ["populate_db", "handle_month_forward_action", "month_forward_vectorized",
+                          "month_forward_sharded", "sharded_bank_month_forward", "simulate_30_months",
+                          "money_in_bank", "add_loan", "withdraw_savings"] +
+                         ["concurrent_withdrawals_and_loans"] * 8)
+        for result in report["results"]:
+            self.assertNotIn("error", result)
+            self.assertGreater(result["median_seconds"], 0)
+        self.assertEqual(report["results"][0]["params"], {"n_users": 20})
+
+    def test_failing_benchmark_makes_the_suite_fail(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        output = os.path.join(directory.name, "results.json")
+        with unittest.mock.patch("benchmarks.simulate", side_effect=RuntimeError("broken")), \
+                unittest.mock.patch("benchmarks.QUICK_POPULATION_SIZES", [20]):
+            with self.assertRaises(SystemExit) as raised:
+                benchmarks.main(["--quick", "--users", "20", "--repeats", "1", "--output", output])
+        self.assertEqual(raised.exception.code, "Failed benchmarks: simulate_30_months")
+        with open(output) as file:
+            self.assertIn("RuntimeError: broken", file.read())
+
+
+class TransactionsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.session = Session()
+        self.session.notifications = SilentSink()
+        self.user = User(self.session, savings=1000)
+        self.session.add_user(self.user)
+        self.locked_user = User(self.session, savings=1000)
+        self.session.add_user(self.locked_user)
+        self.locked_user.status = UserStatusSavingEnum.LOCKED
+
+    def test_csv_batch_applies_valid_and_reports_rejected_transactions(self):
+        path = os.path.join(self.directory, "day.csv")
+        with open(path, "w") as file:
+            file.write("user,action,amount,loan\n"
+                       f"{self.user.username},deposit,500,\n"
+                       f"{self.user.username},take_a_loan,2000,\n"
+                       f"{self.user.username},pay_a_loan,100.004,1\n"
+                       f"{self.user.username},withdraw,0.5,\n"
+                       f"{self.locked_user.username},deposit,500,\n"
+                       "nobody,deposit,500,\n"
+                       f"{self.user.username},refund,500,\n"
+                       f"{self.user.username},pay_a_loan,100,2\n")
+        report = run_batch(self.session, read_transactions(path))
+        self.assertEqual(report.applied, 3)
+        self.assertEqual([number for number, _ in report.rejected], [4, 5, 6, 7, 8])
+        self.assertEqual(self.user.savings_account.savings_amount, 1000 + 500 + 2000 - 100)
+        self.assertEqual(self.user.loans[0].sum, 1900)
+        self.assertEqual(self.locked_user.savings_account.savings_amount, 1000)
+        self.assertGreater(report.transactions_per_second, 0)
+
+    def test_jsonl_batch_follows_user_panel_rules(self):
+        path = os.path.join(self.directory, "day.jsonl")
+        with open(path, "w") as file:
+            for amount in [100, 100, 100, 100]:
+                file.write(json.dumps({"user": self.user.username, "action": "take_a_loan", "amount": amount}) + "\n")
+        report = run_batch(self.session, read_transactions(path))
+        self.assertEqual(report.applied, 3)
+        self.assertEqual(report.rejected, [(4, "User can not have more than 3 loans concurrently")])
+        self.user.status = UserStatusSavingEnum.OVERDUE_LOANS
+        report = run_batch(self.session, [
+            Transaction(self.user.username, TransactionActionEnum.WITHDRAW, 10),
+            Transaction(self.user.username, TransactionActionEnum.DEPOSIT, 10)])
+        self.assertEqual(report.applied, 1)
+        self.assertEqual(report.rejected, [(1, "User has unpaid loans")])
+
+
+class BankServerTest(unittest.TestCase):
+    @staticmethod
+    async def _request(port, request):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        writer.close()
+        return response
+
+    def test_concurrent_withdrawals_do_not_overdraw_the_bank(self):
+        session = Session(check_consistency=True)
+        for _ in range(10):
+            session.add_user(User(session, savings=1000))
+        session.initial_money_in_bank = -9_000  # the bank has €1000 left
+
+        async def scenario():
+            server = BankServer(session)
+            await server.start()
+            port = server.address[1]
+            responses = await asyncio.gather(*[
+                self._request(port, {"id": i, "op": "withdraw", "user": user.username, "amount": 300})
+                for i, user in enumerate(session.users)])
+            bank = await self._request(port, {"op": "bank"})
+            await server.close()
+            return responses, bank
+
+        responses, bank = asyncio.run(scenario())
+        self.assertEqual(sum(response["ok"] for response in responses), 3)
+        self.assertEqual(bank["result"]["money_in_bank"], 100)
+        self.assertEqual(sorted(response["id"] for response in responses), list(range(10)))
+
+    def test_load_generator_measures_requests_per_second(self):
+        session = Session(check_consistency=True)
+        session.populate_db(30, seed=18)
+
+        async def scenario():
+            server = BankServer(session)
+            await server.start()
+            report = await run_load("127.0.0.1", server.address[1], clients=20, requests_per_client=10, seed=1)
+            unknown = await self._request(server.address[1], {"id": 7, "op": "rob_the_bank"})
+            await server.close()
+            return report, unknown, server.operations
+
+        report, unknown, operations = asyncio.run(scenario())
+        self.assertEqual(report.requests, 200)
+        self.assertGreater(report.operations_per_second, 0)
+        self.assertEqual(operations, 1 + 200 + 1)
+        self.assertEqual(unknown, {"id": 7, "ok": False, "error": "Unknown operation 'rob_the_bank'"})
+        session.verify_totals()
+        self.assertGreaterEqual(session.money_in_bank, 0)
+
+    def test_user_locks_are_dropped_after_requests(self):
+        session = Session()
+        session.populate_db(3, seed=19)
+
+        async def scenario():
+            server = BankServer(session)
+            await server.start()
+            responses = await asyncio.gather(*[
+                self._request(server.address[1], {"op": "deposit", "user": f"nobody_{i}", "amount": 10})
+                for i in range(50)])
+            await self._request(server.address[1], {"op": "deposit", "user": session.users[0].username, "amount": 10})
+            await server.close()
+            return responses, len(server._user_locks)
+
+        responses, n_locks = asyncio.run(scenario())
+        self.assertFalse(any(response["ok"] for response in responses))
+        self.assertEqual(n_locks, 0)
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,174 @@
+import argparse
+import csv
+import enum
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from entities import Session, Loan, User, UserStatusSavingEnum
+from storage import SQLiteStorage
+from utils import IOUtils, SilentSink
+
+
+class TransactionActionEnum(str, enum.Enum):
+    DEPOSIT = "deposit"
+    WITHDRAW = "withdraw"
+    TAKE_A_LOAN = "take_a_loan"
+    PAY_A_LOAN = "pay_a_loan"
+
+
+@dataclass
+class Transaction:
+    """Customer operation of the user panel, without the prompts"""
+    username: str
+    action: TransactionActionEnum
+    amount: float
+    loan: int = 1  # number of the loan to pay, as in the user panel menu (starting from 1)
+
+
+@dataclass
+class BatchReport:
+    applied: int = 0
+    rejected: List[Tuple[int, str]] = field(default_factory=list)  # number of the transaction (from 1) and reason
+    seconds: float = 0.0
+
+    @property
+    def transactions_per_second(self) -> float:
+        total = self.applied + len(self.rejected)
+        return total / self.seconds if self.seconds else 0.0
+
+
+def _check_amount(amount: float, lower_bound: float, upper_bound: float) -> float:
+    """Same bounds and rounding as the amounts entered in the user panel (see IOUtils.input_float)"""
+    amount = IOUtils.round_float_to_2_decimal_places(amount)
+    if amount < lower_bound:
+        raise ValueError(f"Amount must be at least {lower_bound}")
+    if amount > upper_bound:
+        raise ValueError(f"Amount must be at most {upper_bound}")
+    return amount
+
+
+def deposit(user: User, amount: float):
+    user.deposit_savings(_check_amount(amount, 1, 1_000_000))
+
+
+def withdraw(session: Session, user: User, amount: float):
+    if user.savings_account.savings_amount <= 0:
+        raise ValueError("You have no money in your savings account. Thus it is not possible to withdraw money.")
+    user.withdraw_savings(session, _check_amount(amount, 1, user.savings_account.savings_amount))
+
+
+def take_a_loan(session: Session, user: User, amount: float):
+    policy = session.policy
+    if len(user.loans) >= policy.max_loans:
+        raise ValueError(f"User can not have more than {policy.max_loans} loans concurrently")
+    user.add_loan(session, Loan.create_loan_object(session, _check_amount(amount, 1, policy.max_loan_amount)))
+
+
+def pay_a_loan(session: Session, user: User, amount: float, loan_number: int = 1):
+    if len(user.loans) == 0:
+        raise ValueError("You have no loans")
+    if user.savings_account.savings_amount <= 0:
+        raise ValueError(
+            "You have no money in your savings account. Thus it is not possible to pay a loan. Deposit money first.")
+    if not 1 <= loan_number <= len(user.loans):
+        raise ValueError(f"There is no loan number {loan_number}")
+    loan = user.loans[loan_number - 1]
+    user.pay_loan(session, loan, _check_amount(amount, 0.01, loan.sum))
+
+
+def execute(session: Session, transaction: Transaction):
+    """Apply the transaction with the same rules as the user panel. Raises ValueError if it is rejected."""
+    user = session.get_user(transaction.username)
+    if user is None:
+        raise ValueError(f"There is no user with username '{transaction.username}'")
+    # The user panel offers nothing to locked users, and only deposits and payments to users with overdue loans
+    if user.status == UserStatusSavingEnum.LOCKED:
+        raise ValueError("This account is locked")
+    if user.status == UserStatusSavingEnum.OVERDUE_LOANS and transaction.action in [
+            TransactionActionEnum.WITHDRAW, TransactionActionEnum.TAKE_A_LOAN]:
+        raise ValueError("User has unpaid loans")
+
+    if transaction.action == TransactionActionEnum.DEPOSIT:
+        deposit(user, transaction.amount)
+    elif transaction.action == TransactionActionEnum.WITHDRAW:
+        withdraw(session, user, transaction.amount)
+    elif transaction.action == TransactionActionEnum.TAKE_A_LOAN:
+        take_a_loan(session, user, transaction.amount)
+    elif transaction.action == TransactionActionEnum.PAY_A_LOAN:
+        pay_a_loan(session, user, transaction.amount, transaction.loan)
+
+
+def parse_transaction(record: Dict[str, object]) -> Transaction:
+    """Build a transaction from a record with the keys user, action, amount and, for payments, optionally loan"""
+    try:
+        return Transaction(
+            username=str(record["user"]),
+            action=TransactionActionEnum(str(record["action"]).strip().lower()),
+            amount=float(record["amount"]),
+            loan=int(record.get("loan") or 1),
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Malformed transaction {record}: {e}")
+
+
+def read_transactions(path: str) -> Iterator[Dict[str, object]]:
+    """Read transaction records from a CSV file with a header row, or from a JSON lines file (*.jsonl)"""
+    with open(path, newline="") as file:
+        if path.endswith(".jsonl"):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+
+def run_batch(session: Session, transactions: Iterable[Union[Transaction, Dict[str, object]]]) -> BatchReport:
+    """Apply the transactions in order; rejected and malformed transactions are reported and skipped"""
+    report = BatchReport()
+    start = time.perf_counter()
+    for number, transaction in enumerate(transactions, start=1):
+        try:
+            if not isinstance(transaction, Transaction):
+                transaction = parse_transaction(transaction)
+            execute(session, transaction)
+        except ValueError as e:
+            report.rejected.append((number, str(e)))
+        else:
+            report.applied += 1
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Apply a file of customer transactions (CSV or JSON lines with "
+                                                 "user, action, amount and optionally loan) to the bank.")
+    parser.add_argument("transactions", help="CSV file with a header row, or a *.jsonl file")
+    parser.add_argument("--db", help="SQLite database of the bank; changes are saved. Without it a demo bank is used.")
+    parser.add_argument("--users", type=int, default=100, help="number of users of the demo bank")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the demo bank")
+    args = parser.parse_args(argv)
+
+    storage = None
+    if args.db:
+        storage = SQLiteStorage(args.db)
+        session = storage.open_session()
+    else:
+        session = Session()
+        session.populate_db(args.users, seed=args.seed)
+    session.notifications = SilentSink()
+
+    report = run_batch(session, read_transactions(args.transactions))
+    if storage is not None:
+        storage.save(session)
+        storage.close()
+
+    print(f"Applied {report.applied} and rejected {len(report.rejected)} transactions in {report.seconds:.3f} s "
+          f"({report.transactions_per_second:.0f} transactions per second).")
+    for number, reason in report.rejected:
+        print(f" * Transaction {number} was rejected: {reason}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import enum
+from typing import Optional
 
 from entities import Session, UserStatusSavingEnum, LoanStatusEnum, User, Loan
 from utils import IOUtils
@@ -66,11 +67,12 @@ def handle_user_withdraw_money_action(session, user: User):
 
 
 def handle_user_take_a_loan_action(session: Session, user: User):
-    if len(user.loans) >= 3:
-        print("User can not have more than 3 loans concurrently")
+    policy = session.policy
+    if len(user.loans) >= policy.max_loans:
+        print(f"User can not have more than {policy.max_loans} loans concurrently")
         return
-    loan_amount = IOUtils.input_float("Enter the amount of the loan (at least €1 and at most €10000): ", lower_bound=1,
-                                      upper_bound=10_000)
+    prompt = f"Enter the amount of the loan (at least €1 and at most €{policy.max_loan_amount:.0f}): "
+    loan_amount = IOUtils.input_float(prompt, lower_bound=1, upper_bound=policy.max_loan_amount)
     new_loan = Loan.create_loan_object(session, loan_amount)
     try:
         user.add_loan(session, new_loan)
@@ -113,13 +115,26 @@ class UserActionEnum(enum.Enum):
     LOGOUT = 5
 
 
+def log_in(session: Session) -> Optional[User]:
+    """Ask for a username until an existing user is entered. Returns None if the user decides to go back."""
+    print("Log in as a user (usernames are shown in the administrator mode under 'View all users'):")
+    while True:
+        username = IOUtils.input_str("Enter your username (leave empty to go back): ").strip()
+        if not username:
+            return None
+        user = session.get_user(username)
+        if user is None:
+            print(f"There is no user with username '{username}'. Try again.")
+            continue
+        return user
+
+
 def handle_user_mode(session: Session):
     IOUtils.print_header("Welcome to the user mode!")
-    print("Log in as a user:")
-    for i, user in enumerate(session.users):
-        print(f"{i + 1} - {user.full_name}")
-    user_index = IOUtils.input_int("Enter the number of the user: ", upper_bound=len(session.users), lower_bound=1)
-    user = session.users[user_index - 1]
+    user = log_in(session)
+    if user is None:
+        print("Going back...")
+        return
 
     IOUtils.print_section(f"Hello, {user.full_name}!")
     while True:
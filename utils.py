@@ -75,3 +75,43 @@ class IOUtils:
     @staticmethod
     def print_section(message: str):
         print("-" * 10 + message + "-" * 10)
+
+
+class MoneyUtils:
+    """Helpers for money amounts, which are kept as integer numbers of cents to make the arithmetic exact"""
+
+    @staticmethod
+    def to_cents(amount: float) -> int:
+        """Function that converts the amount in euros to cents, rounding it to the nearest cent"""
+        return round(amount * 100)
+
+    @staticmethod
+    def to_euros(cents: int) -> float:
+        return cents / 100
+
+    @staticmethod
+    def monthly_interest(cents: int, annual_interest_rate: float) -> int:
+        """Function that returns the interest for one month at the annual interest rate, rounded to the nearest cent"""
+        return round(cents * (annual_interest_rate / 12))
+
+    @staticmethod
+    def with_monthly_interest(cents: int, annual_interest_rate: float) -> int:
+        """Function that returns the amount after one month at the annual interest rate, rounded to the nearest cent"""
+        return round(cents * (1 + annual_interest_rate / 12))
+
+
+class NotificationSink:
+    """Receives the messages of the domain methods (deposits, loan payments, month-end events) and prints them
+
+    A message is a str.format template with its arguments, so it is formatted only if it is actually shown.
+    """
+
+    def notify(self, message: str, *args):
+        print(message.format(*args) if args else message)
+
+
+class SilentSink(NotificationSink):
+    """Sink that drops all messages, for simulations and other headless runs"""
+
+    def notify(self, message: str, *args):
+        pass
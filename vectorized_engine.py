@@ -0,0 +1,422 @@
+import copy
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from entities import Session, User, UserStatusSavingEnum, LoanStatusEnum
+from policy import DEFAULT_POLICY, Policy
+from utils import MoneyUtils
+
+# Integer codes of the user statuses as they are stored in the status column
+ACTIVE, OVERDUE_LOANS, LOCKED = 0, 1, 2
+STATUS_CODES = {
+    UserStatusSavingEnum.ACTIVE: ACTIVE,
+    UserStatusSavingEnum.OVERDUE_LOANS: OVERDUE_LOANS,
+    UserStatusSavingEnum.LOCKED: LOCKED,
+}
+STATUSES = {code: status for status, code in STATUS_CODES.items()}
+COLUMNS = ["savings_cents", "savings_interest_rate", "status", "loan_sum_cents", "loan_interest_rate",
+           "loan_initiated_at", "loan_present", "loan_term_months", "base_savings_interest_rate",
+           "large_savings_interest_rate", "large_savings_threshold_cents"]
+
+
+def monthly_interest(cents: np.ndarray, annual_interest_rates: np.ndarray) -> np.ndarray:
+    """Vectorized version of MoneyUtils.monthly_interest
+
+    np.rint rounds half to even like the built-in round, so the results are exactly the same.
+    """
+    return np.rint(cents * (annual_interest_rates / 12)).astype(np.int64)
+
+
+def with_monthly_interest(cents: np.ndarray, annual_interest_rates: np.ndarray) -> np.ndarray:
+    """Vectorized version of MoneyUtils.with_monthly_interest"""
+    return np.rint(cents * (1 + annual_interest_rates / 12)).astype(np.int64)
+
+
+class BankColumns:
+    """Column-oriented copy of the bank state used to advance all users at once
+
+    Every user is a row and money is stored in integer cents. Loans are stored in fixed-width 2D columns (one slot per loan of the user, in the same order as
+    in User.loans); free slots have loan_present set to False. The parts of the policy that the month step depends on
+    are columns as well (see set_policy), so rows under different policies can be stepped together.
+
+    Usage example:
+    >>> columns = BankColumns.from_session(session)
+    >>> columns.step()  # one month ahead for the whole bank
+    >>> columns.apply_to_session(session)
+    """
+    users: List[User]
+    current_time: int
+    savings_cents: np.ndarray
+    savings_interest_rate: np.ndarray
+    status: np.ndarray
+    loan_sum_cents: np.ndarray
+    loan_interest_rate: np.ndarray
+    loan_initiated_at: np.ndarray
+    loan_present: np.ndarray
+    loan_term_months: np.ndarray
+    base_savings_interest_rate: np.ndarray
+    large_savings_interest_rate: np.ndarray
+    large_savings_threshold_cents: np.ndarray
+
+    def __init__(self, users: List[User], current_time: int, policy: Policy = DEFAULT_POLICY):
+        n_users = len(users)
+        n_slots = max([len(user.loans) for user in users], default=0)
+        self.users = list(users)
+        self.current_time = current_time
+        self.savings_cents = np.array([user.savings_account.savings_cents for user in users], dtype=np.int64)
+        self.savings_interest_rate = np.array([user.savings_account.interest_rate for user in users],
+                                              dtype=np.float64)
+        self.status = np.array([STATUS_CODES[user.status] for user in users], dtype=np.int8)
+        self.loan_sum_cents = np.zeros((n_users, n_slots), dtype=np.int64)
+        self.loan_interest_rate = np.zeros((n_users, n_slots), dtype=np.float64)
+        self.loan_initiated_at = np.zeros((n_users, n_slots), dtype=np.int64)
+        self.loan_present = np.zeros((n_users, n_slots), dtype=bool)
+        for i, user in enumerate(users):
+            for j, loan in enumerate(user.loans):
+                self.loan_sum_cents[i, j] = loan.sum_cents
+                self.loan_interest_rate[i, j] = loan.interest_rate
+                self.loan_initiated_at[i, j] = loan.initiated_at
+                self.loan_present[i, j] = True
+        self.loan_term_months = np.empty(n_users, dtype=np.int64)
+        self.base_savings_interest_rate = np.empty(n_users, dtype=np.float64)
+        self.large_savings_interest_rate = np.empty(n_users, dtype=np.float64)
+        self.large_savings_threshold_cents = np.empty(n_users, dtype=np.int64)
+        self.set_policy(slice(None), policy)
+        self._initial_columns = self._columns()
+
+    def set_policy(self, rows, policy: Policy):
+        """Apply the policy to the given rows (an index, a mask or a slice) from now on"""
+        self.loan_term_months[rows] = policy.loan_term_months
+        self.base_savings_interest_rate[rows] = policy.savings_interest_rate
+        self.large_savings_interest_rate[rows] = policy.large_savings_interest_rate
+        self.large_savings_threshold_cents[rows] = MoneyUtils.to_cents(policy.large_savings_threshold)
+
+    def _savings_interest_rate_for(self, savings_cents: np.ndarray, rows) -> np.ndarray:
+        """Vectorized version of Policy.savings_interest_rate_for for the savings of the given rows"""
+        return np.where(savings_cents >= self.large_savings_threshold_cents[rows],
+                        self.large_savings_interest_rate[rows], self.base_savings_interest_rate[rows])
+
+    def _expires_at(self) -> np.ndarray:
+        """Month in which the loan in each slot expires (see Loan.expires_at)"""
+        return self.loan_initiated_at + self.loan_term_months[:, None]
+
+    def _columns(self) -> List[np.ndarray]:
+        return [self.savings_cents.copy(), self.savings_interest_rate.copy(), self.status.copy(),
+                self.loan_sum_cents.copy(), self.loan_present.copy()]
+
+    def changed_users(self) -> np.ndarray:
+        """Indices of the users whose state differs from the one the columns were built from"""
+        changed = np.zeros(len(self.savings_cents), dtype=bool)
+        for initial, current in zip(self._initial_columns, self._columns()):
+            difference = initial != current
+            changed |= difference.any(axis=1) if difference.ndim == 2 else difference
+        return np.flatnonzero(changed)
+
+    @staticmethod
+    def from_session(session: Session) -> "BankColumns":
+        return BankColumns(session.users, session.current_time, session.policy)
+
+    def detached_copy(self, n_slots: int = 0) -> "BankColumns":
+        """Copy of the columns that is not linked to the user objects, e.g. to step it in another process
+
+        The loan columns are widened to at least n_slots slots. A detached copy can not be applied to a session.
+        """
+        detached = copy.copy(self)
+        detached.users = []
+        for name in COLUMNS:
+            column = getattr(self, name)
+            if column.ndim == 2 and column.shape[1] < n_slots:
+                column = np.pad(column, [(0, 0), (0, n_slots - column.shape[1])])
+            setattr(detached, name, column.copy())
+        detached._initial_columns = detached._columns()
+        return detached
+
+    def shard(self, rows: np.ndarray) -> "BankColumns":
+        """Detached copy of the given rows, e.g. to step a part of the bank in another process (see merge_shard)"""
+        shard = copy.copy(self)
+        shard.users = []
+        for name in COLUMNS:
+            setattr(shard, name, getattr(self, name)[rows])
+        shard._initial_columns = []
+        return shard
+
+    def merge_shard(self, rows: np.ndarray, shard: "BankColumns"):
+        """Write back the rows of a shard that was stepped to the same time"""
+        for name in COLUMNS:
+            getattr(self, name)[rows] = getattr(shard, name)
+        self.current_time = shard.current_time
+
+    def expired_loans(self) -> np.ndarray:
+        """Mask of the loans that are expired at the current time (see Loan.is_expired)"""
+        return self.loan_present & (self._expires_at() <= self.current_time)
+
+    def step(self):
+        """Advance the whole bank one month ahead
+
+        Applies exactly the same rules as admin_panel._user_in_one_month does for a single user.
+        """
+        self.current_time += 1
+        status = self.status
+        expired = self.expired_loans()
+        has_expired_loans = expired.any(axis=1)
+
+        # Users that were in the grace period are either locked or reactivated
+        overdue = status == OVERDUE_LOANS
+        status[overdue & has_expired_loans] = LOCKED
+        status[overdue & ~has_expired_loans] = ACTIVE
+        not_locked = status != LOCKED
+
+        # Increase loans and savings by interest rate that was set at the beginning of the previous month
+        accruing_loans = self.loan_present & not_locked[:, None]
+        self.loan_sum_cents[accruing_loans] = with_monthly_interest(
+            self.loan_sum_cents[accruing_loans], self.loan_interest_rate[accruing_loans])
+        savings_cents = self.savings_cents[not_locked]
+        savings_cents += monthly_interest(savings_cents, self.savings_interest_rate[not_locked])
+        self.savings_cents[not_locked] = savings_cents
+        self.savings_interest_rate[not_locked] = self._savings_interest_rate_for(savings_cents, not_locked)
+
+        status[(status == ACTIVE) & has_expired_loans] = OVERDUE_LOANS
+
+        # Drain savings to cover expired loans, in the order of the loans, until the first one that can not be covered
+        draining = status == OVERDUE_LOANS
+        for slot in range(self.loan_sum_cents.shape[1]):
+            due = draining & expired[:, slot]
+            covered = due & (self.savings_cents >= self.loan_sum_cents[:, slot])
+            self.savings_cents[covered] -= self.loan_sum_cents[covered, slot]
+            self.loan_sum_cents[covered, slot] = 0
+            self.loan_present[covered, slot] = False
+            draining &= ~(due & ~covered)
+
+        # If all overdue loans were successfully paid, set status back to active
+        status[(status == OVERDUE_LOANS) & ~self.expired_loans().any(axis=1)] = ACTIVE
+
+    def fast_forward(self, months: int):
+        """Advance the whole bank the given number of months ahead, with the same result as calling step() that many
+        times
+
+        Only the users that may change their status (overdue users and users with loans that expire within the months)
+        are stepped with all the rules, and only until their last loan has expired and the grace period is over.
+        Locked users do not change at all. The rest of the time users only accrue interest, which is applied in a loop
+        that does nothing else; the interest is still rounded to a cent every month, and the savings interest rate
+        follows the amount of the savings.
+        """
+        expires_at = self._expires_at()
+        expiring = (self.loan_present & (expires_at <= self.current_time + months)).any(axis=1)
+        eventful = np.flatnonzero((self.status == OVERDUE_LOANS) | ((self.status == ACTIVE) & expiring))
+        self._accrue_interest(np.flatnonzero((self.status == ACTIVE) & ~expiring), months)
+
+        if len(eventful):
+            # A month after the last loan expired the users are either active with no expired loans or locked
+            last_expiry = expires_at[eventful][self.loan_present[eventful]].max(initial=self.current_time)
+            stepped_months = min(months, max(int(last_expiry) - self.current_time, 1) + 1)
+            subset = self.shard(eventful)
+            for _ in range(stepped_months):
+                subset.step()
+            for name in COLUMNS:
+                getattr(self, name)[eventful] = getattr(subset, name)
+            self._accrue_interest(eventful[subset.status == ACTIVE], months - stepped_months)
+
+        self.current_time += months
+
+    def _accrue_interest(self, rows: np.ndarray, months: int):
+        """Apply the monthly interest to the savings and loans of active users whose loans do not expire meanwhile"""
+        if not len(rows) or not months:
+            return
+        loans = self.loan_present[rows]
+        loan_sum_cents = self.loan_sum_cents[rows]
+        accrued_loans = loan_sum_cents[loans]
+        loan_interest_rate = self.loan_interest_rate[rows][loans]
+        savings_cents = self.savings_cents[rows]
+        savings_interest_rate = self.savings_interest_rate[rows]
+        large_savings_threshold_cents = self.large_savings_threshold_cents[rows]
+        base_savings_interest_rate = self.base_savings_interest_rate[rows]
+        large_savings_interest_rate = self.large_savings_interest_rate[rows]
+        for _ in range(months):
+            accrued_loans = with_monthly_interest(accrued_loans, loan_interest_rate)
+            savings_cents += monthly_interest(savings_cents, savings_interest_rate)
+            savings_interest_rate = np.where(savings_cents >= large_savings_threshold_cents,
+                                             large_savings_interest_rate, base_savings_interest_rate)
+        loan_sum_cents[loans] = accrued_loans
+        self.loan_sum_cents[rows] = loan_sum_cents
+        self.savings_cents[rows] = savings_cents
+        self.savings_interest_rate[rows] = savings_interest_rate
+
+    def apply_to_session(self, session: Session):
+        """Write the columns back to the users of the session the columns were built from
+
+        The users must not have been changed since the columns were built. Only the users that changed are written,
+        so users shared with the base of a forked session are copied only if needed. Paid loans are closed and removed.
+        """
+        session.current_time = self.current_time
+        for i in self.changed_users().tolist():
+            user = session.writable_user(i)
+            self.users[i] = user
+            user.savings_account.savings_cents = int(self.savings_cents[i])
+            user.savings_account.interest_rate = float(self.savings_interest_rate[i])
+            user.status = STATUSES[int(self.status[i])]
+            if not user.loans:
+                continue
+            remaining_loans = []
+            for j, loan in enumerate(user.loans):
+                loan.sum_cents = int(self.loan_sum_cents[i, j])
+                if self.loan_present[i, j]:
+                    remaining_loans.append(loan)
+                else:
+                    loan.status = LoanStatusEnum.PAID
+                    loan._detach()
+            user.loans = remaining_loans
+
+
+def month_forward_vectorized(session: Session):
+    """Silent, vectorized counterpart of admin_panel.handle_month_forward_action"""
+    columns = BankColumns.from_session(session)
+    columns.step()
+    columns.apply_to_session(session)
+    session.pop_users_with_expiring_loans()  # the columns check all loans, so the expiring ones are not needed
+
+
+def _open_shard(directory: str, start: int, stop: int, current_time: int) -> BankColumns:
+    """Detached columns of the rows start:stop of a ShardedBank, memory-mapped s.t. changes are written in place"""
+    shard = BankColumns.__new__(BankColumns)
+    shard.users = []
+    shard.current_time = current_time
+    for name in COLUMNS:
+        setattr(shard, name, np.load(os.path.join(directory, name + ".npy"), mmap_mode="r+")[start:stop])
+    shard._initial_columns = []
+    return shard
+
+
+def _step_shard(directory: str, start: int, stop: int, current_time: int, months: int) -> Tuple[int, int, List[int]]:
+    """Move the rows of a shard the months ahead in place and return their savings, loans and number of users per
+    status"""
+    shard = _open_shard(directory, start, stop, current_time)
+    if months == 1:
+        shard.step()
+    else:
+        shard.fast_forward(months)
+    return (int(shard.savings_cents.sum()), int(np.where(shard.loan_present, shard.loan_sum_cents, 0).sum()),
+            np.bincount(shard.status, minlength=len(STATUSES)).tolist())
+
+
+class ShardedBank:
+    """Month-end of a session with its users partitioned into shards that are stepped in a pool of worker processes
+
+    The columns of the bank (see BankColumns) are built from the users once and kept in memory-mapped files, so every
+    worker steps the rows of its shard in place, and only the bank totals of the shards are sent back and merged. A
+    month therefore costs a handful of array operations per shard and no work per user object; the users of the
+    session are updated from the columns only when apply_to_session is called. The session must not be changed while
+    the sharded bank is in use, other than by apply_to_session.
+
+    Usage example:
+    >>> with ShardedBank(session) as bank:
+    ...     for _ in range(12):
+    ...         bank.month_forward()
+    ...         print(bank.current_time, bank.money_in_bank)
+    ...     bank.apply_to_session()
+    """
+    session: Session
+    workers: int
+    current_time: int
+    total_user_savings_cents: int
+    total_user_loans_cents: int
+    status_counts: Dict[UserStatusSavingEnum, int]
+
+    def __init__(self, session: Session, workers: Optional[int] = None):
+        self.session = session
+        self.workers = workers or os.cpu_count() or 1
+        # The columns live in memory when /dev/shm is available
+        self._directory = tempfile.mkdtemp(prefix="bank-shards-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self._columns = None
+        self._load()
+
+    def _load(self):
+        """(Re)build the columns from the users of the session"""
+        columns = BankColumns.from_session(self.session)
+        # An empty file can not be memory-mapped, so there is at least one loan slot
+        detached = columns.detached_copy(n_slots=1)
+        for name in COLUMNS:
+            np.save(os.path.join(self._directory, name + ".npy"), getattr(detached, name))
+            setattr(columns, name, np.load(os.path.join(self._directory, name + ".npy"), mmap_mode="r+"))
+        columns._initial_columns = columns._columns()
+        self._columns = columns
+        n_users = len(columns.users)
+        self._shards = [(int(rows[0]), int(rows[-1]) + 1) for rows in
+                        np.array_split(np.arange(n_users), max(min(self.workers, n_users), 1)) if len(rows)]
+        self.current_time = columns.current_time
+        self.total_user_savings_cents = self.session._total_user_savings_cents
+        self.total_user_loans_cents = self.session._total_user_loans_cents
+        self.status_counts = {status: len(self.session._usernames_by_status[status]) for status in STATUSES.values()}
+
+    @property
+    def money_in_bank(self) -> float:
+        return MoneyUtils.to_euros(MoneyUtils.to_cents(self.session.initial_money_in_bank)
+                                   + self.total_user_savings_cents - self.total_user_loans_cents)
+
+    def month_forward(self):
+        """Move the bank one month ahead, with the same result as month_forward_vectorized"""
+        self.fast_forward(1)
+
+    def fast_forward(self, months: int):
+        """Move the bank the given number of months ahead at once, see BankColumns.fast_forward"""
+        if self._columns is None:  # the users were changed by apply_to_session
+            self._load()
+        arguments = [(self._directory, start, stop, self.current_time, months) for start, stop in self._shards]
+        if self._executor is None:
+            totals = [_step_shard(*shard_arguments) for shard_arguments in arguments]
+        else:
+            totals = list(self._executor.map(_step_shard, *zip(*arguments)))
+        self.current_time += months
+        self._columns.current_time = self.current_time
+        self.total_user_savings_cents = sum(savings_cents for savings_cents, _, _ in totals)
+        self.total_user_loans_cents = sum(loans_cents for _, loans_cents, _ in totals)
+        counts = np.sum([counts for _, _, counts in totals], axis=0, dtype=np.int64) if totals else [0] * len(STATUSES)
+        self.status_counts = {status: int(counts[code]) for code, status in STATUSES.items()}
+
+    def apply_to_session(self):
+        """Write the columns back to the users of the session, see BankColumns.apply_to_session"""
+        if self._columns is None:
+            return
+        self._columns.apply_to_session(self.session)
+        self.session.pop_users_with_expiring_loans()  # the columns check all loans, so the expiring ones are not needed
+        self._columns = None  # paid loans were removed from the users, so the columns are rebuilt on the next month
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._columns = None
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def __enter__(self) -> "ShardedBank":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def month_forward_sharded(session: Session, workers: Optional[int] = None):
+    """month_forward_vectorized with the users partitioned into shards that are stepped in a pool of worker processes
+
+    Building the columns from the users and writing them back are not parallel, so a single month gains little; keep
+    a ShardedBank to close many months in parallel and apply them to the users once.
+    """
+    with ShardedBank(session, workers) as bank:
+        bank.month_forward()
+        bank.apply_to_session()
+
+
+def fast_forward(session: Session, months: int):
+    """Move the session the given number of months ahead at once, see BankColumns.fast_forward
+
+    Gives the same result as calling month_forward_vectorized (or admin_panel.handle_month_forward_action) months times.
+    """
+    columns = BankColumns.from_session(session)
+    columns.fast_forward(months)
+    columns.apply_to_session(session)
+    session.pop_users_with_expiring_loans()